@@ -1,22 +1,182 @@
+import asyncio
+import json
+import logging
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-from google import genai
 from google.genai import types
 from pydantic import BaseModel
-import pandas as pd
 import numpy as np
 
+from AI.cache import SHARED_SINGLEFLIGHT, SemanticCache, SingleFlight, SQLiteCache, TieredCache, make_key, normalize_text
+from AI.catalog import ProductCatalog
+from AI.categories import CategoryIndex
+from AI.context import estimate_tokens, fit_history, truncate_text
+from AI.providers import provider_from_env
+from AI.scheduler import LLMUnavailable, Scheduler
+
 # Load environment variables
 load_dotenv()
 
-class AI:
-    client = genai.Client(api_key=os.getenv("API_KEY"))
-
-    # Load the product embeddings
-    products = pd.read_csv("./AI/scraper/products_with_embeddings.csv")
+logger = logging.getLogger(__name__)
+
+class ChatTurns:
+    """
+    Bookkeeping of one chat reply, shared by get_response, stream_response and their async versions:
+    the tool round limit, profile updates, streamed text, when the reply is complete and the turn logs.
+    The four loops only differ in how they call the model and run the function calls.
+    Iterating gives the generate request of each round and raises RuntimeError after max_tool_rounds.
+    Methods return the events a streaming caller yields; the blocking callers ignore them.
+    """
+
+    def __init__(self, ai, chat_history, user_profile, cache_entry, max_tool_rounds, label=""):
+        self.ai = ai
+        self.chat_history = chat_history
+        self.user_profile = user_profile
+        self.cache_entry = cache_entry
+        self.max_tool_rounds = max_tool_rounds
+        self.label = label
+        self.new_profile = None
+        self.reply = []
+
+    def __iter__(self):
+        for turn in range(self.max_tool_rounds + 1):
+            self.turn = turn
+            self.function_calls = []
+            self.pending = ""
+            self.streamed = False
+            self.started = time.perf_counter()
+            yield self.ai.chat_request(self.chat_history, self.user_profile)
+
+        raise RuntimeError("Too many function calls in one chat turn.")
+
+    def text_event(self, text):
+        self.reply.append(self.ai.expand_product_refs(text))
+        return {"type": "text", "text": self.reply[-1]}
+
+    def profile_events(self, new_profile):
+        if new_profile is None:
+            return []
+        self.user_profile = self.new_profile = new_profile
+        return [{"type": "profile", "new_profile": new_profile}]
+
+    def stream_chunk(self, chunk):
+        # Function calls are collected while streaming; product ids are expanded as they arrive,
+        # holding back a possibly cut one
+        events = []
+        for part in self.ai.response_parts(chunk):
+            if part.function_call:
+                self.function_calls.append(part.function_call)
+            elif part.text:
+                text, self.pending = self.ai.split_product_refs(self.pending + part.text)
+                self.streamed = True
+                if text:
+                    events.append(self.text_event(text))
+        return events
+
+    def end_stream(self):
+        # The streamed generation is over: flushes the held back text and records the answer
+        events = [self.text_event(self.pending)] if self.pending else []
+        return events + self.answered(self.function_calls, self.streamed)
+
+    def answered(self, function_calls, has_text):
+        """
+        Records the model's answer of this round. Afterwards self.done tells if the reply is complete:
+        no function calls, or a reply next to calls that only update the profile (the caller saves
+        the profile, the model needs no second round trip).
+        """
+        self.generated = time.perf_counter()
+        self.function_calls = function_calls
+        profile_update = self.ai.profile_only_update(function_calls) if function_calls and has_text else None
+        self.done = not function_calls or profile_update is not None
+        return self.profile_events(profile_update)
+
+    def add_results(self, message, new_profile):
+        # All the function responses of the round go back to the model in the next request
+        self.chat_history.append(message)
+        logger.info("chat turn %d%s: generate %.3fs, %d function calls %.3fs", self.turn, self.label,
+                    self.generated - self.started, len(self.function_calls), time.perf_counter() - self.generated)
+        return self.profile_events(new_profile)
+
+    def finish(self, text=None):
+        """Returns {"response": ...} plus "new_profile" if the model updated it. Streams pass no text."""
+        logger.info("chat turn %d%s: generate %.3fs", self.turn, self.label, self.generated - self.started)
+        response = "".join(self.reply) if text is None else self.ai.expand_product_refs(text)
+        self.ai.semantic_store(self.cache_entry, response, self.new_profile)
+        result = {"response": response}
+        if self.new_profile is not None:
+            result["new_profile"] = self.new_profile
+        return result
 
-    # Convert the embeddings from string to list of floats
-    products["embedding"] = products["embedding"].apply(lambda x: np.fromstring(x[1:-1], sep=",").astype(float))
+class AI:
+    # Every API call goes through the scheduler: per-model concurrency limits, quota pacing,
+    # retries with backoff, call deadlines and a circuit breaker (see AI/scheduler.py).
+    # Calls to a model whose breaker is open raise LLMUnavailable right away.
+    scheduler = Scheduler.from_env()
+
+    # Load the product catalog: metadata plus the memory-mapped float32 embedding matrix.
+    # Build it with `python -m AI.catalog` after re-running the encoder notebook.
+    # PRODUCT_ANN_INDEX=1 switches searches to the approximate index (`python -m AI.catalog --build-index`),
+    # PRODUCT_ANN_PROBES and PRODUCT_ANN_MIN_CANDIDATES trade speed for recall.
+    # PRODUCT_QUANTIZATION=int8|float16 scans a compact copy (`python -m AI.catalog --quantize int8`)
+    # and re-ranks the best PRODUCT_RERANK candidates at full precision. It saves memory but scans
+    # slower than the default float32 matrix (see AI/quantize.py).
+    catalog = ProductCatalog.load(
+        use_index=os.getenv("PRODUCT_ANN_INDEX") == "1",
+        n_probe=int(os.getenv("PRODUCT_ANN_PROBES", "8")),
+        min_candidates=int(os.getenv("PRODUCT_ANN_MIN_CANDIDATES", "0")),
+        quantization=os.getenv("PRODUCT_QUANTIZATION") or None,
+        rerank=int(os.getenv("PRODUCT_RERANK", "200")),
+    )
+    products = catalog.products
+
+    # Makes the generate / embed calls (see AI/providers.py). AI_PROVIDER=fake answers locally and
+    # deterministically, with embeddings the size of the catalog's, so tests and benchmarks run offline.
+    provider = provider_from_env(embedding_dim=catalog.embeddings.shape[1])
+    # The persistent caches of other providers live under their own namespaces, so fake answers
+    # are never served by (or to) the live API
+    cache_prefix = "" if provider.name == "gemini" else f"{provider.name}_"
+
+    # Category and tag names of the catalog, embedded on the first paraphrase. Each paraphrase
+    # prompt lists only the AI_PARAPHRASE_CATEGORIES names closest to the query.
+    category_index = CategoryIndex.from_products(products)
+    paraphrase_category_count = int(os.getenv("AI_PARAPHRASE_CATEGORIES", "25"))
+
+    embedding_model = "text-embedding-004"
+    # Most texts embed_content accepts in one request
+    embedding_batch_size = 100
+
+    # Query embeddings keyed by normalized text + model + task type.
+    # In-process LRU in front of a SQLite file shared by all workers (see AI/cache.py).
+    embedding_cache = TieredCache(
+        cache_prefix + "embeddings",
+        maxsize=int(os.getenv("AI_EMBEDDING_CACHE_SIZE", "4096")),
+        encode=lambda vector: np.asarray(vector, dtype=np.float32).tobytes(),
+        decode=lambda data: np.frombuffer(data, dtype=np.float32),
+    )
+
+    # Paraphrased queries keyed by normalized query + model + system instruction, so a changed
+    # prompt or category list never serves old entries. Entries expire after AI_PARAPHRASE_CACHE_TTL seconds.
+    paraphrase_cache = TieredCache(
+        cache_prefix + "paraphrases",
+        maxsize=int(os.getenv("AI_PARAPHRASE_CACHE_SIZE", "2048")),
+        ttl=int(os.getenv("AI_PARAPHRASE_CACHE_TTL", "86400")),
+    )
+
+    # Identical paraphrase, embedding and home calls in flight at the same time are made once and
+    # their result shared. With AI_SINGLEFLIGHT_SHARED=1 workers coordinate through leases in the cache file.
+    inflight = SingleFlight(leases=SQLiteCache(namespace=cache_prefix + "leases") if SHARED_SINGLEFLIGHT else None)
+
+    # Opt-in (AI_SEMANTIC_CACHE=1): first-turn chat questions close enough in meaning to an earlier
+    # one asked with the exact same profile get its stored reply instead of a new generation.
+    # Replies are written for a profile, so they are never shared between different profiles.
+    semantic_cache = SemanticCache(
+        maxsize=int(os.getenv("AI_SEMANTIC_CACHE_SIZE", "1024")),
+        threshold=float(os.getenv("AI_SEMANTIC_CACHE_THRESHOLD", "0.92")),
+        ttl=int(os.getenv("AI_SEMANTIC_CACHE_TTL", "86400")),
+    ) if os.getenv("AI_SEMANTIC_CACHE") == "1" else None
 
     # Tools for the AI
     # function definition to make product recommendations
@@ -30,6 +190,11 @@ class AI:
                     "type": "string",
                     "description": "The query to search for products. Make it relevant to the user's need.",
                 },
+                "additional_queries": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "description": "Optional extra queries when the user needs several different kinds of products. All queries are searched together.",
+                },
             },
             "required": ["query"],
         },
@@ -51,11 +216,28 @@ class AI:
         },
     }
 
+    # Token budgets (estimated locally, see AI/context.py). The chat budget covers the system
+    # instruction, the profile and the history; the oldest messages are trimmed or dropped to fit.
+    chat_context_tokens = int(os.getenv("AI_CONTEXT_TOKENS", "6000"))
+    # Each function result is cut to this size before it goes back to the model
+    tool_result_tokens = int(os.getenv("AI_TOOL_RESULT_TOKENS", "2000"))
+    # Input of the single-shot prompts (make_profile, paraphrase_query, summarize_chat)
+    input_tokens = int(os.getenv("AI_INPUT_TOKENS", "2000"))
+    summary_context_tokens = int(os.getenv("AI_SUMMARY_CONTEXT_TOKENS", "16000"))
+
+    # make_product_recommendations returns only the best AI_TOOL_PRODUCTS products to the model, one
+    # short line each with an id like P123 (the catalog row). The model cites products as [P123] and
+    # the title and link are filled in from the catalog after generation (see expand_product_refs).
+    tool_product_count = int(os.getenv("AI_TOOL_PRODUCTS", "8"))
+    tool_description_chars = int(os.getenv("AI_TOOL_DESCRIPTION_CHARS", "160"))
+    product_ref_pattern = re.compile(r"\[P(\d+)\]")
+
     tools = types.Tool(function_declarations=[update_profile, make_product_recommendations])
 
-    @classmethod
-    def get_response(cls, chat_history, user_profile):
-        system_instruction = """
+    # Function calls of one model turn run concurrently on this pool
+    tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv("AI_TOOL_WORKERS", "8")), thread_name_prefix="ai-tools")
+
+    chat_system_instruction = """
 You are EcoGenie, a friendly and helpful AI assistant passionate about sustainability. 
 Your purpose is to provide information, tips, and resources to help users live more eco-consciously. 
 
@@ -64,51 +246,289 @@ user_profile: {user_profile}
 
 - If you identify new information about the user that doesn't exist in user_profile, create an updated profile text. To do this, call the function update_profile with the new profile text.
 
-- If you think some product recommendation might help the user, call the function make_product_recommendations with a relevant query. The function will return a list of products. Suggest the most relevant products from the list to the user. Give a short description of the product and why it might be useful for the user and the site link to buy it.
+- If you think some product recommendation might help the user, call the function make_product_recommendations with a relevant query. The function will return a list of products, one per line, each starting with its id (e.g. P123). Suggest the most relevant products from the list to the user. Refer to each product by its id in square brackets (e.g. [P123]), it will be replaced with the product name and a link to buy it. Give a short description of the product and why it might be useful for the user.
 
 If a user asks a question unrelated to sustainability, politely inform them that you are focused on helping people live more sustainably and cannot answer their question.
-"""     
-        response = cls.client.models.generate_content(
-            model = "gemini-2.0-flash",
-            contents = [types.Content(role=content.get("role"), parts=[types.Part.from_text(text=content.get("parts"))]) for content in chat_history],
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction.format(user_profile=user_profile),
+"""
+
+    @classmethod
+    def generate(cls, **request):
+        return cls.scheduler.call(request["model"], cls.provider.generate, **request)
+
+    @classmethod
+    def generate_stream(cls, **request):
+        return cls.scheduler.stream(request["model"], cls.provider.generate_stream, **request)
+
+    @classmethod
+    def embed(cls, **request):
+        return cls.scheduler.call(request["model"], cls.provider.embed, **request)
+
+    @classmethod
+    async def agenerate(cls, **request):
+        return await cls.scheduler.acall(request["model"], cls.provider.agenerate, **request)
+
+    @classmethod
+    def agenerate_stream(cls, **request):
+        return cls.scheduler.astream(request["model"], cls.provider.agenerate_stream, **request)
+
+    @classmethod
+    async def aembed(cls, **request):
+        return await cls.scheduler.acall(request["model"], cls.provider.aembed, **request)
+
+    @classmethod
+    def fit_context(cls, chat_history, budget, *fixed):
+        """
+        Trims chat_history to what's left of `budget` once the fixed texts (system instruction, profile...)
+        are counted. The latest turn is always kept. Logs and returns (history, tokens_saved).
+        """
+        history, saved = fit_history(chat_history, budget - sum(estimate_tokens(text) for text in fixed))
+        if saved:
+            logger.info("context: dropped %d of %d messages, saved ~%d tokens",
+                        len(chat_history) - len(history), len(chat_history), saved)
+        return history, saved
+
+    @classmethod
+    def chat_request(cls, chat_history, user_profile):
+        # Arguments for a chat generate_content call, shared by the blocking and streaming paths.
+        # The history is windowed to the token budget, whatever the client sent.
+        system_instruction = cls.chat_system_instruction.format(user_profile=user_profile)
+        chat_history, _ = cls.fit_context(chat_history, cls.chat_context_tokens, system_instruction)
+        return {
+            "model": "gemini-2.0-flash",
+            "contents": [types.Content(role=content.get("role"), parts=[types.Part.from_text(text=content.get("parts"))]) for content in chat_history],
+            "config": types.GenerateContentConfig(
+                system_instruction=system_instruction,
                 tools=[cls.tools]
             ),
-        )
-        
-        # check for function calls. Due to the current limitations of the API, we can't resolve text that comes before the function calls.
-        # So we need to check if the function call is present in any part the response and then deal with the function call.
-        # Since the response text alongside the function call is not useful, we need to recursively get another response after dealing with the function call.
-        for part in response.candidates[0].content.parts:
-            if part.function_call:
-                if part.function_call.name == "update_profile":
-                    # get the updated profile
-                    new_profile = part.function_call.args.get("new_profile")
-
-                    # Append function call and result of the function execution to contents
-                    # chat_history.append({"role": "model", "parts": f"Function call (name:{part.function_call.name}, args: {part.function_call.args})"})
-                    chat_history.append({"role": "user", "parts": f"Function response (name:{part.function_call.name}, args: {part.function_call.args}, response: {{'result': 'Profile updated successfully.'}})"})
-
-                    return {"response": cls.get_response(chat_history, new_profile).get('response'), "new_profile" :new_profile}
-                
-                elif part.function_call.name == "make_product_recommendations":
-                    # get the query
-                    query = part.function_call.args.get("query")
-                    
-                    # get the products
-                    paraphrased_query = cls.paraphrase_query(query)
-                    products = cls.get_products(paraphrased_query)
-
-                    # Append function call and result of the function execution to contents
-                    # chat_history.append({"role": "model", "parts": f"Function call (name:{part.function_call.name}, args: {part.function_call.args})"})
-                    chat_history.append({"role": "user", "parts": f"Function response (name:{part.function_call.name}, args: {part.function_call.args}, response: {products})"})                    
-
-                    return {"response": cls.get_response(chat_history, user_profile).get('response')}
-            
-        return {"response": response.text}
+        }
+
+    @classmethod
+    def run_function_call(cls, function_call):
+        """
+        Executes a function call from the model.
+        Returns the "Function response" message to append to the chat history and the new profile (or None).
+        """
+        if function_call.name == "update_profile":
+            # get the updated profile
+            new_profile = function_call.args.get("new_profile")
+            result = {'result': 'Profile updated successfully.'}
+
+        elif function_call.name == "make_product_recommendations":
+            new_profile = None
+
+            # get the query
+            query = function_call.args.get("query")
+            additional_queries = function_call.args.get("additional_queries") or []
+
+            # get the products. Several product intents are searched in one batch
+            if additional_queries:
+                indices = cls.rank_products_batch([query, *additional_queries], cls.tool_product_count)
+            else:
+                paraphrased_query = cls.paraphrase_query(query)
+                indices = cls.rank_products(paraphrased_query, cls.tool_product_count)
+            result = cls.compact_products(indices)
+
+        else:
+            new_profile = None
+            result = {'error': f'Unknown function {function_call.name}.'}
+
+        return cls.function_response_message(function_call, result), new_profile
+
+    @classmethod
+    def function_response_message(cls, function_call, result):
+        # Result of the function execution, to be appended to contents
+        # chat_history.append({"role": "model", "parts": f"Function call (name:{function_call.name}, args: {function_call.args})"})
+        result = truncate_text(result, cls.tool_result_tokens)
+        return {"role": "user", "parts": f"Function response (name:{function_call.name}, args: {function_call.args}, response: {result})"}
+
+    @classmethod
+    def compact_products(cls, indices):
+        """
+        Tool result for make_product_recommendations: one line per product with its id,
+        title, brand and a shortened description. Links stay server side.
+        """
+        lines = []
+        for index, product in zip(indices, cls.products.iloc[indices][["title", "brand", "description"]].itertuples(index=False)):
+            description = str(product.description)
+            if len(description) > cls.tool_description_chars:
+                description = description[:cls.tool_description_chars].rsplit(" ", 1)[0] + "..."
+            lines.append(f"P{index}: {product.title} | {product.brand} | {description}")
+        return "\n".join(lines)
+
+    @classmethod
+    def expand_product_refs(cls, text):
+        # Replaces the [P123] product ids in a reply with a markdown link to the product.
+        # Ids outside the catalog are left as they are.
+        def link(match):
+            index = int(match.group(1))
+            if index >= len(cls.products):
+                return match.group(0)
+            product = cls.products.iloc[index]
+            return f"[{product['title']}]({product['site-link']})"
+
+        return cls.product_ref_pattern.sub(link, text)
+
+    @staticmethod
+    def split_product_refs(text):
+        # Splits streamed text into the part that can be expanded now and a tail that may be
+        # the start of a product id cut by a chunk boundary
+        start = text.rfind("[")
+        if start == -1 or "]" in text[start:] or len(text) - start > 12:
+            return text, ""
+        return text[:start], text[start:]
+
+    @staticmethod
+    def response_parts(response):
+        # Parts of the first candidate, empty for chunks without content
+        if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+            return []
+        return response.candidates[0].content.parts
+
+    @classmethod
+    def function_calls(cls, response):
+        # Every function call the model made in this response (it may make several in one turn)
+        return [part.function_call for part in cls.response_parts(response) if part.function_call]
+
+    @classmethod
+    def response_text(cls, response):
+        # Text parts of a response, without the warning response.text gives when it also has function calls
+        return "".join(part.text for part in cls.response_parts(response) if part.text)
+
+    @staticmethod
+    def profile_only_update(function_calls):
+        """
+        update_profile is a side effect: when it is the only kind of call in a turn, the model doesn't
+        need its result. Returns the new profile (last call wins) or None if other functions were called.
+        """
+        if not all(function_call.name == "update_profile" for function_call in function_calls):
+            return None
+        return function_calls[-1].args.get("new_profile")
+
+    @classmethod
+    def run_function_calls(cls, function_calls):
+        """
+        Executes all the function calls of a turn concurrently.
+        Returns one message with all their "Function response"s (in call order) and the new profile (or None).
+        """
+        if len(function_calls) == 1:
+            results = [cls.run_function_call(function_calls[0])]
+        else:
+            results = list(cls.tool_executor.map(cls.run_function_call, function_calls))
+
+        return cls.merge_function_results(results)
+
+    @staticmethod
+    def merge_function_results(results):
+        # All the responses of a turn go back to the model as one message; the last profile update wins
+        new_profile = None
+        for _, profile in results:
+            if profile is not None:
+                new_profile = profile
+        message = {"role": "user", "parts": "\n".join(message["parts"] for message, _ in results)}
+        return message, new_profile
+
+    @classmethod
+    def semantic_cache_question(cls, chat_history, use_cache):
+        # Only a first-turn question can be answered from the semantic cache
+        if cls.semantic_cache is None or not use_cache or len(chat_history) != 1 or chat_history[0].get("role") != "user":
+            return None
+        return chat_history[0].get("parts")
+
+    @staticmethod
+    def semantic_cache_bucket(user_profile):
+        # Replies can mention anything in the profile they were generated for (name, age, habits),
+        # so only the exact same profile may reuse them
+        return make_key(json.dumps(user_profile, sort_keys=True, default=str))
+
+    @classmethod
+    def semantic_lookup(cls, chat_history, user_profile, use_cache):
+        """
+        Looks a first-turn question up in the semantic cache.
+        Returns (entry, response): entry is passed to semantic_store later (None if the cache doesn't apply),
+        response is the cached reply or None.
+        The question is only embedded if its profile's bucket has entries; an unavailable
+        embedding model skips the cache instead of failing the chat.
+        """
+        question = cls.semantic_cache_question(chat_history, use_cache)
+        if question is None:
+            return None, None
+        bucket = cls.semantic_cache_bucket(user_profile)
+        if cls.semantic_cache.empty_bucket(bucket):
+            return (question, bucket, None), None
+        try:
+            embedding = cls.embed_queries([question], task_type="SEMANTIC_SIMILARITY")[0]
+        except LLMUnavailable as e:
+            logger.warning("Skipping the semantic cache: %s", e)
+            cls.semantic_cache.count_miss()
+            return None, None
+        return (question, bucket, embedding), cls.semantic_cache.lookup(embedding, bucket)
+
+    @classmethod
+    def semantic_store(cls, entry, response, new_profile):
+        # A reply that updated the profile was about this user, not the question, so it isn't shared
+        if entry is None or not response or new_profile is not None:
+            return
+        question, bucket, embedding = entry
+        if embedding is not None:
+            cls.semantic_cache.store(embedding, bucket, response)
+        else:
+            # The lookup skipped the embedding (empty bucket): embed off the request path
+            cls.tool_executor.submit(cls.embed_and_store, cls.semantic_cache, question, bucket, response)
+
+    @classmethod
+    def embed_and_store(cls, semantic_cache, question, bucket, response):
+        try:
+            embedding = cls.embed_queries([question], task_type="SEMANTIC_SIMILARITY")[0]
+        except LLMUnavailable as e:
+            logger.warning("Reply not added to the semantic cache: %s", e)
+            return
+        semantic_cache.store(embedding, bucket, response)
+
+    @classmethod
+    def get_response(cls, chat_history, user_profile, max_tool_rounds=5, use_cache=True):
+        """
+        Generates the model's reply. Function calls are resolved in a loop: all the calls of a
+        turn run concurrently and their results go back to the model in a single follow-up request.
+        With the semantic cache enabled, use_cache=False bypasses it.
+        Returns {"response": ...} plus "new_profile" if the model updated the profile.
+        """
+        cache_entry, cached = cls.semantic_lookup(chat_history, user_profile, use_cache)
+        if cached is not None:
+            return {"response": cached}
+
+        turns = ChatTurns(cls, chat_history, user_profile, cache_entry, max_tool_rounds)
+        for request in turns:
+            response = cls.generate(**request)
+            text = cls.response_text(response)
+            turns.answered(cls.function_calls(response), text)
+            if turns.done:
+                return turns.finish(text)
+            turns.add_results(*cls.run_function_calls(turns.function_calls))
+
+    @classmethod
+    def stream_response(cls, chat_history, user_profile, max_tool_rounds=5, use_cache=True):
+        """
+        Streaming version of get_response. Yields events as the model produces them:
+        - {"type": "text", "text": ...} for every chunk of the reply
+        - {"type": "profile", "new_profile": ...} when the model updates the profile
+        Function calls are collected while streaming, resolved together and a new generation is streamed with their results.
+        A semantic cache hit is yielded as a single text event.
+        """
+        cache_entry, cached = cls.semantic_lookup(chat_history, user_profile, use_cache)
+        if cached is not None:
+            yield {"type": "text", "text": cached}
+            return
+
+        turns = ChatTurns(cls, list(chat_history), user_profile, cache_entry, max_tool_rounds, " (stream)")
+        for request in turns:
+            for chunk in cls.generate_stream(**request):
+                yield from turns.stream_chunk(chunk)
+            yield from turns.end_stream()
+            if turns.done:
+                turns.finish()
+                return
+            yield from turns.add_results(*cls.run_function_calls(turns.function_calls))
 
-    
     @classmethod
     def make_profile(cls, info):
         system_instruction = """
@@ -118,10 +538,10 @@ For this task, you will be given a list of questions and a user's response to th
 Respond with just a short and concise profile summary that captures the user's key characteristics, lifestyle, and sustainability habits from their responses.
 Don't add anything else to the response.
 """
-        response = cls.client.models.generate_content(
+        response = cls.generate(
             model = "gemini-2.0-flash-lite",
             contents = [
-                types.Content(role="user", parts = [types.Part.from_text(text=info)])
+                types.Content(role="user", parts = [types.Part.from_text(text=truncate_text(info, cls.input_tokens))])
             ],
                 config=types.GenerateContentConfig(
                     system_instruction=system_instruction,
@@ -147,7 +567,8 @@ If the "Conversation summary" is too long, you can further summarize the older i
 
 Return response in json format [{}]
 """
-        response = cls.client.models.generate_content(
+        chat_history, _ = cls.fit_context(chat_history, cls.summary_context_tokens, system_instruction)
+        response = cls.generate(
             model = "gemini-2.0-flash",
             contents = [types.Content(role="user", parts=[types.Part.from_text(text=str(chat_history))])],
             config=types.GenerateContentConfig(
@@ -159,7 +580,21 @@ Return response in json format [{}]
         return response.text
     
     @classmethod
-    def AI_home_response(cls, user_profile):
+    def compact_chat(cls, chat_history):
+        """
+        Folds a chat_history into a shorter one with summarize_chat.
+        Returns the summarized history (list of {"role", "parts"}), raises ValueError if the model's output isn't one.
+        """
+        compacted = json.loads(cls.summarize_chat(chat_history))
+        if not isinstance(compacted, list) or not all(
+            isinstance(content, dict) and content.get("role") in ("user", "model") and isinstance(content.get("parts"), str)
+            for content in compacted
+        ):
+            raise ValueError("summarize_chat returned an invalid chat history.")
+        return [{"role": content["role"], "parts": content["parts"]} for content in compacted]
+
+    @classmethod
+    def home_request(cls, user_profile):
         system_instruction ="""
 You are EcoGenie, a friendly and helpful AI assistant passionate about sustainability. 
 Your purpose is to provide information, tips, and resources to help users live more eco-consciously. 
@@ -168,70 +603,384 @@ You should personalize your suggestions based on the user's profile provided bel
 
 user_profile: {user_profile}
 """     
-        response = cls.client.models.generate_content(
-            model = "gemini-2.0-flash",
-            contents = """
+        return {
+            "model": "gemini-2.0-flash",
+            "contents": """
 As part of the onboarding, give user a list of suggestions that they can later pick and choose from for later for deeper explanation.
 The suggestions should be practical and actionable, focusing on sustainability and eco-friendly practices. Each suggestion should have title and small description. example:
 
 **Compost Food Scraps:** Start a compost bin to turn food scraps and yard waste into nutrient-rich soil for your garden.
  
 only response the list of suggestions and nothing else. Do not add anything else to the response.""",
-                config=types.GenerateContentConfig(
-                    system_instruction=system_instruction.format(user_profile=user_profile),
+            "config": types.GenerateContentConfig(
+                system_instruction=system_instruction.format(user_profile=user_profile),
             ),
-        )
-        return response.text
-    
+        }
+
     @classmethod
-    def paraphrase_query(cls, query):
-        system_instruction = """
+    def home_flight_key(cls, request, user_profile):
+        return make_key("home", request["model"], normalize_text(user_profile))
+
+    @classmethod
+    def AI_home_response(cls, user_profile):
+        request = cls.home_request(user_profile)
+        return cls.inflight.do(cls.home_flight_key(request, user_profile), lambda: cls.generate(**request).text)
+    
+    paraphrase_model = "gemini-2.0-flash-lite"
+
+    paraphrase_system_instruction = """
 You are EcoGenie, a friendly and helpful AI assistant passionate about sustainability.
 Your purpose is to provide information, tips, and resources to help users live more eco-consciously.
 
 You will be given a query about what the user is looking for. Products are stored in an embedding database. 
 Each products had a description like this: Wooden Styling Comb. Brand: Eco Living. Categories: Haircare, Brushes & Combs. Tags: Natural, Plastic Free, Biodegradable, Sustainable. A beautiful beech wood comb with rounded teeth. Natural or wooden bristles are gentle to the hair structure and avoid damage, would suit thick or curly hair.
 This description was embedded and stored in the database.
-The products can belong to multiple of the following categories: ['Haircare', 'Brushes & Combs', 'Kitchen', 'Kitchen Essentials', 'Bathroom', 'Toothbrushes', 'Mama & Baby', 'Baby Bottles', 'Skincare', 'Eye Creams', 'Soap Bars', 'Facial Cleansing Soap Bars', 'Food & Drink', 'Tea', 'All Shampoo', 'Shampoo Bars', 'Body Oil', 'Deodorants', 'Deodorant Tins', 'For The Home', 'Makeup', 'Complexion', 'Foundations', 'On-The-Go', 'Produce Bags', 'Glitter', 'Glitter Sets', 'Gifts', 'Gift Sets', 'Skincare Accessories', 'All Conditioners', 'Conditioner Liquid', 'Pets Supplies', 'Dog Treats', 'Deodorant Sticks', 'Facial Serums', 'Toys & Books', "Children's Books", 'Suncream', 'Gardening', 'Face Masks', 'Shampoo Liquid', 'Stationery', 'Gift Wrap', 'Eyes', 'Eyeshadows', 'Shampoo Cubes', 'Nuts & Seeds', 'Seeds', 'Dish Cloths & Towels', 'Hair Treatments & Masks', 'Safety Razors', 'Poop Bags', 'Flour & Baking', 'Flours & Baking', 'Loose Tea', 'Kids Toothbrushes', 'Chocolate', 'All Drinking Bottles', 'Glass Bottles', 'Pacifiers & Rattles', 'Nuts', 'Herbs & Spices', 'Deodorant Glass Jars', 'Greeting Cards', 'Coffee', 'Drinking Cups', 'Kitchen Utensils', 'Single Safety Razors', 'Hand & Body Soap Bars', 'Straws', 'Bread Bags', 'Candles', 'Incense Sticks', 'All Kitchen Cleaning', 'Soap Pouches', 'Chocolate & Sweets', 'Cleaning Brushes', 'Dish Brushes', 'Cloths & Rounds', 'Cotton Rounds', 'Bathroom Cleaning', 'All Laundry', 'Laundry Accessories', 'On-The-Go Essentials', 'Household Cleaning', 'Soap Dishes', 'Tealights', 'All Lunch Boxes', 'Stainless Steel Lunch Boxes', 'Safety Razor Kits', 'Baby Wipes', 'Dish Sponges', 'Bath Bombs', 'Cotton Swabs', 'Eco-Friendly Kits', 'Vitamins', 'Pens & Pencils', 'Pens', 'Deodorant Bars', 'New Arrivals', 'Bowl Covers', 'Unpaper Towels', 'Face Creams', 'Lips', 'Lipsticks', 'Makeup Accessories', 'Makeup Brushes', 'Foot & Hand Creams', 'Toys', 'Garden Essentials', 'Makeup Palettes', 'Essential Oils', 'Legumes', 'Beans', 'String & Twine', 'Perfume & Cologne', 'Liquid Soaps', 'Body Wash', 'Face Scrubs', 'Safety Razor Accessories', 'Books', 'All Moisturisers', 'Menstrual Products', 'Menstrual Pads', 'Brows', 'Balms', 'Single Toothbrushes', 'Cotton Bags', 'Storage Baskets', 'Dental Floss', 'Makeup Pencils', 'Coffee Cups', 'Insulated Coffee Cups', 'Dried Fruit', 'Mouthwash', 'Oil Pulling Mouthwash', 'Condiments', 'Mayonnaise', 'Silicone Coffee Cups', 'Sponges', 'Toothpaste', 'Toothpaste Tablets', 'Garden Tools', 'Concealers', 'Straw Cleaning Brushes', 'Travel Utensils', 'Bath Mats', 'Toothpowders', 'Hair Styling', 'Cheeks', 'Blush & Bronzers', 'Wax Wraps', 'Wax Wrap Refresher Blocks', 'Kids Bottles', 'Body Butters', 'All Food Storage', 'Laundry Bar & Powders', 'Garden Kits', 'Bowls & Cutlery', 'Body Brushes', 'Bath Salts', 'Oils', 'Pasta, Rice & Grains', 'Rice, Grains & Cous Cous', 'Bottle Brushes', 'Hot Water Bottles', 'Hair Ties', 'Wet Bags', 'Beeswax Wraps', 'Wax Melts', 'First Aid', 'Bamboo Plasters', 'Dry Shampoo', 'Dog Shampoo', 'Bin Bags', 'Pasta & Spaghetti', 'Soda Free Deodorants', 'Multipack Toothbrushes', 'Baby Skincare', 'Baby Bowls & Utensils', 'Lip Balms', 'Laundry & Dryer Eggs', 'Dryer Eggs', 'Lunch Bags', 'Sandwich Bags', 'Hair Rinse', 'Net Bags', 'Body Wash Liquids', 'Salt', 'Highlighters', 'Natural Toothpaste', 'Period Pants', 'Laundry Liquid', 'Shaving Soap', 'Wheat Bags', 'Stainless Steel Bottles', 'Ground Coffee', 'Facial Cleansers', 'Mascaras', 'Drinkware', 'Baby Bibs', 'Organic Soap Bars', "Men's Haircare", 'Beard Care', 'Household Essentials', 'Laundry Sheets', 'Shaving Brushes', 'Glass Coffee Cups', 'Festival Essentials', 'Turkish Towels', 'Paw Salves', 'Instant Coffee', 'Hand Sanitiser', 'Shaving Accessories', 'Notepads', 'Makeup Removers', 'Tea Bags', 'Lip Scrubs', 'Conditioner Bars', 'Nails', 'Nail Polish Removers', 'Shaving Bars', 'Incense Holders', 'Chewing Gum', "Men's Skincare", 'Eyeliners', 'Cereal & Beverages', 'Cereals', 'Nut Butter', 'Peas', 'Facial Toners', 'Baby Bath Mats', 'Deodorant Refills', 'Body Scrubs', 'Toothbrush Cases', 'Finishing Powders', 'Coffee Accessories', 'Body Wash Bars & Cubes', 'Mouthwash Tablets', 'Rubber Gloves', 'Food Bags', 'Stainless Steel Straws', 'Clothing Accessories', 'Nail Polish', 'Dog Toys', 'Dish Soap', 'Washing Up', 'Shampoo Powder', 'Nail Brushes', 'DIY Cleaning Supplies', 'Organic', 'Kitchen & Home', 'Toothbrush Heads', 'Primers', 'Dog Bowls', 'Crisps', 'Cocktail Mixes', 'Bamboo Flannels', 'Tea Accessories', 'Tongue Scrapers', 'Nail Care', 'Sugar', 'Food Containers', 'Dishwasher Tablets', 'All Dental Care', 'Baby Balms', 'Laundry Eggs', 'Wash Powder', 'Tomato Ketchup', 'Gluten-Free Pasta', 'Aftersun', 'Baby Cloth Wipes', 'Baby Pacifiers', 'Christmas', 'Stocking Fillers', 'Room Sprays', 'Toilet Roll', 'Hair Wax & Clay', 'Silicone Lunch Boxes', 'Bags & Luggage', 'Coffee Capsules', 'Body Wash Foam Powder', 'Cloth Nappies', 'Cleaning Powders', 'Makeup Remover Oil', 'Crystal Deodorants', 'Vegan Wax Wraps', 'Toiletry Bags', 'Gift Vouchers', 'Menstrual Cups', 'Vinegar', 'Glue', 'Cold Cups']
+The categories and tags of the catalog closest to the query are: {categories}
 
 Based on this, paraphrase the user's query in a way that will return the most relevant products. The products are recommended based on the dot product of the query and the product description embeddings.
 """
-        # Paraphrasing the query
-        response = cls.client.models.generate_content(
-            model = "gemini-2.0-flash-lite",
-            contents = query,
-                config=types.GenerateContentConfig(
-                    system_instruction=system_instruction,
+
+    @classmethod
+    def paraphrase_cache_key(cls, query):
+        # Repeated searches skip the LLM hop entirely.
+        # Temperature 0 keeps the output deterministic, so caching it changes nothing.
+        # The category list is picked from the query, so the vocabulary version stands in for it
+        return make_key(cls.paraphrase_model, cls.paraphrase_system_instruction, cls.category_index.version,
+                        normalize_text(query, strip_punctuation=True))
+
+    @classmethod
+    def paraphrase_request(cls, query, categories):
+        # generate_content arguments for paraphrasing a search query
+        return {
+            "model": cls.paraphrase_model,
+            "contents": query,
+            "config": types.GenerateContentConfig(
+                system_instruction=cls.paraphrase_system_instruction.format(categories=categories),
+                temperature=0,
             ),
-        )
+        }
 
-        return response.text
+    @classmethod
+    def relevant_categories(cls, query):
+        # A vocabulary that fits the prompt is listed whole, nothing to embed
+        if len(cls.category_index) <= cls.paraphrase_category_count:
+            return list(cls.category_index.names)
+        # The vocabulary is embedded once per worker (and cached on disk for the others)
+        if not cls.category_index.embedded:
+            names = cls.category_index.names
+            embeddings = []
+            for i in range(0, len(names), cls.embedding_batch_size):
+                embeddings += cls.embed_queries(names[i:i + cls.embedding_batch_size], task_type="RETRIEVAL_DOCUMENT")
+            cls.category_index.set_embeddings(embeddings)
+
+        return cls.category_index.nearest(cls.embed_query(query), cls.paraphrase_category_count)
+
+    @classmethod
+    def paraphrase_query(cls, query):
+        query = truncate_text(query, cls.input_tokens)
+        cache_key = cls.paraphrase_cache_key(query)
+        paraphrased_query = cls.paraphrase_cache.get(cache_key)
+        if paraphrased_query is not None:
+            return paraphrased_query
+
+        # Paraphrasing the query
+        def paraphrase():
+            response = cls.generate(**cls.paraphrase_request(query, cls.relevant_categories(query)))
+            if response.text:
+                cls.paraphrase_cache.set(cache_key, response.text)
+            return response.text
+
+        # Concurrent duplicates share one call. If the model is unavailable the raw query is searched instead
+        try:
+            return cls.inflight.do(make_key("paraphrase", cache_key), paraphrase, lambda: cls.paraphrase_cache.peek(cache_key))
+        except LLMUnavailable as e:
+            logger.warning("paraphrase skipped: %s", e)
+            return query
         
     @classmethod
-    def get_products(cls, query, start=0, count=20):
+    def cached_embeddings(cls, queries, task_type):
+        """
+        Looks the queries up in the embedding cache.
+        Returns the cache keys, the embeddings (None where missing) and the indices of the misses.
+        """
+        keys = [make_key(cls.embedding_model, task_type, normalize_text(query)) for query in queries]
+        embeddings = [cls.embedding_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return keys, embeddings, missing
+
+    @classmethod
+    async def acached_embeddings(cls, queries, task_type):
+        # Async version of cached_embeddings, the disk tier is read off the event loop
+        keys = [make_key(cls.embedding_model, task_type, normalize_text(query)) for query in queries]
+        embeddings = await cls.embedding_cache.aget_many(keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return keys, embeddings, missing
+
+    @classmethod
+    def embedding_request(cls, queries, task_type):
+        return {"model": cls.embedding_model, "contents": queries, "config": types.EmbedContentConfig(task_type=task_type)}
+
+    @classmethod
+    def store_embeddings(cls, keys, response):
+        # Caches the embeddings of an embed_content response (one per key) and returns them
+        vectors = [np.asarray(embedding.values, dtype=np.float32) for embedding in response.embeddings]
+        for key, vector in zip(keys, vectors):
+            cls.embedding_cache.set(key, vector)
+        return vectors
+
+    @classmethod
+    async def astore_embeddings(cls, keys, response):
+        vectors = [np.asarray(embedding.values, dtype=np.float32) for embedding in response.embeddings]
+        await cls.embedding_cache.aset_many(list(zip(keys, vectors)))
+        return vectors
+
+    @classmethod
+    def peek_embeddings(cls, keys):
+        # The cached embeddings of all the keys, or None while any is missing
+        vectors = [cls.embedding_cache.peek(key) for key in keys]
+        return None if any(vector is None for vector in vectors) else vectors
+
+    @classmethod
+    def embed_queries(cls, queries, task_type="RETRIEVAL_QUERY"):
+        queries = list(queries)
+
+        # Repeated queries are served from the embedding cache
+        keys, embeddings, missing = cls.cached_embeddings(queries, task_type)
+
+        if missing:
+            # Embedding all the missing queries in a single request, shared with concurrent duplicates
+            missing_keys = [keys[i] for i in missing]
+            vectors = cls.inflight.do(
+                make_key("embed", *missing_keys),
+                lambda: cls.store_embeddings(missing_keys, cls.embed(**cls.embedding_request([queries[i] for i in missing], task_type))),
+                lambda: cls.peek_embeddings(missing_keys),
+            )
+            for i, vector in zip(missing, vectors):
+                embeddings[i] = vector
+
+        return embeddings
+
+    @classmethod
+    def embed_query(cls, query):
         # Embedding the paraphrased query
-        response = cls.client.models.embed_content(
-            model="text-embedding-004",
-            contents=[query],
-            config=types.EmbedContentConfig(task_type="RETRIEVAL_QUERY"))
+        return cls.embed_queries([query])[0]
 
-        embedded_query = response.embeddings[0].values
+    @classmethod
+    def rank_products(cls, query, limit):
+        # Returns the catalog row indices of the `limit` most similar products, best first.
+        # Only the top `limit` scores are selected and sorted, never the whole catalog.
+        embedded_query = cls.embed_query(query)
+        return cls.catalog.search(embedded_query, limit).tolist()
+
+    @classmethod
+    def rank_products_batch(cls, queries, limit, rrf_k=60):
+        # One embedding request and one matrix-matrix product for all queries,
+        # with the per-query rankings merged by reciprocal-rank fusion
+        embedded_queries = cls.embed_queries(queries)
+        return cls.catalog.search_batch(embedded_queries, limit, rrf_k=rrf_k).tolist()
 
-        # Finding the most similar products using dot product
-        dot_product = np.dot(np.stack(cls.products["embedding"]), embedded_query)
+    @classmethod
+    def products_from_indices(cls, indices):
+        products_to_return = cls.products.iloc[indices]
+        return products_to_return[["title", "brand", "description", "image-link", "site-link"]].to_dict(orient="records")
 
-        # Sorting the products based on similarity
-        sorted_indices = np.argsort(dot_product)[::-1]
+    @classmethod
+    def get_products(cls, query, start=0, count=20):
+        # Rank just enough products to cover the requested window
+        sorted_indices = cls.rank_products(query, start + count)
 
-        # Getting the top 30 products
-        products_to_return = cls.products.iloc[sorted_indices[start:start + count]]
+        return cls.products_from_indices(sorted_indices[start:start + count])
 
-        products_to_return = products_to_return[["title", "brand", "description", "image-link", "site-link"]].to_dict(orient="records")
-        return products_to_return
+    @classmethod
+    def search_batch(cls, queries, count=20, rrf_k=60):
+        # Searches several product intents at once and returns one fused list of products
+        return cls.products_from_indices(cls.rank_products_batch(queries, count, rrf_k=rrf_k))
+
+    @classmethod
+    def cache_stats(cls):
+        # Hit/miss counters of this worker's AI caches, served to staff at /api/admin/ai-stats/
+        stats = {
+            "embeddings": cls.embedding_cache.stats(),
+            "paraphrases": cls.paraphrase_cache.stats(),
+            "scheduler": cls.scheduler.stats(),
+            "inflight": cls.inflight.stats(),
+        }
+        if cls.semantic_cache is not None:
+            stats["semantic"] = cls.semantic_cache.stats()
+        return stats
 
     @classmethod
     def get_product_query_from_profile(cls, user_profile):
         # Generating a paraphrased query from the user profile
         query = cls.paraphrase_query(f"Create a query based on this profile: {user_profile}")
 
-        return query
\ No newline at end of file
+        return query
+    # Async variants of the LLM-bound methods, for the ASGI views (see EcoGenie/api/async_views.py).
+    # They await the provider's async calls, so one event loop can keep hundreds of calls in flight,
+    # and share the request builders and caches with the blocking versions above.
+    # CPU bound work (catalog searches, pandas) and the SQLite cache tier run in a thread so they never stall the loop.
+
+    @classmethod
+    async def aembed_queries(cls, queries, task_type="RETRIEVAL_QUERY"):
+        queries = list(queries)
+        keys, embeddings, missing = await cls.acached_embeddings(queries, task_type)
+
+        if missing:
+            missing_keys = [keys[i] for i in missing]
+
+            async def embed():
+                return await cls.astore_embeddings(missing_keys, await cls.aembed(**cls.embedding_request([queries[i] for i in missing], task_type)))
+
+            vectors = await cls.inflight.ado(make_key("embed", *missing_keys), embed, lambda: cls.peek_embeddings(missing_keys))
+            for i, vector in zip(missing, vectors):
+                embeddings[i] = vector
+
+        return embeddings
+
+    @classmethod
+    async def arelevant_categories(cls, query):
+        if len(cls.category_index) <= cls.paraphrase_category_count:
+            return list(cls.category_index.names)
+        if not cls.category_index.embedded:
+            names = cls.category_index.names
+            batches = await asyncio.gather(*(
+                cls.aembed_queries(names[i:i + cls.embedding_batch_size], task_type="RETRIEVAL_DOCUMENT")
+                for i in range(0, len(names), cls.embedding_batch_size)
+            ))
+            cls.category_index.set_embeddings([embedding for batch in batches for embedding in batch])
+
+        embedded_query = (await cls.aembed_queries([query]))[0]
+        return cls.category_index.nearest(embedded_query, cls.paraphrase_category_count)
+
+    @classmethod
+    async def aparaphrase_query(cls, query):
+        query = truncate_text(query, cls.input_tokens)
+        cache_key = cls.paraphrase_cache_key(query)
+        paraphrased_query = await cls.paraphrase_cache.aget(cache_key)
+        if paraphrased_query is not None:
+            return paraphrased_query
+
+        async def paraphrase():
+            response = await cls.agenerate(**cls.paraphrase_request(query, await cls.arelevant_categories(query)))
+            if response.text:
+                await cls.paraphrase_cache.aset(cache_key, response.text)
+            return response.text
+
+        try:
+            return await cls.inflight.ado(make_key("paraphrase", cache_key), paraphrase, lambda: cls.paraphrase_cache.peek(cache_key))
+        except LLMUnavailable as e:
+            logger.warning("paraphrase skipped: %s", e)
+            return query
+
+    @classmethod
+    async def arank_products(cls, query, limit):
+        embedded_query = (await cls.aembed_queries([query]))[0]
+        return (await asyncio.to_thread(cls.catalog.search, embedded_query, limit)).tolist()
+
+    @classmethod
+    async def arank_products_batch(cls, queries, limit, rrf_k=60):
+        embedded_queries = await cls.aembed_queries(queries)
+        return (await asyncio.to_thread(cls.catalog.search_batch, embedded_queries, limit, rrf_k)).tolist()
+
+    @classmethod
+    async def aget_products(cls, query, start=0, count=20):
+        sorted_indices = await cls.arank_products(query, start + count)
+        return await asyncio.to_thread(cls.products_from_indices, sorted_indices[start:start + count])
+
+    @classmethod
+    async def asearch_batch(cls, queries, count=20, rrf_k=60):
+        indices = await cls.arank_products_batch(queries, count, rrf_k=rrf_k)
+        return await asyncio.to_thread(cls.products_from_indices, indices)
+
+    @classmethod
+    async def aget_product_query_from_profile(cls, user_profile):
+        return await cls.aparaphrase_query(f"Create a query based on this profile: {user_profile}")
+
+    @classmethod
+    async def aAI_home_response(cls, user_profile):
+        request = cls.home_request(user_profile)
+
+        async def generate():
+            return (await cls.agenerate(**request)).text
+
+        return await cls.inflight.ado(cls.home_flight_key(request, user_profile), generate)
+
+    @classmethod
+    async def arun_function_call(cls, function_call):
+        """Async version of run_function_call."""
+        if function_call.name == "make_product_recommendations":
+            query = function_call.args.get("query")
+            additional_queries = function_call.args.get("additional_queries") or []
+
+            if additional_queries:
+                indices = await cls.arank_products_batch([query, *additional_queries], cls.tool_product_count)
+            else:
+                paraphrased_query = await cls.aparaphrase_query(query)
+                indices = await cls.arank_products(paraphrased_query, cls.tool_product_count)
+            result = await asyncio.to_thread(cls.compact_products, indices)
+
+            return cls.function_response_message(function_call, result), None
+
+        # The remaining functions don't call the API
+        return cls.run_function_call(function_call)
+
+    @classmethod
+    async def arun_function_calls(cls, function_calls):
+        """Async version of run_function_calls, the calls run concurrently on the event loop."""
+        results = await asyncio.gather(*(cls.arun_function_call(function_call) for function_call in function_calls))
+
+        return cls.merge_function_results(results)
+
+    @classmethod
+    async def asemantic_lookup(cls, chat_history, user_profile, use_cache):
+        """Async version of semantic_lookup."""
+        question = cls.semantic_cache_question(chat_history, use_cache)
+        if question is None:
+            return None, None
+        bucket = cls.semantic_cache_bucket(user_profile)
+        if cls.semantic_cache.empty_bucket(bucket):
+            return (question, bucket, None), None
+        try:
+            embedding = (await cls.aembed_queries([question], task_type="SEMANTIC_SIMILARITY"))[0]
+        except LLMUnavailable as e:
+            logger.warning("Skipping the semantic cache: %s", e)
+            cls.semantic_cache.count_miss()
+            return None, None
+        return (question, bucket, embedding), cls.semantic_cache.lookup(embedding, bucket)
+
+    @classmethod
+    async def aget_response(cls, chat_history, user_profile, max_tool_rounds=5, use_cache=True):
+        """Async version of get_response. Returns {"response": ...} plus "new_profile" if the model updated it."""
+        cache_entry, cached = await cls.asemantic_lookup(chat_history, user_profile, use_cache)
+        if cached is not None:
+            return {"response": cached}
+
+        turns = ChatTurns(cls, chat_history, user_profile, cache_entry, max_tool_rounds, " (async)")
+        for request in turns:
+            response = await cls.agenerate(**request)
+            text = cls.response_text(response)
+            turns.answered(cls.function_calls(response), text)
+            if turns.done:
+                return turns.finish(text)
+            turns.add_results(*await cls.arun_function_calls(turns.function_calls))
+
+    @classmethod
+    async def astream_response(cls, chat_history, user_profile, max_tool_rounds=5, use_cache=True):
+        """Async version of stream_response, yields the same events."""
+        cache_entry, cached = await cls.asemantic_lookup(chat_history, user_profile, use_cache)
+        if cached is not None:
+            yield {"type": "text", "text": cached}
+            return
+
+        turns = ChatTurns(cls, list(chat_history), user_profile, cache_entry, max_tool_rounds, " (async stream)")
+        for request in turns:
+            async for chunk in cls.agenerate_stream(**request):
+                for event in turns.stream_chunk(chunk):
+                    yield event
+            for event in turns.end_stream():
+                yield event
+            if turns.done:
+                turns.finish()
+                return
+            for event in turns.add_results(*await cls.arun_function_calls(turns.function_calls)):
+                yield event
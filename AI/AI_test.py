@@ -1,6 +1,25 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
 import unittest
-from AI import AI
+from unittest import mock
+import numpy as np
+import pandas as pd
+from google.genai import types
+from AI.AI import AI
+from AI.ann import IVFIndex
+from AI.cache import SemanticCache, SingleFlight, SQLiteCache, TieredCache
+from AI import quantize
+from AI.catalog import ProductCatalog, build_quantized, build_store
+from AI.categories import CategoryIndex, parse_names
+from AI.context import estimate_tokens, fit_history, truncate_text
+from AI.providers import FakeProvider
+from AI.quantize import QuantizedEmbeddings
+from AI.scheduler import LLMUnavailable, Scheduler
 
+@unittest.skipUnless(AI.provider.name == "gemini", "judges the live model's profile updates")
 class TestAIProfileUpdates(unittest.TestCase):
 
     def test_profile_update(self):
@@ -63,9 +82,708 @@ class TestAIProfileUpdates(unittest.TestCase):
                 # Get the response from the AI
                 response = AI.get_response(chat, profile)
 
-                # Check if the response starts with "{new_profile", indicating a profile update
-                profile_update_detected = response[:12] == "{new_profile"
+                # A profile update comes back as "new_profile" next to the response
+                profile_update_detected = "new_profile" in response
                 self.assertEqual(profile_update_detected, expected, f"Test case {idx + 1} failed: Expected {expected} but got {profile_update_detected}")
 
+
+class TestProductCatalog(unittest.TestCase):
+
+    def test_top_k_returns_best_first(self):
+        scores = np.array([0.1, 0.9, 0.5, 0.7, 0.3], dtype=np.float32)
+        self.assertEqual(ProductCatalog.top_k(scores, 3).tolist(), [1, 3, 2])
+        self.assertEqual(ProductCatalog.top_k(scores, 10).tolist(), [1, 3, 2, 4, 0])
+        self.assertEqual(len(ProductCatalog.top_k(scores, 0)), 0)
+
+    def test_search_matches_a_full_sort(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((500, 16)).astype(np.float32)
+        query = rng.standard_normal(16).astype(np.float32)
+        catalog = ProductCatalog(list(range(len(embeddings))), embeddings)
+        self.assertEqual(catalog.search(query, 20).tolist(), np.argsort(-(embeddings @ query))[:20].tolist())
+
+    def test_search_batch_fuses_rankings(self):
+        # Product 0 is second for both queries, 1 and 2 are first for one query and missing from the other's top 2
+        embeddings = np.array([[0.9, 0.9], [1.0, 0.0], [0.0, 1.0]], dtype=np.float32)
+        catalog = ProductCatalog(list(range(len(embeddings))), embeddings)
+        queries = np.array([[1.0, 0.05], [0.05, 1.0]], dtype=np.float32)
+        self.assertEqual(catalog.search_batch(queries, 2, rrf_k=60).tolist()[0], 0)
+        self.assertEqual(catalog.search_batch(queries[:1], 2).tolist(), catalog.search(queries[0], 2).tolist())
+
+    def make_store(self, rows, normalize=False):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        csv_path = os.path.join(directory.name, "products.csv")
+        embeddings = np.random.default_rng(rows).standard_normal((rows, 8)).astype(np.float32)
+        write_products_csv(csv_path, embeddings)
+        self.assertEqual(build_store(csv_path, directory.name, normalize=normalize), rows)
+        return directory.name, csv_path, embeddings
+
+    def test_store_is_loaded_memory_mapped(self):
+        directory, csv_path, embeddings = self.make_store(5)
+        catalog = ProductCatalog.load(directory, csv_path)
+        np.testing.assert_allclose(catalog.embeddings, embeddings, rtol=1e-6)
+        # Read-only pages of the .npy file, not a parsed copy
+        self.assertFalse(catalog.embeddings.flags.writeable)
+        self.assertEqual(catalog.products["title"].tolist(), [f"Product {i}" for i in range(5)])
+        self.assertFalse(catalog.normalized)
+
+    def test_missing_or_older_store_is_rebuilt(self):
+        directory, csv_path, _ = self.make_store(5, normalize=True)
+
+        # A newer CSV (re-scraped catalog) replaces the store and keeps its normalization
+        write_products_csv(csv_path, np.full((7, 8), 2.0, dtype=np.float32))
+        newer = os.path.getmtime(os.path.join(directory, "products_embeddings.npy")) + 10
+        os.utime(csv_path, (newer, newer))
+        catalog = ProductCatalog.load(directory, csv_path)
+        self.assertEqual(len(catalog), 7)
+        self.assertTrue(catalog.normalized)
+        np.testing.assert_allclose(np.linalg.norm(catalog.embeddings, axis=1), 1.0, rtol=1e-6)
+
+        os.remove(os.path.join(directory, "products_metadata.json"))
+        self.assertEqual(len(ProductCatalog.load(directory, csv_path)), 7)
+
+def write_products_csv(path, embeddings):
+    # The scraper's CSV layout: metadata columns plus the embedding as a "[x, y, ...]" string
+    pd.DataFrame({
+        "title": [f"Product {i}" for i in range(len(embeddings))],
+        "brand": ["Brand"] * len(embeddings),
+        "embedding": ["[" + ", ".join(str(value) for value in row) + "]" for row in embeddings.tolist()],
+    }).to_csv(path, index=False)
+
+class TestQuantizedEmbeddings(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.standard_normal((2000, 32)).astype(np.float32)
+        self.embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.queries = rng.standard_normal((20, 32)).astype(np.float32)
+
+    def test_int8_round_trip(self):
+        compact = QuantizedEmbeddings.quantize(self.embeddings, "int8")
+        self.assertEqual(compact.dtype, "int8")
+        restored = compact.codes.astype(np.float32) * compact.scales[:, None]
+        # Rounding moves each value by at most half a step of its row's scale
+        self.assertTrue(np.all(np.abs(restored - self.embeddings) <= compact.scales[:, None] / 2 + 1e-7))
+
+    def test_float16_round_trip(self):
+        compact = QuantizedEmbeddings.quantize(self.embeddings, "float16")
+        self.assertIsNone(compact.scales)
+        np.testing.assert_allclose(compact.codes.astype(np.float32), self.embeddings, atol=1e-3)
+
+    def test_scores_are_the_same_across_scan_chunks(self):
+        compact = QuantizedEmbeddings.quantize(self.embeddings, "int8")
+        expected = (compact.codes.astype(np.float32) * compact.scales[:, None]) @ self.queries.T
+        with mock.patch.object(quantize, "SCAN_CHUNK", 7):
+            np.testing.assert_allclose(compact.score(self.queries), expected.T, rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(compact.score(self.queries[0]), expected[:, 0], rtol=1e-4, atol=1e-5)
+
+    def test_compact_search_recall(self):
+        exact = ProductCatalog(list(range(len(self.embeddings))), self.embeddings)
+        for dtype in ("int8", "float16"):
+            compact = ProductCatalog(list(range(len(self.embeddings))), self.embeddings,
+                                     compact=QuantizedEmbeddings.quantize(self.embeddings, dtype), rerank=50)
+            found = sum(len(set(compact.search(query, 10)) & set(exact.search(query, 10))) for query in self.queries)
+            self.assertGreaterEqual(found / (10 * len(self.queries)), 0.99, dtype)
+
+    def test_compact_search_batch_reranks_each_query(self):
+        exact = ProductCatalog(list(range(len(self.embeddings))), self.embeddings)
+        compact = ProductCatalog(list(range(len(self.embeddings))), self.embeddings,
+                                 compact=QuantizedEmbeddings.quantize(self.embeddings, "int8"), rerank=100)
+        self.assertEqual(compact.search_batch(self.queries[:3], 10).tolist(), exact.search_batch(self.queries[:3], 10).tolist())
+
+    def test_load_only_uses_fresh_codes(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        csv_path = os.path.join(directory.name, "products.csv")
+        write_products_csv(csv_path, self.embeddings[:100])
+        build_store(csv_path, directory.name)
+
+        # Missing codes file: full precision, with a warning
+        with self.assertLogs("AI.catalog", "WARNING"):
+            catalog = ProductCatalog.load(directory.name, csv_path, quantization="int8")
+        self.assertIsNone(catalog.compact)
+
+        build_quantized(directory.name, "int8")
+        catalog = ProductCatalog.load(directory.name, csv_path, quantization="int8")
+        self.assertEqual(catalog.compact.dtype, "int8")
+        self.assertEqual(catalog.search(self.embeddings[5], 1).tolist(), [5])
+
+        # Codes older than the store (the store was rebuilt since): ignored
+        codes_path = os.path.join(directory.name, quantize.codes_file("int8"))
+        stale = os.path.getmtime(os.path.join(directory.name, "products_embeddings.npy")) - 10
+        os.utime(codes_path, (stale, stale))
+        with self.assertLogs("AI.catalog", "WARNING"):
+            catalog = ProductCatalog.load(directory.name, csv_path, quantization="int8")
+        self.assertIsNone(catalog.compact)
+
+class TestCategoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        products = pd.DataFrame({
+            "categories": ["['Kitchen', 'Bags']", "['Kitchen']", None],
+            "tags": ["['Reusable']", "Kitchen, Glass", "[]"],
+        })
+        self.index = CategoryIndex.from_products(products)
+        self.index.set_embeddings(np.eye(len(self.index), dtype=np.float32))
+
+    def test_names_are_parsed_and_ranked_by_frequency(self):
+        self.assertEqual(parse_names("['Haircare', 'Brushes & Combs']"), ["Haircare", "Brushes & Combs"])
+        self.assertEqual(parse_names(None), [])
+        self.assertEqual(self.index.names[0], "Kitchen")
+        self.assertEqual(sorted(self.index.names), ["Bags", "Glass", "Kitchen", "Reusable"])
+
+    def test_exact_match_comes_first(self):
+        query = np.eye(len(self.index), dtype=np.float32)[self.index.names.index("Glass")]
+        self.assertEqual(self.index.nearest(query, 1), ["Glass"])
+
+    def test_nearest_match(self):
+        vectors = np.eye(len(self.index), dtype=np.float32)
+        query = 0.9 * vectors[self.index.names.index("Bags")] + 0.4 * vectors[self.index.names.index("Reusable")]
+        self.assertEqual(self.index.nearest(query, 2), ["Bags", "Reusable"])
+        self.assertEqual(len(self.index.nearest(query, 10)), 4)
+
+    def test_empty_vocabulary_matches_nothing(self):
+        index = CategoryIndex.from_products(pd.DataFrame({"title": ["Bottle"]}))
+        self.assertEqual(index.nearest(np.ones(4, dtype=np.float32), 3), [])
+        index.set_embeddings([])
+        self.assertTrue(index.embedded)
+        self.assertEqual(index.nearest(np.ones(4, dtype=np.float32), 3), [])
+
+class TestIVFIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.embeddings = rng.standard_normal((2000, 16)).astype(np.float32)
+        self.index = IVFIndex.build(self.embeddings, n_lists=20, n_iter=5)
+
+    def test_every_product_is_in_one_list(self):
+        self.assertEqual(sorted(self.index.list_ids.tolist()), list(range(len(self.embeddings))))
+        self.assertEqual(self.index.list_offsets[-1], len(self.embeddings))
+
+    def test_probing_every_list_is_exact(self):
+        query = self.embeddings[7]
+        catalog = ProductCatalog(list(range(len(self.embeddings))), self.embeddings, index=self.index)
+        self.index.n_probe = 20
+        self.assertEqual(catalog.search(query, 10).tolist(), np.argsort(-(self.embeddings @ query))[:10].tolist())
+
+    def test_min_candidates_probes_more_lists(self):
+        self.index.n_probe = 1
+        query = self.embeddings[0]
+        few = len(self.index.candidates(query))
+        self.index.min_candidates = 500
+        self.assertGreaterEqual(len(self.index.candidates(query)), 500)
+        self.assertGreater(len(self.index.candidates(query)), few)
+
+class TestTieredCache(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cache.sqlite3")
+
+    def test_disk_tier_is_shared(self):
+        first = TieredCache("test", path=self.path)
+        second = TieredCache("test", path=self.path)
+        first.set("query", "paraphrase")
+        self.assertEqual(second.get("query"), "paraphrase")
+        self.assertEqual(second.get("query"), "paraphrase")
+        self.assertEqual((second.disk_hits, second.hits, second.misses), (1, 1, 0))
+
+    def test_entries_expire_in_both_tiers(self):
+        cache = TieredCache("test", ttl=0.05, path=self.path)
+        cache.set("query", "paraphrase")
+        self.assertEqual(cache.get("query"), "paraphrase")
+        time.sleep(0.1)
+        self.assertIsNone(cache.get("query"))
+        self.assertIsNone(TieredCache("test", path=self.path).get("query"))
+
+    def test_async_lookups_read_both_tiers(self):
+        first = TieredCache("test", path=self.path)
+        second = TieredCache("test", path=self.path)
+
+        async def run():
+            await first.aset_many([("a", "1"), ("b", "2")])
+            second.set("c", "3")
+            return await second.aget_many(["a", "b", "c", "d"])
+
+        self.assertEqual(asyncio.run(run()), ["1", "2", "3", None])
+        self.assertEqual((second.hits, second.disk_hits, second.misses), (1, 2, 1))
+
+class TestContext(unittest.TestCase):
+
+    def message(self, role, words):
+        return {"role": role, "parts": " ".join(["word"] * words)}
+
+    def test_history_within_budget_is_unchanged(self):
+        history = [self.message("user", 10), self.message("model", 10)]
+        self.assertEqual(fit_history(history, 100), (history, 0))
+
+    def test_keeps_summary_and_latest_turn(self):
+        summary = {"role": "model", "parts": "Conversation summary: the user composts."}
+        latest = [self.message("user", 20), {"role": "user", "parts": "Function response (name:x, args: {}, response: ok)"}]
+        history = [summary] + [self.message("model", 100) for _ in range(5)] + latest
+        fitted, saved = fit_history(history, 200)
+        self.assertEqual(fitted[0], summary)
+        self.assertEqual(fitted[-2:], latest)
+        self.assertGreater(saved, 0)
+        self.assertLessEqual(sum(estimate_tokens(message["parts"]) for message in fitted), 200)
+
+    def test_latest_turn_is_kept_over_budget(self):
+        history = [self.message("model", 50), self.message("user", 500)]
+        self.assertEqual(fit_history(history, 100)[0], history[-1:])
+
+    def test_truncate_text(self):
+        text = " ".join(str(i) for i in range(1000))
+        self.assertLessEqual(estimate_tokens(truncate_text(text, 100)), 100)
+        self.assertLessEqual(estimate_tokens(truncate_text(text, 100, keep_end=True)), 100)
+        self.assertTrue(truncate_text(text, 100, keep_end=True).endswith("999"))
+        self.assertEqual(truncate_text("short", 100), "short")
+
+class FakeAITestCase(unittest.TestCase):
+    """Runs AI on FakeProvider, with in-memory caches."""
+
+    profile = "Alex, 34, lives in Oslo and cycles to work."
+    semantic_cache = None
+
+    def setUp(self):
+        ai = AI
+        patcher = mock.patch.multiple(
+            ai,
+            provider=FakeProvider(embedding_dim=ai.catalog.embeddings.shape[1]),
+            embedding_cache=TieredCache("embeddings", disk=False),
+            paraphrase_cache=TieredCache("paraphrases", disk=False),
+            semantic_cache=self.semantic_cache,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        generate = mock.patch.object(ai, "generate", wraps=ai.generate)
+        self.generate = generate.start()
+        self.addCleanup(generate.stop)
+
+    def chat(self, message):
+        return [{"role": "user", "parts": message}]
+
+class TestSemanticCache(FakeAITestCase):
+
+    def setUp(self):
+        self.semantic_cache = SemanticCache(threshold=0.99)
+        super().setUp()
+        embed = mock.patch.object(AI, "embed", wraps=AI.embed)
+        self.embed = embed.start()
+        self.addCleanup(embed.stop)
+
+    def wait_for_store(self, size):
+        # Replies of an empty bucket are embedded and stored in the background
+        deadline = time.monotonic() + 5
+        while len(self.semantic_cache) < size and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.semantic_cache), size)
+
+    def test_replies_are_only_shared_by_identical_profiles(self):
+        ai = AI
+        question = "How can I save water at home?"
+        first = ai.get_response(self.chat(question), self.profile)
+        self.wait_for_store(1)
+        self.assertEqual(ai.get_response(self.chat(question), self.profile), first)
+        self.assertEqual(self.generate.call_count, 1)
+
+        ai.get_response(self.chat(question), "Sam, 61, lives in Lima and drives to work.")
+        self.assertEqual(self.generate.call_count, 2)
+        self.assertEqual(self.semantic_cache.stats()["hit_rate"], 1 / 3)
+
+    def test_empty_bucket_skips_the_embedding(self):
+        AI.get_response(self.chat("How can I save water at home?"), self.profile)
+        self.wait_for_store(1)
+        # Embedded once, in the background, to store the reply
+        self.assertEqual(self.embed.call_count, 1)
+        self.assertEqual(self.semantic_cache.stats()["misses"], 1)
+
+    def test_unavailable_embedding_model_skips_the_cache(self):
+        ai = AI
+        ai.get_response(self.chat("How can I save water at home?"), self.profile)
+        self.wait_for_store(1)
+        with self.assertLogs("AI.AI", "WARNING"), \
+                mock.patch.object(ai, "embed_queries", side_effect=LLMUnavailable("text-embedding-004", "circuit open")):
+            result = ai.get_response(self.chat("How do I save water at home?"), self.profile)
+        self.assertTrue(result["response"])
+        self.assertEqual(self.generate.call_count, 2)
+        self.assertEqual(self.semantic_cache.stats()["misses"], 2)
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_calls_are_coalesced(self):
+        flight = SingleFlight()
+        calls, release = [], threading.Event()
+
+        def func():
+            calls.append(1)
+            release.wait(5)
+            return "result"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", func))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while flight.calls + flight.coalesced < 5:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((results, len(calls)), (["result"] * 5, 1))
+
+    def test_workers_share_a_call_through_leases(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "cache.sqlite3")
+        results = SQLiteCache(path=path, namespace="results")
+        # One SingleFlight per worker, sharing the lease file
+        workers = [SingleFlight(leases=SQLiteCache(path=path, namespace="leases"), poll_interval=0.01) for _ in range(2)]
+        calls, started = [], threading.Event()
+
+        def func():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            results.set("key", b"result")
+            return b"result"
+
+        lookup = lambda: results.get("key")
+        leader = threading.Thread(target=lambda: workers[0].do("key", func, lookup))
+        leader.start()
+        started.wait(5)
+        self.assertEqual(workers[1].do("key", func, lookup), b"result")
+        leader.join()
+        self.assertEqual(len(calls), 1)
+
+    def test_cancelled_leader_does_not_cancel_waiters(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "result"
+
+        async def run():
+            leader = asyncio.ensure_future(flight.ado("key", func))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(flight.ado("key", func))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await waiter, leader.cancelled()
+
+        self.assertEqual(asyncio.run(run()), ("result", True))
+        self.assertEqual(len(calls), 1)
+
+    def test_call_is_cancelled_when_nobody_waits(self):
+        flight = SingleFlight()
+        finished = []
+
+        async def func():
+            await asyncio.sleep(0.05)
+            finished.append(1)
+
+        async def run():
+            callers = [asyncio.ensure_future(flight.ado("key", func)) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            for caller in callers:
+                caller.cancel()
+            await asyncio.sleep(0.1)
+
+        asyncio.run(run())
+        self.assertEqual(finished, [])
+
+    def test_caller_after_an_abandoned_call_starts_a_new_one(self):
+        flight = SingleFlight()
+        calls = []
+
+        async def func():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        async def run():
+            leader = asyncio.ensure_future(flight.ado("key", func))
+            await asyncio.sleep(0)
+            leader.cancel()
+            # Let the leader handle its cancellation, but not the abandoned task finish
+            await asyncio.sleep(0)
+            return await flight.ado("key", func)
+
+        self.assertEqual(asyncio.run(run()), "result")
+        self.assertEqual(len(calls), 2)
+
+class ServerError(Exception):
+    code = 503
+
+
+class TestScheduler(unittest.TestCase):
+
+    def scheduler(self, **options):
+        options = {"base_delay": 0.001, "max_delay": 0.01, "rate_limits": {"test": 60_000}, **options}
+        return Scheduler(**options)
+
+    def failing(self, failures, error=ServerError):
+        # A function that fails `failures` times, then returns "ok"
+        calls = []
+
+        def func(timeout=None):
+            calls.append(timeout)
+            if len(calls) <= failures:
+                raise error()
+            return "ok"
+        return func, calls
+
+    def test_retries_retryable_errors(self):
+        scheduler = self.scheduler(max_retries=3)
+        func, calls = self.failing(2)
+        self.assertEqual(scheduler.call("test", func), "ok")
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(scheduler.stats()["test"]["retries"], 2)
+
+    def test_other_errors_are_not_retried(self):
+        scheduler = self.scheduler(max_retries=3)
+        func, calls = self.failing(1, error=ValueError)
+        with self.assertRaises(ValueError):
+            scheduler.call("test", func)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(scheduler.stats()["test"]["state"], "closed")
+
+    def test_attempts_get_the_time_left(self):
+        scheduler = self.scheduler(deadline=2.0)
+        func, calls = self.failing(0)
+        scheduler.call("test", func)
+        self.assertTrue(0 < calls[0] <= 2.0)
+
+    def test_attempt_past_the_deadline_times_out(self):
+        scheduler = self.scheduler(deadline=0.1, max_retries=0)
+        provider = FakeProvider(latency=1.0)
+        started = time.monotonic()
+        with self.assertRaises(LLMUnavailable) as raised:
+            scheduler.call("test", provider.embed, model="test", contents=["text"])
+        self.assertIsInstance(raised.exception.__cause__, TimeoutError)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_exhausted_retries_raise_llm_unavailable(self):
+        scheduler = self.scheduler(max_retries=2)
+        func, calls = self.failing(5)
+        with self.assertRaises(LLMUnavailable) as raised:
+            scheduler.call("test", func)
+        self.assertIsInstance(raised.exception.__cause__, ServerError)
+        self.assertIsNotNone(raised.exception.retry_after)
+        self.assertEqual(len(calls), 3)
+
+    def test_failed_stream_after_the_first_chunk_raises_llm_unavailable(self):
+        scheduler = self.scheduler(max_retries=3)
+
+        def func(timeout=None):
+            yield "first"
+            raise ServerError()
+
+        chunks = []
+        with self.assertRaises(LLMUnavailable):
+            for chunk in scheduler.stream("test", func):
+                chunks.append(chunk)
+        self.assertEqual(chunks, ["first"])
+
+    def test_breaker_opens_and_closes(self):
+        scheduler = self.scheduler(max_retries=0, breaker_failures=2, breaker_reset=0.05)
+        func, calls = self.failing(3)
+        for _ in range(2):
+            with self.assertRaises(LLMUnavailable):
+                scheduler.call("test", func)
+        self.assertEqual(scheduler.stats()["test"]["state"], "open")
+
+        # Open: fails fast without calling the model
+        with self.assertRaises(LLMUnavailable):
+            scheduler.call("test", func)
+        self.assertEqual(len(calls), 2)
+
+        # Half-open: a failed trial opens it again, a successful one closes it
+        time.sleep(0.06)
+        self.assertEqual(scheduler.stats()["test"]["state"], "half-open")
+        with self.assertRaises(LLMUnavailable):
+            scheduler.call("test", func)
+        self.assertEqual(scheduler.stats()["test"]["state"], "open")
+        time.sleep(0.06)
+        self.assertEqual(scheduler.call("test", func), "ok")
+        self.assertEqual(scheduler.stats()["test"]["state"], "closed")
+
+    def test_rate_limit_fails_fast_before_the_deadline(self):
+        # 60 requests per minute: one now, the next only in a second
+        scheduler = self.scheduler(rate_limits={"test": 60}, deadline=0.5)
+        func, calls = self.failing(0)
+        scheduler.call("test", func)
+        started = time.monotonic()
+        with self.assertRaises(LLMUnavailable):
+            scheduler.call("test", func)
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertEqual(len(calls), 1)
+
+    def test_async_calls_retry(self):
+        scheduler = self.scheduler(max_retries=3)
+        failures = []
+
+        async def func():
+            failures.append(1)
+            if len(failures) <= 2:
+                raise ServerError()
+            return "ok"
+
+        self.assertEqual(asyncio.run(scheduler.acall("test", func)), "ok")
+        self.assertEqual(len(failures), 3)
+
+    def test_async_exhausted_retries_raise_llm_unavailable(self):
+        scheduler = self.scheduler(max_retries=1)
+        failures = []
+
+        async def func():
+            failures.append(1)
+            raise ServerError()
+
+        with self.assertRaises(LLMUnavailable) as raised:
+            asyncio.run(scheduler.acall("test", func))
+        self.assertIsInstance(raised.exception.__cause__, ServerError)
+        self.assertEqual(len(failures), 2)
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        with self.assertRaises(LLMUnavailable):
+            asyncio.run(self.scheduler(deadline=0.05, max_retries=0).acall("test", slow))
+
+    def test_async_stream_is_bounded_by_the_deadline(self):
+        scheduler = self.scheduler(deadline=0.1, max_retries=0)
+
+        async def func():
+            async def chunks():
+                yield "first"
+                await asyncio.sleep(1)
+                yield "late"
+            return chunks()
+
+        async def consume():
+            chunks = []
+            with self.assertRaises(LLMUnavailable):
+                async for chunk in scheduler.astream("test", func):
+                    chunks.append(chunk)
+            return chunks
+
+        started = time.monotonic()
+        self.assertEqual(asyncio.run(consume()), ["first"])
+        self.assertLess(time.monotonic() - started, 0.5)
+
+class TestFakeProvider(unittest.TestCase):
+
+    def request(self, message, tools=None):
+        return {
+            "model": "gemini-2.0-flash",
+            "contents": [types.Content(role="user", parts=[types.Part.from_text(text=message)])],
+            "config": types.GenerateContentConfig(system_instruction="test", tools=tools),
+        }
+
+    def test_replies_are_deterministic(self):
+        provider = FakeProvider()
+        first = provider.generate(**self.request("How can I save water?")).text
+        self.assertEqual(first, provider.generate(**self.request("How can I save water?")).text)
+        self.assertNotEqual(first, provider.generate(**self.request("How can I save energy?")).text)
+
+    def test_product_question_calls_the_tool(self):
+        tool = types.Tool(function_declarations=[{"name": "make_product_recommendations", "description": "Searches products."}])
+        response = FakeProvider().generate(**self.request("Can you recommend a reusable bottle?", tools=[tool]))
+        function_call = response.candidates[0].content.parts[0].function_call
+        self.assertEqual(function_call.name, "make_product_recommendations")
+
+    def test_stream_has_the_text_of_the_reply(self):
+        streamed = "".join(chunk.text for chunk in FakeProvider().generate_stream(**self.request("How can I save water?")))
+        self.assertEqual(streamed.strip(), FakeProvider().generate(**self.request("How can I save water?")).text)
+
+    def test_message_about_the_user_updates_the_profile(self):
+        parts = FakeProvider().generate(**self.request("I'm vegan, how do I cut waste?", tools=[AI.tools])).candidates[0].content.parts
+        self.assertTrue(parts[0].text)
+        self.assertEqual(parts[1].function_call.name, "update_profile")
+        self.assertIn("I'm vegan", parts[1].function_call.args["new_profile"])
+
+        # Without the tool there's nothing to call
+        parts = FakeProvider().generate(**self.request("I'm vegan, how do I cut waste?")).candidates[0].content.parts
+        self.assertEqual(len(parts), 1)
+
+    def test_stream_sends_function_calls_after_the_text(self):
+        chunks = list(FakeProvider().generate_stream(**self.request("My garden is small, any tips?", tools=[AI.tools])))
+        self.assertEqual(chunks[-1].candidates[0].content.parts[0].function_call.name, "update_profile")
+        self.assertTrue(all(chunk.text for chunk in chunks[:-1]))
+
+    def test_embeddings_are_unit_vectors(self):
+        provider = FakeProvider(embedding_dim=16)
+        first, second = provider.embed(model="text-embedding-004", contents=["bamboo toothbrush", "bamboo toothbrush"]).embeddings
+        self.assertEqual(len(first.values), 16)
+        self.assertEqual(first.values, second.values)
+        self.assertAlmostEqual(sum(value * value for value in first.values), 1.0, places=5)
+
+class TestChatOnFakeProvider(FakeAITestCase):
+    """get_response / stream_response end to end, with every model call answered by FakeProvider."""
+
+    def chat_calls(self):
+        # generate calls of the chat itself, not the paraphrases of the product search
+        return sum(1 for call in self.generate.call_args_list if call.kwargs["config"].tools)
+
+    def test_product_question_gets_product_links(self):
+        result = AI.get_response(self.chat("Can you recommend a reusable bottle?"), self.profile)
+        self.assertNotIn("new_profile", result)
+        self.assertRegex(result["response"], r"\[[^\]]+\]\([^)]+\)")
+        self.assertNotRegex(result["response"], AI.product_ref_pattern)
+        self.assertEqual(self.chat_calls(), 2)
+
+    def test_profile_update_next_to_the_reply_takes_one_call(self):
+        result = AI.get_response(self.chat("I'm vegan, how do I cut food waste?"), self.profile)
+        self.assertEqual(result["new_profile"], "The user said: I'm vegan, how do I cut food waste?")
+        self.assertTrue(result["response"])
+        self.assertEqual(self.chat_calls(), 1)
+
+    def test_profile_update_and_products_in_one_turn(self):
+        result = AI.get_response(self.chat("My kids need lunch boxes, what should I buy?"), self.profile)
+        self.assertIn("My kids", result["new_profile"])
+        self.assertRegex(result["response"], r"\[[^\]]+\]\([^)]+\)")
+        self.assertEqual(self.chat_calls(), 2)
+
+    def test_stream_matches_the_blocking_reply(self):
+        message = "I'm vegan, how do I cut food waste?"
+        events = list(AI.stream_response(self.chat(message), self.profile))
+        text = "".join(event["text"] for event in events if event["type"] == "text")
+        self.assertEqual(events[-1], {"type": "profile", "new_profile": f"The user said: {message}"})
+        # The fake streams a few words per chunk, each followed by a space
+        self.assertEqual(text.strip(), AI.get_response(self.chat(message), self.profile)["response"])
+
+    def test_stream_of_a_product_question(self):
+        events = list(AI.stream_response(self.chat("Can you recommend a reusable bottle?"), self.profile))
+        self.assertEqual({event["type"] for event in events}, {"text"})
+        self.assertRegex("".join(event["text"] for event in events), r"\[[^\]]+\]\([^)]+\)")
+
+    def test_async_versions_match(self):
+        async def astream(message):
+            return [event async for event in AI.astream_response(self.chat(message), self.profile)]
+
+        for message in ["Can you recommend a reusable bottle?", "I'm vegan, how do I cut food waste?",
+                        "My kids need lunch boxes, what should I buy?"]:
+            with self.subTest(message=message):
+                self.assertEqual(asyncio.run(AI.aget_response(self.chat(message), self.profile)),
+                                 AI.get_response(self.chat(message), self.profile))
+                self.assertEqual(asyncio.run(astream(message)), list(AI.stream_response(self.chat(message), self.profile)))
+
+    def test_tool_rounds_are_limited(self):
+        async def astream():
+            return [event async for event in AI.astream_response(chat, self.profile, max_tool_rounds=0)]
+
+        chat = self.chat("Can you recommend a reusable bottle?")
+        with self.assertRaisesRegex(RuntimeError, "Too many function calls"):
+            AI.get_response(list(chat), self.profile, max_tool_rounds=0)
+        with self.assertRaisesRegex(RuntimeError, "Too many function calls"):
+            list(AI.stream_response(chat, self.profile, max_tool_rounds=0))
+        with self.assertRaisesRegex(RuntimeError, "Too many function calls"):
+            asyncio.run(AI.aget_response(list(chat), self.profile, max_tool_rounds=0))
+        with self.assertRaisesRegex(RuntimeError, "Too many function calls"):
+            asyncio.run(astream())
+
 if __name__ == "__main__":
     unittest.main()
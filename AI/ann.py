@@ -0,0 +1,106 @@
+"""
+Approximate nearest-neighbour index for the product catalog.
+
+IVFIndex is an inverted-file index: the embeddings are clustered with spherical k-means,
+and every product is stored in the list of its closest centroid. A search only scores the
+products in the `n_probe` lists whose centroids are closest to the query, so its cost grows
+with the size of those lists instead of the whole catalog. Scoring the candidates is left to
+ProductCatalog, which owns the embedding matrix.
+
+The index is built offline from the catalog store and saved next to it:
+    python -m AI.catalog --build-index [--lists N]
+"""
+import numpy as np
+
+# Rows scored at once while clustering, keeps the temporary score matrix small
+ASSIGN_CHUNK = 8192
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def _assign(embeddings, centroids):
+    # Index of the closest centroid (by dot product) for every row
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), ASSIGN_CHUNK):
+        chunk = np.asarray(embeddings[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        assignments[start:start + ASSIGN_CHUNK] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """
+    Inverted-file index over the rows of an embedding matrix.
+
+    n_probe: number of closest lists scanned per query (higher = better recall, slower).
+    min_candidates: keep probing further lists until at least this many products are scored.
+    """
+
+    def __init__(self, centroids, list_offsets, list_ids, n_probe=8, min_candidates=0):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.n_probe = n_probe
+        self.min_candidates = min_candidates
+
+    @property
+    def size(self):
+        return len(self.list_ids)
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=20, sample_size=100_000, seed=0):
+        """
+        Clusters the embeddings with spherical k-means and builds the inverted lists.
+        Centroids are trained on at most `sample_size` rows, then every row is assigned.
+        """
+        rng = np.random.default_rng(seed)
+        n = len(embeddings)
+        n_lists = min(n_lists or max(1, int(np.sqrt(n))), n)
+
+        sample_ids = rng.choice(n, size=min(sample_size, n), replace=False)
+        sample = _normalize(np.asarray(embeddings[np.sort(sample_ids)], dtype=np.float32))
+
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+        for _ in range(n_iter):
+            assignments = _assign(sample, centroids)
+            counts = np.bincount(assignments, minlength=n_lists)
+
+            # Sum the rows of every list in one pass over the rows sorted by list
+            order = np.argsort(assignments, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            empty = counts == 0
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(sample[order], starts[~empty])
+
+            # Empty lists are restarted from random sample rows
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = _normalize(sums)
+
+        # Group the product ids by list so every list is one contiguous slice
+        assignments = _assign(embeddings, centroids)
+        list_ids = np.argsort(assignments, kind="stable").astype(np.int32)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))]).astype(np.int64)
+
+        return cls(centroids.astype(np.float32), list_offsets, list_ids)
+
+    def save(self, file):
+        # file can be a path or an open binary file
+        np.savez(file, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, path, n_probe=8, min_candidates=0):
+        with np.load(path) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_ids"], n_probe=n_probe, min_candidates=min_candidates)
+
+    def candidates(self, query):
+        """Returns the product ids stored in the lists probed for this query."""
+        # Lists ordered by how close their centroid is to the query
+        lists = np.argsort(self.centroids @ query)[::-1]
+        sizes = self.list_offsets[lists + 1] - self.list_offsets[lists]
+
+        # Probe n_probe lists, or more until min_candidates products are covered
+        n_lists = max(self.n_probe, int(np.searchsorted(np.cumsum(sizes), self.min_candidates)) + 1)
+        lists = lists[:n_lists]
+        return np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in lists])
@@ -0,0 +1,572 @@
+"""
+Caches for results of AI calls.
+
+TieredCache keeps a bounded in-process LRU in front of a persistent SQLite file.
+The SQLite tier survives restarts and is shared by every worker on the machine,
+so a query embedded by one worker is a cache hit for all the others.
+
+SemanticCache matches by meaning instead of by key: a stored response is reused when a new
+text's embedding is close enough (cosine similarity) to the one it was stored for.
+
+SingleFlight coalesces identical calls that are in flight at the same time, so duplicates wait
+for one call and share its result (optionally across workers, through a lease in the SQLite file).
+
+Configuration (environment):
+- AI_CACHE_PATH: SQLite file for the persistent tier (default: AI/cache/ai_cache.sqlite3)
+- AI_CACHE_DISK=0: disable the persistent tier, only the in-process LRU is used
+- AI_SINGLEFLIGHT_SHARED=1: coalesce identical calls across workers too
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CACHE_PATH = os.getenv(
+    "AI_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "ai_cache.sqlite3"),
+)
+DISK_ENABLED = os.getenv("AI_CACHE_DISK", "1") != "0"
+SHARED_SINGLEFLIGHT = DISK_ENABLED and os.getenv("AI_SINGLEFLIGHT_SHARED") == "1"
+
+
+def normalize_text(text, strip_punctuation=False):
+    """
+    Lower-cases and collapses whitespace, so trivially different inputs share a key.
+    With strip_punctuation, punctuation is dropped as well ("Shampoo bars?" == "shampoo bars").
+    """
+    text = str(text)
+    if strip_punctuation:
+        text = re.sub(r"[^\w\s]", " ", text)
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def make_key(*parts):
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU with an optional time to live (seconds) per entry."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """
+    Persistent key/value store (bytes values) shared by all processes using the same file.
+    Every thread gets its own connection; the database runs in WAL mode so readers never block.
+    """
+
+    # Expired and surplus rows are pruned every PRUNE_EVERY writes
+    PRUNE_EVERY = 256
+
+    def __init__(self, path=CACHE_PATH, namespace="default", max_entries=100_000):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+    def _connection(self):
+        # Connections must not cross a fork, so they are keyed by process id as well
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, "
+                "expires_at REAL, created_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, key, value, now + ttl if ttl is not None else None, now),
+        )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def add(self, key, value, ttl=None):
+        """Stores the value only if the key is missing (or expired). Returns True if it was stored."""
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND key = ? AND expires_at IS NOT NULL AND expires_at <= ?",
+            (self.namespace, key, now),
+        )
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO cache (namespace, key, value, expires_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            (self.namespace, key, value, now + ttl if ttl is not None else None, now),
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        """Returns True if the key existed."""
+        cursor = self._connection().execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+        return cursor.rowcount == 1
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache WHERE namespace = ?", (self.namespace,))
+
+    def prune(self):
+        connection = self._connection()
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND expires_at IS NOT NULL AND expires_at < ?", (self.namespace, time.time())
+        )
+        # Keep only the newest max_entries rows of this namespace
+        connection.execute(
+            "DELETE FROM cache WHERE namespace = ? AND key IN ("
+            "SELECT key FROM cache WHERE namespace = ? ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self.max_entries),
+        )
+
+
+class TieredCache:
+    """
+    In-process LRU in front of a SQLiteCache, with hit/miss counters.
+    encode/decode convert values to and from the bytes stored in the persistent tier.
+    """
+
+    def __init__(self, namespace, maxsize=1024, ttl=None, encode=None, decode=None, disk=DISK_ENABLED, path=CACHE_PATH):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.disk = SQLiteCache(path=path, namespace=namespace) if disk else None
+        self.encode = encode or (lambda value: str(value).encode("utf-8"))
+        self.decode = decode or (lambda data: bytes(data).decode("utf-8"))
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _read_disk(self, key):
+        # Value from the persistent tier (copied to memory), or None
+        if self.disk is None:
+            return None
+        try:
+            data = self.disk.get(key)
+        except sqlite3.Error as e:
+            # The persistent tier is an optimisation, never fail the call because of it
+            logger.warning("AI cache read failed: %s", e)
+            return None
+        if data is None:
+            return None
+        value = self.decode(data)
+        self.memory.set(key, value)
+        return value
+
+    def _write_disk(self, key, value):
+        if self.disk is not None:
+            try:
+                self.disk.set(key, self.encode(value), ttl=self.ttl)
+            except sqlite3.Error as e:
+                logger.warning("AI cache write failed: %s", e)
+
+    def _count(self, value, from_disk):
+        if value is None:
+            self.misses += 1
+        elif from_disk:
+            self.disk_hits += 1
+        else:
+            self.hits += 1
+
+    def get(self, key):
+        value = self.memory.get(key)
+        from_disk = value is None
+        if from_disk:
+            value = self._read_disk(key)
+        self._count(value, from_disk)
+        return value
+
+    def peek(self, key):
+        # Like get(), without counting a hit or miss (used while polling)
+        value = self.memory.get(key)
+        return value if value is not None else self._read_disk(key)
+
+    def set(self, key, value):
+        self.memory.set(key, value)
+        self._write_disk(key, value)
+
+    # Async versions for the event loop: the in-process LRU is checked on the loop, the SQLite
+    # tier (which may wait up to 5 s on a write lock) is only touched from a worker thread.
+
+    async def aget_many(self, keys):
+        """Values of all the keys (None where missing), with a single thread hop for the disk reads."""
+        values = [self.memory.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing and self.disk is not None:
+            found = await asyncio.to_thread(lambda: [self._read_disk(keys[i]) for i in missing])
+            for i, value in zip(missing, found):
+                values[i] = value
+        from_disk = set(missing)
+        for i, value in enumerate(values):
+            self._count(value, i in from_disk)
+        return values
+
+    async def aget(self, key):
+        return (await self.aget_many([key]))[0]
+
+    async def aset_many(self, items):
+        for key, value in items:
+            self.memory.set(key, value)
+        if self.disk is not None:
+            await asyncio.to_thread(lambda: [self._write_disk(key, value) for key, value in items])
+
+    async def aset(self, key, value):
+        await self.aset_many([(key, value)])
+
+    def delete(self, key):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "size": len(self.memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+class SemanticCache:
+    """
+    Thread-safe in-process cache of responses keyed by embedding.
+    lookup() returns the response stored for the most similar embedding of the same bucket,
+    if its cosine similarity is at least `threshold`. At most `maxsize` entries are kept,
+    the least recently used one is evicted first; entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, maxsize=1024, threshold=0.92, ttl=None):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        # One unit row per slot, allocated on the first store once the dimension is known
+        self._vectors = None
+        self._entries = {}  # slot -> (bucket, response, expires_at)
+        self._order = OrderedDict()  # slots, least recently used first
+        self._free = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def lookup(self, embedding, bucket):
+        query = self._unit(embedding)
+        now = time.time()
+        with self._lock:
+            slots = []
+            for slot, (entry_bucket, _, expires_at) in list(self._entries.items()):
+                if expires_at is not None and expires_at < now:
+                    self._evict(slot)
+                elif entry_bucket == bucket:
+                    slots.append(slot)
+
+            if slots:
+                scores = self._vectors[slots] @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._order.move_to_end(slots[best])
+                    self.hits += 1
+                    return self._entries[slots[best]][1]
+
+            self.misses += 1
+            return None
+
+    def empty_bucket(self, bucket):
+        """
+        True if `bucket` has no live entries: a lookup can only miss, so the caller can skip embedding
+        the question. Counted as a miss.
+        """
+        now = time.time()
+        with self._lock:
+            for entry_bucket, _, expires_at in self._entries.values():
+                if entry_bucket == bucket and (expires_at is None or expires_at >= now):
+                    return False
+            self.misses += 1
+            return True
+
+    def count_miss(self):
+        # A lookup that couldn't be made (e.g. the embedding model is unavailable)
+        with self._lock:
+            self.misses += 1
+
+    def store(self, embedding, bucket, response):
+        vector = self._unit(embedding)
+        with self._lock:
+            if self._vectors is None or self._vectors.shape[1] != len(vector):
+                self._vectors = np.zeros((self.maxsize, len(vector)), dtype=np.float32)
+                self._entries.clear()
+                self._order.clear()
+                self._free = list(range(self.maxsize - 1, -1, -1))
+
+            if not self._free:
+                self._evict(next(iter(self._order)))
+            slot = self._free.pop()
+
+            self._vectors[slot] = vector
+            self._entries[slot] = (bucket, response, time.time() + self.ttl if self.ttl is not None else None)
+            self._order[slot] = None
+
+    def _evict(self, slot):
+        del self._entries[slot]
+        del self._order[slot]
+        self._free.append(slot)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class _Flight:
+    # One in-flight call that duplicates wait for
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncFlight:
+    # One in-flight async call: a task of its own, so it outlives any single caller
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the function, callers that
+    arrive while it is running wait and get the same result (or exception).
+
+    With a `leases` SQLiteCache, the first worker to take a lease on the key runs the call and other
+    workers poll `lookup()` (usually a cache read of the result the call stores) until it returns a
+    value or the lease is released or expires after `lease_ttl` seconds; then they call the function themselves.
+    """
+
+    def __init__(self, leases=None, lease_ttl=30, poll_interval=0.05):
+        self.leases = leases
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self._flights = {}
+        self._async_flights = weakref.WeakKeyDictionary()  # event loop -> {key: _AsyncFlight}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def _take_lease(self, key):
+        # True if this worker may run the call (no shared leases, or the lease was free)
+        if self.leases is None:
+            return True
+        try:
+            return self.leases.add(key, b"1", ttl=self.lease_ttl)
+        except sqlite3.Error as e:
+            logger.warning("AI lease failed: %s", e)
+            return True
+
+    def _release_lease(self, key):
+        if self.leases is not None:
+            try:
+                self.leases.delete(key)
+            except sqlite3.Error as e:
+                logger.warning("AI lease release failed: %s", e)
+
+    def _lease_held(self, key):
+        try:
+            return self.leases.get(key) is not None
+        except sqlite3.Error:
+            return False
+
+    def _run(self, key, func, lookup):
+        if lookup is None or self._take_lease(key):
+            try:
+                return func()
+            finally:
+                if lookup is not None:
+                    self._release_lease(key)
+
+        # Another worker is making this call: wait for its result to show up
+        deadline = time.monotonic() + self.lease_ttl
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            value = lookup()
+            if value is not None:
+                return value
+            if not self._lease_held(key):
+                break
+        value = lookup()
+        return value if value is not None else func()
+
+    def do(self, key, func, lookup=None):
+        """Returns func(), shared with the concurrent calls of the same key."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._run(key, func, lookup)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def _arun(self, key, func, lookup):
+        # Same as _run(); the lease file and lookup() (usually a disk read) are used from a worker thread
+        shared = lookup is not None and self.leases is not None
+        if not shared or await asyncio.to_thread(self._take_lease, key):
+            try:
+                return await func()
+            finally:
+                if shared:
+                    await asyncio.to_thread(self._release_lease, key)
+
+        deadline = time.monotonic() + self.lease_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            value = await asyncio.to_thread(lookup)
+            if value is not None:
+                return value
+            if not await asyncio.to_thread(self._lease_held, key):
+                break
+        value = await asyncio.to_thread(lookup)
+        return value if value is not None else await func()
+
+    async def ado(self, key, func, lookup=None):
+        """
+        Async version of do(): func is an async function, duplicates on the same event loop share its result.
+        The call runs in its own task, so a caller that is cancelled (e.g. its client disconnected) only
+        stops waiting; the call is cancelled once no caller waits for it anymore.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flights = self._async_flights.setdefault(loop, {})
+            flight = flights.get(key)
+            if flight is None:
+                flight = flights[key] = _AsyncFlight(loop.create_task(self._arun(key, func, lookup)))
+                flight.task.add_done_callback(lambda task: self._async_done(flights, key, flight))
+                self.calls += 1
+            else:
+                self.coalesced += 1
+            flight.waiters += 1
+
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            with self._lock:
+                flight.waiters -= 1
+                abandoned = flight.waiters == 0
+                if abandoned and flights.get(key) is flight:
+                    # A caller arriving from now on starts a new call instead of joining the cancelled one
+                    del flights[key]
+            if abandoned:
+                flight.task.cancel()
+            raise
+
+    def _async_done(self, flights, key, flight):
+        with self._lock:
+            if flights.get(key) is flight:
+                del flights[key]
+        # Retrieved here so an exception nobody waited for isn't logged as unhandled
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self):
+        total = self.calls + self.coalesced
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / total if total else 0.0,
+        }
@@ -0,0 +1,281 @@
+"""
+Binary product catalog store.
+
+The scraper notebooks produce products_with_embeddings.csv, where every embedding is a
+string like "[0.01, -0.2, ...]". Parsing that text on every worker boot is slow, so the
+catalog is converted once into:
+
+- products_embeddings.npy: a contiguous float32 matrix with one row per product
+- products_metadata.json: the remaining columns, stored column by column, plus store flags
+
+The matrix is memory-mapped when loaded, so cold start is a few milliseconds and all
+gunicorn workers share the same pages from the OS page cache.
+
+Build (or rebuild) the store from the repository root with:
+    python -m AI.catalog [--normalize] [--build-index [--lists N]] [--quantize int8|float16]
+
+With --normalize every row is scaled to unit length, so scores become cosine similarities.
+With --build-index an approximate nearest-neighbour index (see AI/ann.py) is built from the
+store and saved next to it, so workers load it instead of clustering on boot.
+With --quantize a compact copy of the matrix is written (see AI/quantize.py); exact searches
+then scan the compact copy and only re-rank the best candidates at full precision. That saves
+memory, not time: the float32 scan is the faster one and stays the default.
+"""
+import argparse
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from AI.ann import IVFIndex
+from AI.quantize import QUANTIZATIONS, QuantizedEmbeddings, codes_file, scales_file
+
+logger = logging.getLogger(__name__)
+
+SCRAPER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scraper")
+CSV_PATH = os.path.join(SCRAPER_DIR, "products_with_embeddings.csv")
+
+EMBEDDINGS_FILE = "products_embeddings.npy"
+METADATA_FILE = "products_metadata.json"
+INDEX_FILE = "products_ivf_index.npz"
+
+
+def _replace_atomically(path, write):
+    # Write to a temporary file first so other workers never see a half written store
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def build_store(csv_path=CSV_PATH, out_dir=SCRAPER_DIR, normalize=False):
+    """
+    Converts the embeddings CSV into the binary store used by ProductCatalog.
+    If normalize is True the rows are stored with unit length.
+    Returns the number of products written.
+    """
+    products = pd.read_csv(csv_path)
+
+    # The encoder notebook names the column "embeddings", older exports use "embedding"
+    column = "embedding" if "embedding" in products.columns else "embeddings"
+
+    # Convert the embeddings from string to a single float32 matrix
+    embeddings = np.vstack([np.fromstring(x[1:-1], sep=",", dtype=np.float32) for x in products[column]])
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    if normalize:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings /= np.maximum(norms, np.finfo(np.float32).tiny)
+
+    # Everything else is kept as columnar metadata, with NaN stored as null
+    metadata = products.drop(columns=[column])
+    metadata = metadata.astype(object).where(metadata.notna(), None)
+    store = {
+        "normalized": bool(normalize),
+        "columns": {name: metadata[name].tolist() for name in metadata.columns},
+    }
+
+    os.makedirs(out_dir, exist_ok=True)
+    _replace_atomically(os.path.join(out_dir, EMBEDDINGS_FILE), lambda f: np.save(f, embeddings))
+    _replace_atomically(os.path.join(out_dir, METADATA_FILE), lambda f: f.write(json.dumps(store).encode("utf-8")))
+
+    return len(products)
+
+
+def build_index(out_dir=SCRAPER_DIR, n_lists=None):
+    """
+    Builds the IVF index from an existing store and saves it next to it.
+    Returns the number of lists.
+    """
+    catalog = ProductCatalog.load(out_dir)
+    index = IVFIndex.build(catalog.embeddings, n_lists=n_lists)
+    _replace_atomically(os.path.join(out_dir, INDEX_FILE), index.save)
+    return len(index.centroids)
+
+
+def build_quantized(out_dir=SCRAPER_DIR, dtype="int8"):
+    """Writes the compact copy of the store's embedding matrix."""
+    catalog = ProductCatalog.load(out_dir)
+    compact = QuantizedEmbeddings.quantize(catalog.embeddings, dtype)
+    if compact.scales is not None:
+        _replace_atomically(os.path.join(out_dir, scales_file(dtype)), lambda f: np.save(f, compact.scales))
+    _replace_atomically(os.path.join(out_dir, codes_file(dtype)), lambda f: np.save(f, compact.codes))
+
+
+class ProductCatalog:
+    """
+    Product metadata (a pandas DataFrame) plus the memory-mapped embedding matrix.
+    Row i of `embeddings` belongs to row i of `products`.
+    If an ANN `index` is set, search() only scores the products it returns as candidates.
+    Otherwise, if `compact` (QuantizedEmbeddings) is set, the compact copy is scanned and the
+    best `rerank` candidates are re-scored with the full precision matrix.
+    """
+
+    def __init__(self, products, embeddings, normalized=False, index=None, compact=None, rerank=200):
+        self.products = products
+        # One C-contiguous float32 matrix for the whole catalog, so scoring is a single BLAS call
+        self.embeddings = np.asarray(embeddings)
+        if self.embeddings.dtype != np.float32 or not self.embeddings.flags["C_CONTIGUOUS"]:
+            self.embeddings = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        self.normalized = normalized
+        self.index = index
+        self.compact = compact
+        self.rerank = rerank
+
+    def __len__(self):
+        return len(self.products)
+
+    def prepare_query(self, query):
+        query = np.asarray(query, dtype=np.float32)
+        if self.normalized:
+            query = query / np.linalg.norm(query)
+        return query
+
+    def score(self, query):
+        """
+        Returns the similarity of every product to the query embedding.
+        The score vector is the only allocation; the matrix itself is never copied.
+        """
+        return self.embeddings @ self.prepare_query(query)
+
+    @staticmethod
+    def top_k(scores, k):
+        """
+        Returns the indices of the k highest scores, best first.
+        Uses a partial selection (O(n)) and only sorts the k winners.
+        """
+        k = min(k, len(scores))
+        if k <= 0:
+            return np.empty(0, dtype=np.intp)
+        if k < len(scores):
+            candidates = np.argpartition(scores, -k)[-k:]
+        else:
+            candidates = np.arange(len(scores))
+        return candidates[np.argsort(scores[candidates])[::-1]]
+
+    def rescore(self, query, candidates, k):
+        # Exact scores for a subset of products, returns the k best of them
+        return candidates[self.top_k(self.embeddings[candidates] @ query, k)]
+
+    def search(self, query, k):
+        """Returns the indices of the k products most similar to the query embedding, best first."""
+        query = self.prepare_query(query)
+
+        if self.index is not None:
+            # Approximate search: only score the products in the probed index lists
+            return self.rescore(query, self.index.candidates(query), k)
+
+        if self.compact is not None:
+            # Scan the compact copy, then re-rank the best candidates at full precision
+            candidates = self.top_k(self.compact.score(query), max(k, self.rerank))
+            return self.rescore(query, candidates, k)
+
+        return self.top_k(self.embeddings @ query, k)
+
+    def search_batch(self, queries, k, rrf_k=60):
+        """
+        Scores several query embeddings with one matrix-matrix product (or one index
+        search each, when an ANN index is set) and fuses their rankings with
+        reciprocal-rank fusion (score = sum of 1 / (rrf_k + rank)).
+        Returns the indices of the k best fused products, best first.
+        """
+        if self.index is not None:
+            ranked = [self.search(query, k) for query in queries]
+        else:
+            queries = np.asarray(queries, dtype=np.float32)
+            if self.normalized:
+                queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+            if self.compact is not None:
+                # One scan of the compact copy for all queries, then per-query exact re-ranking
+                scores = self.compact.score(queries)
+                ranked = [self.rescore(query, self.top_k(row, max(k, self.rerank)), k) for query, row in zip(queries, scores)]
+            else:
+                # One GEMM for all queries, one row of scores per query
+                scores = queries @ self.embeddings.T
+                ranked = [self.top_k(row, k) for row in scores]
+
+        # Add up the reciprocal ranks of every product over all the rankings
+        weights = 1.0 / (rrf_k + np.arange(1, k + 1, dtype=np.float32))
+        fused = np.zeros(len(self), dtype=np.float32)
+        for ids in ranked:
+            fused[ids] += weights[:len(ids)]
+
+        return self.top_k(fused, min(k, len(np.unique(np.concatenate(ranked)))))
+
+    @classmethod
+    def load(cls, directory=SCRAPER_DIR, csv_path=CSV_PATH, use_index=False, n_probe=8, min_candidates=0,
+             quantization=None, rerank=200):
+        """
+        Loads the store, building it first if needed.
+        With use_index the saved IVF index is loaded too (see build_index); n_probe and
+        min_candidates are its recall knobs.
+        With quantization ("int8" or "float16") the compact copy is loaded (see build_quantized)
+        and `rerank` candidates are re-scored at full precision.
+        """
+        embeddings_path = os.path.join(directory, EMBEDDINGS_FILE)
+        metadata_path = os.path.join(directory, METADATA_FILE)
+        index_path = os.path.join(directory, INDEX_FILE)
+
+        # Build the store once if it is missing or older than the scraped CSV
+        if not os.path.exists(embeddings_path) or not os.path.exists(metadata_path):
+            build_store(csv_path, directory)
+        elif os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(embeddings_path):
+            with open(metadata_path, encoding="utf-8") as f:
+                build_store(csv_path, directory, normalize=json.load(f)["normalized"])
+
+        embeddings = np.load(embeddings_path, mmap_mode="r")
+        with open(metadata_path, encoding="utf-8") as f:
+            store = json.load(f)
+        products = pd.DataFrame(store["columns"])
+
+        if len(products) != embeddings.shape[0]:
+            raise ValueError(f"Catalog store is inconsistent: {len(products)} products but {embeddings.shape[0]} embeddings.")
+
+        index = None
+        if use_index:
+            if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(embeddings_path):
+                index = IVFIndex.load(index_path, n_probe=n_probe, min_candidates=min_candidates)
+            else:
+                # Never cluster on boot; fall back to exact search until the index is rebuilt
+                logger.warning("Product index is missing or older than the store, using exact search. Run `python -m AI.catalog --build-index`.")
+
+        if index is not None and index.size != len(products):
+            raise ValueError(f"Product index covers {index.size} products but the store has {len(products)}.")
+
+        compact = None
+        if quantization:
+            codes_path = os.path.join(directory, codes_file(quantization))
+            if os.path.exists(codes_path) and os.path.getmtime(codes_path) >= os.path.getmtime(embeddings_path):
+                compact = QuantizedEmbeddings.load(directory, quantization)
+            else:
+                logger.warning("Quantized %s embeddings are missing or older than the store, using full precision. Run `python -m AI.catalog --quantize %s`.", quantization, quantization)
+
+        if compact is not None and len(compact.codes) != len(products):
+            raise ValueError(f"Quantized embeddings cover {len(compact.codes)} products but the store has {len(products)}.")
+
+        return cls(products, embeddings, normalized=store["normalized"], index=index, compact=compact, rerank=rerank)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the binary product catalog store from the embeddings CSV.")
+    parser.add_argument("--csv", default=CSV_PATH, help="Path to products_with_embeddings.csv")
+    parser.add_argument("--out", default=SCRAPER_DIR, help="Directory to write the store to")
+    parser.add_argument("--normalize", action="store_true", help="Store unit-length rows (cosine similarity)")
+    parser.add_argument("--build-index", action="store_true", help="Also build the approximate nearest-neighbour index")
+    parser.add_argument("--lists", type=int, default=None, help="Number of index lists (default: sqrt of the product count)")
+    parser.add_argument("--quantize", choices=QUANTIZATIONS, help="Also write a compact int8 or float16 copy of the embeddings")
+    args = parser.parse_args()
+
+    count = build_store(args.csv, args.out, normalize=args.normalize)
+    print(f"Wrote {count} products to {args.out}")
+
+    if args.build_index:
+        n_lists = build_index(args.out, n_lists=args.lists)
+        print(f"Wrote product index with {n_lists} lists to {args.out}")
+
+    if args.quantize:
+        build_quantized(args.out, args.quantize)
+        print(f"Wrote {args.quantize} embeddings to {args.out}")
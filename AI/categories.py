@@ -0,0 +1,82 @@
+"""
+Category and tag vocabulary of the product catalog, for the paraphrase prompt.
+
+The vocabulary is read from the catalog's "categories" and "tags" columns (stored as list
+strings like "['Haircare', 'Brushes & Combs']"), so it follows products.csv instead of a
+hard-coded list. Every name is embedded once; each paraphrase prompt then lists only the
+names closest to the incoming query.
+"""
+import ast
+
+import numpy as np
+
+from AI.cache import make_key
+from AI.catalog import ProductCatalog
+
+COLUMNS = ("categories", "tags")
+
+
+def parse_names(value):
+    # One cell of a list column: a list, a "[...]" string or missing
+    if isinstance(value, (list, tuple)):
+        return [str(name) for name in value]
+    if not isinstance(value, str) or not value.strip():
+        return []
+    try:
+        names = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return [name.strip() for name in value.strip("[]").split(",") if name.strip()]
+    return [str(name) for name in names] if isinstance(names, (list, tuple)) else [str(names)]
+
+
+class CategoryIndex:
+    """
+    Unique category and tag names, most frequent first, plus (once set_embeddings() is called)
+    one embedding row per name. AI.relevant_categories embeds the names with the embedding
+    model (AI.embed_queries, through the scheduler) and passes them in.
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.embeddings = None
+        # Changes whenever the vocabulary does, so cached prompts built from an old one are never served
+        self.version = make_key(*self.names)
+
+    @classmethod
+    def from_products(cls, products, columns=COLUMNS):
+        counts = {}
+        for column in columns:
+            if column not in products.columns:
+                continue
+            for value in products[column]:
+                for name in parse_names(value):
+                    counts[name] = counts.get(name, 0) + 1
+        return cls(sorted(counts, key=lambda name: -counts[name]))
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def embedded(self):
+        return self.embeddings is not None
+
+    def set_embeddings(self, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if not self.names and not len(embeddings):
+            # Empty vocabulary: nothing to rank
+            self.embeddings = embeddings.reshape(0, 0)
+            return
+        if len(embeddings) != len(self.names):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(self.names)} categories.")
+        # Unit rows, so nearest() ranks by cosine similarity
+        self.embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    def nearest(self, query, k):
+        """
+        Returns the k names most similar to the query embedding, best first
+        (all names until embedded, none for an empty vocabulary).
+        """
+        if not self.embedded or k >= len(self.names):
+            return list(self.names)
+        scores = self.embeddings @ np.asarray(query, dtype=np.float32)
+        return [self.names[i] for i in ProductCatalog.top_k(scores, k)]
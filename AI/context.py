@@ -0,0 +1,114 @@
+"""
+Token budgeting for the prompts sent to the model.
+
+Tokens are estimated locally with a cheap approximation (words and punctuation, long words
+counting extra), which is close enough to keep every request within its budget without a
+round trip to the tokenizer.
+
+fit_history trims a chat_history (list of {"role", "parts"}) to a token budget. It always keeps
+the latest turn and a leading "Conversation summary" (see AI.compact_chat), then fills the rest
+of the budget with the most recent messages; the oldest message that only partly fits is cut
+from the front. The system instruction and the profile are not part of the history, the caller
+subtracts them from the budget first.
+"""
+import re
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+# Roughly one token per 4 characters of a long word
+_CHARS_PER_TOKEN = 4
+
+# A message is only cut to fit if at least this many tokens of it can be kept
+MIN_TRIMMED_TOKENS = 32
+
+SUMMARY_PREFIX = "Conversation summary"
+FUNCTION_RESPONSE_PREFIX = "Function response"
+
+
+ELLIPSIS = "..."
+
+
+def _token_cost(token):
+    return 1 + (len(token) - 1) // _CHARS_PER_TOKEN
+
+
+def estimate_tokens(text):
+    """Approximate number of tokens in text."""
+    return sum(_token_cost(token) for token in _TOKEN_RE.findall(str(text)))
+
+
+def truncate_text(text, max_tokens, keep_end=False):
+    """
+    Cuts text at a token boundary so it fits in max_tokens tokens, "..." included.
+    Keeps the beginning, or the end with keep_end. Returns the text unchanged if it already fits.
+    """
+    text = str(text)
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    budget = max_tokens - estimate_tokens(ELLIPSIS)
+    matches = list(_TOKEN_RE.finditer(text))
+    if keep_end:
+        matches.reverse()
+    cut = len(text) if keep_end else 0
+    for match in matches:
+        budget -= _token_cost(match.group())
+        if budget < 0:
+            break
+        cut = match.start() if keep_end else match.end()
+
+    if keep_end:
+        return ELLIPSIS + text[cut:]
+    return text[:cut] + ELLIPSIS
+
+
+def latest_turn_start(chat_history):
+    """
+    Index where the latest turn starts: the last user message that isn't a function response,
+    so a turn's function results are kept together with the question that caused them.
+    """
+    for i in range(len(chat_history) - 1, -1, -1):
+        message = chat_history[i]
+        if message.get("role") == "user" and not str(message.get("parts")).startswith(FUNCTION_RESPONSE_PREFIX):
+            return i
+    return max(0, len(chat_history) - 1)
+
+
+def fit_history(chat_history, budget):
+    """
+    Returns (history, tokens_saved): the messages of chat_history that fit in `budget` tokens, in order.
+    The latest turn is always kept, even if it alone exceeds the budget.
+    """
+    if not chat_history:
+        return [], 0
+
+    sizes = [estimate_tokens(message.get("parts")) for message in chat_history]
+    total = sum(sizes)
+    if total <= budget:
+        return list(chat_history), 0
+
+    start = latest_turn_start(chat_history)
+    remaining = budget - sum(sizes[start:])
+
+    # A leading summary stands for everything before it, so it goes first
+    summary = None
+    first = 0
+    if start > 0 and str(chat_history[0].get("parts")).startswith(SUMMARY_PREFIX):
+        first = 1
+        if sizes[0] <= remaining:
+            summary = chat_history[0]
+            remaining -= sizes[0]
+
+    # Then as many recent messages as fit, newest first
+    kept = []
+    for i in range(start - 1, first - 1, -1):
+        if sizes[i] <= remaining:
+            kept.append(chat_history[i])
+            remaining -= sizes[i]
+            continue
+        if remaining >= MIN_TRIMMED_TOKENS:
+            kept.append({**chat_history[i], "parts": truncate_text(chat_history[i].get("parts"), remaining, keep_end=True)})
+        break
+
+    history = ([summary] if summary else []) + kept[::-1] + list(chat_history[start:])
+    return history, total - sum(estimate_tokens(message.get("parts")) for message in history)
@@ -0,0 +1,249 @@
+"""
+LLM providers behind the AI class.
+
+A provider makes the raw generate_content / embed_content calls; everything around them (scheduling,
+caching, coalescing, tool execution) stays in AI. Requests and responses use the google-genai types
+on both sides, so the rest of the code doesn't know which provider answered.
+
+- GeminiProvider (default) calls the Gemini API.
+- FakeProvider answers locally and deterministically: the same request always gets the same text,
+  tool calls and embeddings, after a configurable synthetic latency. For tests and benchmarks that
+  must not hit the live API.
+
+Each provider has a `name`; AI keeps the cache entries of other providers than gemini apart, so fake
+replies and embeddings never end up in the live API's cache.
+
+Configuration (environment):
+- AI_PROVIDER: gemini (default) or fake
+- AI_FAKE_LATENCY: seconds each fake call takes (default 0)
+- AI_FAKE_CHUNK_LATENCY: extra seconds between fake stream chunks (default 0)
+- AI_FAKE_WORDS: words in a fake text reply (default 40)
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+from google import genai
+from google.genai import types
+
+
+def with_timeout(request, timeout, config_type):
+    # The request with its HTTP timeout lowered to `timeout` seconds (the time left before the call's deadline)
+    config = request.get("config") or config_type()
+    http_options = types.HttpOptions(timeout=max(1, int(timeout * 1000)))
+    return {**request, "config": config.model_copy(update={"http_options": http_options})}
+
+
+class GeminiProvider:
+    """
+    The Gemini API through the google-genai client.
+    The blocking methods take an optional `timeout` (seconds) for this request, capped by the client's.
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key=None, timeout=30.0):
+        # Each HTTP request times out after `timeout` seconds
+        self.timeout = timeout
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(timeout=int(timeout * 1000)),
+        )
+
+    def request_with_timeout(self, request, timeout, config_type):
+        if timeout is None or timeout >= self.timeout:
+            return request
+        return with_timeout(request, timeout, config_type)
+
+    def generate(self, timeout=None, **request):
+        return self.client.models.generate_content(**self.request_with_timeout(request, timeout, types.GenerateContentConfig))
+
+    def generate_stream(self, timeout=None, **request):
+        return self.client.models.generate_content_stream(**self.request_with_timeout(request, timeout, types.GenerateContentConfig))
+
+    def embed(self, timeout=None, **request):
+        return self.client.models.embed_content(**self.request_with_timeout(request, timeout, types.EmbedContentConfig))
+
+    def agenerate(self, **request):
+        return self.client.aio.models.generate_content(**request)
+
+    def agenerate_stream(self, **request):
+        # Awaitable that resolves to an async iterator of chunks, like the SDK
+        return self.client.aio.models.generate_content_stream(**request)
+
+    def aembed(self, **request):
+        return self.client.aio.models.embed_content(**request)
+
+
+class FakeProvider:
+    """
+    Local stand-in for GeminiProvider. Replies are derived from a hash of the request:
+    - a user message asking for products gets a make_product_recommendations call (when the tool is offered),
+    - a user message about themselves ("I am", "I'm", "my") gets an update_profile call (when the tool
+      is offered) whose new_profile quotes the message, next to a text reply, or next to the
+      make_product_recommendations call if it also asks for products,
+    - a function response gets a reply citing the first products it lists ([P123]),
+    - JSON requests (summarize_chat) get a one message history with a "Conversation summary",
+    - anything else gets AI_FAKE_WORDS words picked from a fixed vocabulary.
+    Embeddings are unit vectors seeded from a hash of the text.
+    """
+
+    name = "fake"
+    product_keywords = ("product", "recommend", "buy", "shop", "alternative", "replace")
+    vocabulary = (
+        "reuse", "recycle", "compost", "reduce", "energy", "water", "local", "seasonal", "plastic", "waste",
+        "bamboo", "solar", "repair", "refill", "thrift", "cycling", "transit", "insulation", "plants", "garden",
+        "bulk", "glass", "cotton", "durable", "efficient", "footprint", "carbon", "habit", "weekly", "simple",
+    )
+    profile_pattern = re.compile(r"\b(i am|i'm|my)\b", re.IGNORECASE)
+    product_id_pattern = re.compile(r"\bP(\d+):")
+    chunk_words = 4
+
+    def __init__(self, latency=0.0, chunk_latency=0.0, words=40, embedding_dim=768):
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.words = words
+        self.embedding_dim = embedding_dim
+
+    @staticmethod
+    def seed(*texts):
+        digest = hashlib.sha256("\x1f".join(texts).encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    @staticmethod
+    def content_text(content):
+        if isinstance(content, str):
+            return content
+        return "".join(part.text or "" for part in content.parts or [])
+
+    @classmethod
+    def last_message(cls, contents):
+        if isinstance(contents, list):
+            return cls.content_text(contents[-1]) if contents else ""
+        return cls.content_text(contents)
+
+    @staticmethod
+    def offered_tools(config):
+        if config is None or not config.tools:
+            return set()
+        return {declaration.name for tool in config.tools for declaration in tool.function_declarations or []}
+
+    def reply_text(self, seed):
+        rng = np.random.default_rng(seed)
+        words = rng.choice(self.vocabulary, size=self.words)
+        return " ".join(words).capitalize() + "."
+
+    def reply_parts(self, request):
+        config = request.get("config")
+        message = self.last_message(request["contents"])
+        system_instruction = str(config.system_instruction or "") if config else ""
+        seed = self.seed(request["model"], system_instruction, message)
+
+        if config is not None and config.response_mime_type == "application/json":
+            summary = {"role": "model", "parts": "Conversation summary: " + self.reply_text(seed)}
+            return [types.Part.from_text(text=json.dumps([summary]))]
+
+        if message.startswith("Function response"):
+            ids = self.product_id_pattern.findall(message)[:3]
+            cited = " ".join(f"[P{index}]" for index in ids)
+            return [types.Part.from_text(text=f"{self.reply_text(seed)} {cited}".strip())]
+
+        offered = self.offered_tools(config)
+        calls = []
+        if "update_profile" in offered and self.profile_pattern.search(message):
+            calls.append(types.FunctionCall(name="update_profile", args={"new_profile": f"The user said: {message[:200]}"}))
+        if ("make_product_recommendations" in offered
+                and any(keyword in message.lower() for keyword in self.product_keywords)):
+            calls.append(types.FunctionCall(name="make_product_recommendations", args={"query": message[:200]}))
+            return [types.Part(function_call=call) for call in calls]
+
+        return [types.Part.from_text(text=self.reply_text(seed)), *(types.Part(function_call=call) for call in calls)]
+
+    @staticmethod
+    def response(parts):
+        return types.GenerateContentResponse(
+            candidates=[types.Candidate(content=types.Content(role="model", parts=parts))]
+        )
+
+    def stream_chunks(self, request):
+        # Text is streamed a few words per chunk, function calls in a single chunk after it
+        parts = self.reply_parts(request)
+        calls = [part for part in parts if part.function_call]
+        words = [word for part in parts if part.text for word in part.text.split(" ")]
+        chunks = [
+            self.response([types.Part.from_text(text=" ".join(words[i:i + self.chunk_words]) + " ")])
+            for i in range(0, len(words), self.chunk_words)
+        ]
+        if calls:
+            chunks.append(self.response(calls))
+        return chunks
+
+    def embedding(self, text):
+        vector = np.random.default_rng(self.seed(text)).standard_normal(self.embedding_dim)
+        return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+    def embed_response(self, request):
+        contents = request["contents"]
+        texts = [contents] if isinstance(contents, str) else [self.content_text(content) for content in contents]
+        return types.EmbedContentResponse(embeddings=[types.ContentEmbedding(values=self.embedding(text)) for text in texts])
+
+    def wait(self, timeout):
+        # The synthetic latency; like an HTTP timeout, a `timeout` shorter than it raises TimeoutError
+        if timeout is not None and timeout < self.latency:
+            time.sleep(max(0.0, timeout))
+            raise TimeoutError(f"Fake call timed out after {timeout:.3f}s.")
+        time.sleep(self.latency)
+
+    def generate(self, timeout=None, **request):
+        self.wait(timeout)
+        return self.response(self.reply_parts(request))
+
+    def generate_stream(self, timeout=None, **request):
+        self.wait(timeout)
+        for chunk in self.stream_chunks(request):
+            yield chunk
+            time.sleep(self.chunk_latency)
+
+    def embed(self, timeout=None, **request):
+        self.wait(timeout)
+        return self.embed_response(request)
+
+    async def agenerate(self, **request):
+        await asyncio.sleep(self.latency)
+        return self.response(self.reply_parts(request))
+
+    async def agenerate_stream(self, **request):
+        await asyncio.sleep(self.latency)
+
+        async def chunks():
+            for chunk in self.stream_chunks(request):
+                yield chunk
+                await asyncio.sleep(self.chunk_latency)
+
+        return chunks()
+
+    async def aembed(self, **request):
+        await asyncio.sleep(self.latency)
+        return self.embed_response(request)
+
+
+def provider_from_env(embedding_dim=768):
+    """The provider named by AI_PROVIDER. embedding_dim sizes the fake embeddings (match the catalog)."""
+    name = os.getenv("AI_PROVIDER", "gemini").lower()
+    if name == "gemini":
+        return GeminiProvider(
+            api_key=os.getenv("API_KEY"),
+            timeout=float(os.getenv("AI_HTTP_TIMEOUT", "30")),
+        )
+    if name == "fake":
+        return FakeProvider(
+            latency=float(os.getenv("AI_FAKE_LATENCY", "0")),
+            chunk_latency=float(os.getenv("AI_FAKE_CHUNK_LATENCY", "0")),
+            words=int(os.getenv("AI_FAKE_WORDS", "40")),
+            embedding_dim=embedding_dim,
+        )
+    raise ValueError(f"Unknown AI_PROVIDER {name!r}, expected 'gemini' or 'fake'.")
@@ -0,0 +1,390 @@
+"""
+Scheduling of the calls to the Gemini API.
+
+Every generate_content / embed_content call goes through a per-model lane that:
+- caps the calls in flight (AI_MAX_CONCURRENCY per model and worker, for threads and for the event loop),
+- paces requests with a token bucket matched to the model's requests-per-minute quota,
+- retries quota (429), server errors and timeouts with jittered exponential backoff,
+- gives up once the call's deadline (AI_CALL_DEADLINE seconds, waits and retries included) has passed.
+  Each attempt gets the time left as its timeout, so no attempt runs past the deadline (async streams
+  are bounded while they are consumed too),
+- raises LLMUnavailable when a retryable error is still failing after the last retry or at the deadline;
+  other errors (bad requests, ...) are raised unchanged,
+- opens a circuit breaker after AI_BREAKER_FAILURES failed calls in a row. While it is open, calls fail
+  immediately with LLMUnavailable for AI_BREAKER_RESET seconds, then a single trial call decides
+  whether it closes again.
+
+Configuration (environment):
+- AI_RATE_LIMITS: requests per minute per model, e.g. "gemini-2.0-flash=2000,text-embedding-004=1500"
+  (models not listed use AI_DEFAULT_RPM)
+- AI_MAX_RETRIES, AI_RETRY_BASE_DELAY, AI_RETRY_MAX_DELAY: retry policy (seconds)
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+
+DEFAULT_RATE_LIMITS = {
+    "gemini-2.0-flash": 2000,
+    "gemini-2.0-flash-lite": 4000,
+    "text-embedding-004": 1500,
+}
+
+# Errors worth retrying: quota and transient server side failures
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def parse_rate_limits(value):
+    # "model=rpm,model=rpm" -> {model: rpm}
+    limits = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            model, rpm = item.split("=", 1)
+            limits[model.strip()] = float(rpm)
+    return limits
+
+
+def is_retryable(error):
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    # Timeouts and dropped connections (builtin or from the HTTP client)
+    return isinstance(error, (TimeoutError, ConnectionError)) or any(
+        name in type(error).__name__ for name in ("Timeout", "ConnectError", "RemoteProtocolError")
+    )
+
+
+class LLMUnavailable(Exception):
+    """The model can't be called right now (circuit open, or no slot/quota before the deadline)."""
+
+    def __init__(self, model, reason, retry_after=None):
+        super().__init__(f"{model} is unavailable: {reason}.")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `burst` saved up."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns how long to wait (seconds) before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self):
+        # Gives back a reserved token that won't be used
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failures` failed calls in a row. After `reset_timeout` seconds one trial call is let
+    through; its success closes the breaker, its failure opens it again. A trial that never reports
+    back (e.g. an abandoned stream) is replaced by a new one after another `reset_timeout`.
+    """
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            if self.trial_started is not None and now - self.trial_started < self.reset_timeout:
+                return False
+            self.trial_started = now
+            return True
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.opened_at is not None or self.consecutive_failures >= self.failures:
+                self.opened_at = time.monotonic()
+            self.trial_started = None
+
+
+class ModelLane:
+    """Concurrency limit, pacing and circuit breaker of one model."""
+
+    def __init__(self, model, max_concurrency, rpm, breaker_failures, breaker_reset):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        # A second's worth of requests may go out at once
+        self.bucket = TokenBucket(rpm / 60.0, max(1.0, rpm / 60.0))
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def async_semaphore(self):
+        # asyncio semaphores belong to one event loop
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._async_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    def stats(self):
+        return {
+            "state": self.breaker.state,
+            "calls": self.calls,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class Scheduler:
+    """
+    Runs API calls through the lane of their model (see the module docstring).
+    The blocking call() and stream() pass the seconds left before the deadline to func as its
+    `timeout` keyword argument; the async versions cancel the attempt at the deadline instead.
+    """
+
+    def __init__(self, max_concurrency=16, rate_limits=None, default_rpm=1000, max_retries=3, base_delay=0.5,
+                 max_delay=8.0, deadline=30.0, breaker_failures=5, breaker_reset=30.0):
+        self.max_concurrency = max_concurrency
+        self.rate_limits = {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}
+        self.default_rpm = default_rpm
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_concurrency=int(os.getenv("AI_MAX_CONCURRENCY", "16")),
+            rate_limits=parse_rate_limits(os.getenv("AI_RATE_LIMITS")),
+            default_rpm=float(os.getenv("AI_DEFAULT_RPM", "1000")),
+            max_retries=int(os.getenv("AI_MAX_RETRIES", "3")),
+            base_delay=float(os.getenv("AI_RETRY_BASE_DELAY", "0.5")),
+            max_delay=float(os.getenv("AI_RETRY_MAX_DELAY", "8")),
+            deadline=float(os.getenv("AI_CALL_DEADLINE", "30")),
+            breaker_failures=int(os.getenv("AI_BREAKER_FAILURES", "5")),
+            breaker_reset=float(os.getenv("AI_BREAKER_RESET", "30")),
+        )
+
+    def lane(self, model):
+        with self._lock:
+            lane = self._lanes.get(model)
+            if lane is None:
+                lane = self._lanes[model] = ModelLane(
+                    model, self.max_concurrency, self.rate_limits.get(model, self.default_rpm),
+                    self.breaker_failures, self.breaker_reset,
+                )
+            return lane
+
+    def backoff(self, attempt):
+        # Full jitter: uniform in [0, base * 2^attempt], capped
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def admit(self, lane):
+        if not lane.breaker.allow():
+            lane.rejected += 1
+            raise LLMUnavailable(lane.model, "circuit open", lane.breaker.retry_after())
+
+    def pacing_delay(self, lane, deadline):
+        # Waits for a rate token; fails fast if the quota can't be met before the deadline
+        wait = lane.bucket.reserve()
+        if time.monotonic() + wait >= deadline:
+            lane.bucket.refund()
+            lane.rejected += 1
+            raise LLMUnavailable(lane.model, "rate limit", wait)
+        return wait
+
+    def retry_delay(self, lane, error, attempt, deadline, can_retry=True):
+        """
+        Returns how long to wait before retrying after `error`, or None if it isn't retryable (the caller re-raises it).
+        Raises LLMUnavailable (from `error`) when a retryable error can't be retried any more: out of
+        attempts, past the deadline, or a stream that already yielded (can_retry=False).
+        Updates the breaker: only retryable errors count as failures, an answered request closes it.
+        """
+        if not is_retryable(error):
+            lane.breaker.record_success()
+            return None
+        delay = self.backoff(attempt)
+        if not can_retry or attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+            lane.failures += 1
+            lane.breaker.record_failure()
+            reason = f"{type(error).__name__} after {attempt + 1} attempt{'s' if attempt else ''}"
+            raise LLMUnavailable(lane.model, reason, lane.breaker.retry_after() or self.max_delay) from error
+        lane.retries += 1
+        return delay
+
+    def call(self, model, func, /, *args, **kwargs):
+        """Calls func(*args, **kwargs) for `model`, blocking while it waits for a slot, a token or a retry."""
+        lane = self.lane(model)
+        deadline = time.monotonic() + self.deadline
+        self.admit(lane)
+
+        if not lane.semaphore.acquire(timeout=self.deadline):
+            lane.rejected += 1
+            raise LLMUnavailable(model, "too many calls in flight")
+        try:
+            for attempt in range(self.max_retries + 1):
+                time.sleep(self.pacing_delay(lane, deadline))
+                lane.calls += 1
+                try:
+                    result = func(*args, timeout=deadline - time.monotonic(), **kwargs)
+                except Exception as e:
+                    delay = self.retry_delay(lane, e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    continue
+                lane.breaker.record_success()
+                return result
+        finally:
+            lane.semaphore.release()
+
+    def stream(self, model, func, /, *args, **kwargs):
+        """
+        Like call() for a function returning an iterator (generate_content_stream). The slot is held
+        until the stream is consumed; a failed stream is only retried if nothing was yielded yet.
+        """
+        lane = self.lane(model)
+        deadline = time.monotonic() + self.deadline
+        self.admit(lane)
+
+        if not lane.semaphore.acquire(timeout=self.deadline):
+            lane.rejected += 1
+            raise LLMUnavailable(model, "too many calls in flight")
+        try:
+            for attempt in range(self.max_retries + 1):
+                time.sleep(self.pacing_delay(lane, deadline))
+                lane.calls += 1
+                started = False
+                try:
+                    for item in func(*args, timeout=deadline - time.monotonic(), **kwargs):
+                        started = True
+                        yield item
+                except Exception as e:
+                    delay = self.retry_delay(lane, e, attempt, deadline, can_retry=not started)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    continue
+                lane.breaker.record_success()
+                return
+        finally:
+            lane.semaphore.release()
+
+    async def acall(self, model, func, /, *args, **kwargs):
+        """Async version of call(): func returns an awaitable, every attempt is bounded by the deadline."""
+        lane = self.lane(model)
+        deadline = time.monotonic() + self.deadline
+        self.admit(lane)
+
+        try:
+            await asyncio.wait_for(lane.async_semaphore().acquire(), self.deadline)
+        except asyncio.TimeoutError:
+            lane.rejected += 1
+            raise LLMUnavailable(model, "too many calls in flight")
+        try:
+            for attempt in range(self.max_retries + 1):
+                await asyncio.sleep(self.pacing_delay(lane, deadline))
+                lane.calls += 1
+                try:
+                    result = await asyncio.wait_for(func(*args, **kwargs), max(0.0, deadline - time.monotonic()))
+                except Exception as e:
+                    delay = self.retry_delay(lane, e, attempt, deadline)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                lane.breaker.record_success()
+                return result
+        finally:
+            lane.async_semaphore().release()
+
+    async def astream(self, model, func, /, *args, **kwargs):
+        """
+        Async version of stream(): func returns an awaitable that resolves to an async iterator.
+        The deadline bounds the whole stream, each chunk gets the time left.
+        """
+        lane = self.lane(model)
+        deadline = time.monotonic() + self.deadline
+        self.admit(lane)
+
+        try:
+            await asyncio.wait_for(lane.async_semaphore().acquire(), self.deadline)
+        except asyncio.TimeoutError:
+            lane.rejected += 1
+            raise LLMUnavailable(model, "too many calls in flight")
+        try:
+            for attempt in range(self.max_retries + 1):
+                await asyncio.sleep(self.pacing_delay(lane, deadline))
+                lane.calls += 1
+                started = False
+                try:
+                    chunks = aiter(await asyncio.wait_for(func(*args, **kwargs), max(0.0, deadline - time.monotonic())))
+                    while True:
+                        try:
+                            item = await asyncio.wait_for(anext(chunks), max(0.0, deadline - time.monotonic()))
+                        except StopAsyncIteration:
+                            break
+                        started = True
+                        yield item
+                except Exception as e:
+                    delay = self.retry_delay(lane, e, attempt, deadline, can_retry=not started)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                lane.breaker.record_success()
+                return
+        finally:
+            lane.async_semaphore().release()
+
+    def stats(self):
+        with self._lock:
+            return {model: lane.stats() for model, lane in self._lanes.items()}
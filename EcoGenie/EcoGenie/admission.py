@@ -0,0 +1,176 @@
+"""
+Admission control for the AI endpoints.
+
+Requests to the AI endpoint classes (chat, recommendations, home) share a pool of slots per worker.
+The pool is smaller than what the worker can serve, so the remaining slots stay free for the
+auth and profile endpoints even when every AI request is stuck waiting on Gemini.
+
+An AI request that finds the pool full waits for a slot. It is rejected right away (503 + Retry-After) if
+- too many requests are already waiting (MAX_QUEUE), or
+- recent requests of its class waited longer than MAX_QUEUE_WAIT on average,
+and rejected after waiting MAX_QUEUE_WAIT seconds without getting a slot.
+
+The counts are kept per process. A sync gunicorn worker serves one request at a time, so its pool is
+never contended and nothing is ever shed: run the app with threaded workers
+(gunicorn --worker-class gthread --threads N) or under ASGI (uvicorn), with WORKER_SLOTS set to the
+requests one worker serves at once (N for gthread).
+
+Configured by settings.ADMISSION_CONTROL (see EcoGenie/settings.py).
+"""
+import asyncio
+import math
+import threading
+import time
+
+
+class EndpointClassStats:
+    """In-flight work and (smoothed) queue wait and service time of one endpoint class."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.waiting = 0
+        self.avg_wait = 0.0
+        self.avg_service = 0.0
+        self.admitted = 0
+        self.rejected = 0
+
+    def as_dict(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "avg_wait": round(self.avg_wait, 3),
+            "avg_service": round(self.avg_service, 3),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class AdmissionController:
+    """
+    capacity: slots shared by the limited endpoint classes
+    classes: {name: [path prefixes]}; paths that match no class are never limited
+    """
+
+    # Weight of the newest sample in the moving averages
+    SMOOTHING = 0.2
+    # Async requests re-check for a free slot this often (seconds)
+    POLL_INTERVAL = 0.02
+
+    def __init__(self, capacity, classes, max_queue=16, max_queue_wait=2.0):
+        self.capacity = capacity
+        self.classes = classes
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+        self.in_flight = 0
+        self.waiting = 0
+        self.stats_by_class = {name: EndpointClassStats() for name in classes}
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_settings(cls, config):
+        capacity = max(1, config.get("WORKER_SLOTS", 16) - config.get("RESERVED_SLOTS", 4))
+        return cls(
+            capacity,
+            config.get("CLASSES", {}),
+            max_queue=config.get("MAX_QUEUE", 16),
+            max_queue_wait=config.get("MAX_QUEUE_WAIT", 2.0),
+        )
+
+    def classify(self, path):
+        for name, prefixes in self.classes.items():
+            if any(path.startswith(prefix) for prefix in prefixes):
+                return name
+        return None
+
+    def _average(self, average, sample):
+        return sample if average == 0 else average + self.SMOOTHING * (sample - average)
+
+    def _shed(self, stats):
+        # Reject without waiting: the queue is long or this class has been waiting too long lately
+        return self.waiting >= self.max_queue or stats.avg_wait > self.max_queue_wait
+
+    def _take(self, stats, waited):
+        self.in_flight += 1
+        stats.in_flight += 1
+        stats.admitted += 1
+        stats.avg_wait = self._average(stats.avg_wait, waited)
+
+    def _reject(self, stats, waited=None):
+        stats.rejected += 1
+        if waited is not None:
+            stats.avg_wait = self._average(stats.avg_wait, waited)
+        return False
+
+    def admit(self, name):
+        """Waits for a slot for a request of class `name`. Returns False if the request must be rejected."""
+        stats = self.stats_by_class[name]
+        started = time.monotonic()
+        with self._condition:
+            if self.in_flight < self.capacity:
+                self._take(stats, 0.0)
+                return True
+            if self._shed(stats):
+                return self._reject(stats)
+
+            self.waiting += 1
+            stats.waiting += 1
+            try:
+                admitted = self._condition.wait_for(lambda: self.in_flight < self.capacity, timeout=self.max_queue_wait)
+            finally:
+                self.waiting -= 1
+                stats.waiting -= 1
+
+            waited = time.monotonic() - started
+            if not admitted:
+                return self._reject(stats, waited)
+            self._take(stats, waited)
+            return True
+
+    async def aadmit(self, name):
+        """Async version of admit(), waits without blocking the event loop."""
+        stats = self.stats_by_class[name]
+        started = time.monotonic()
+        with self._condition:
+            if self.in_flight < self.capacity:
+                self._take(stats, 0.0)
+                return True
+            if self._shed(stats):
+                return self._reject(stats)
+            self.waiting += 1
+            stats.waiting += 1
+
+        try:
+            while time.monotonic() - started < self.max_queue_wait:
+                await asyncio.sleep(self.POLL_INTERVAL)
+                with self._condition:
+                    if self.in_flight < self.capacity:
+                        self._take(stats, time.monotonic() - started)
+                        return True
+        finally:
+            with self._condition:
+                self.waiting -= 1
+                stats.waiting -= 1
+
+        with self._condition:
+            return self._reject(stats, time.monotonic() - started)
+
+    def release(self, name, service_time):
+        stats = self.stats_by_class[name]
+        with self._condition:
+            self.in_flight -= 1
+            stats.in_flight -= 1
+            stats.avg_service = self._average(stats.avg_service, service_time)
+            self._condition.notify()
+
+    def retry_after(self, name):
+        # Roughly when a slot should be free again, in whole seconds
+        return max(1, math.ceil(self.stats_by_class[name].avg_service))
+
+    def stats(self):
+        with self._condition:
+            return {
+                "capacity": self.capacity,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "classes": {name: stats.as_dict() for name, stats in self.stats_by_class.items()},
+            }
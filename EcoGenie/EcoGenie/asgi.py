@@ -1,8 +1,18 @@
 """
-ASGI config for FirstDjango project.
+ASGI config for EcoGenie project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Under ASGI the async AI endpoints (api/async/..., see api/async_views.py) await their
+LLM calls on the event loop instead of holding a worker, so one process can serve
+hundreds of chats at once. Run it with uvicorn workers, from the EcoGenie directory:
+
+    gunicorn EcoGenie.asgi:application -k uvicorn.workers.UvicornWorker --workers 2
+
+or for development:
+
+    uvicorn EcoGenie.asgi:application --reload
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 """
@@ -11,6 +21,6 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'FirstDjango.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'EcoGenie.settings')
 
 application = get_asgi_application()
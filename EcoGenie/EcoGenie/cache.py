@@ -0,0 +1,67 @@
+"""
+Django cache backend on the SQLite file of AI/cache.py.
+
+Every worker process on the machine opens the same file, so what one worker stores the others
+read. It backs the "shared" cache (see settings.CACHES) when no REDIS_URL is configured:
+product search pages and Idempotency-Key records must be visible to whichever worker serves
+the next request, which the per-process LocMemCache can't do.
+
+Values are pickled. add() is atomic across processes (INSERT OR IGNORE).
+"""
+import pickle
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+from django.utils.connection import ConnectionProxy
+
+from AI.cache import CACHE_PATH, SQLiteCache
+
+
+class SQLiteSharedCache(BaseCache):
+    """LOCATION is the SQLite file (default: the AI cache file), OPTIONS['namespace'] its key prefix."""
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.store = SQLiteCache(
+            path=location or CACHE_PATH,
+            namespace=options.get('namespace', 'django'),
+            max_entries=self._max_entries,
+        )
+
+    def ttl(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else max(0, timeout)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self.store.add(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ttl=self.ttl(timeout))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        data = self.store.get(key)
+        return default if data is None else pickle.loads(data)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self.store.set(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ttl=self.ttl(timeout))
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        data = self.store.get(key)
+        if data is None:
+            return False
+        self.store.set(key, data, ttl=self.ttl(timeout))
+        return True
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self.store.delete(key)
+
+    def clear(self):
+        self.store.clear()
+
+
+# The "shared" cache, like django.core.cache.cache is the default one
+shared_cache = ConnectionProxy(caches, 'shared')
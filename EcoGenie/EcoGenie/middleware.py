@@ -1,12 +1,156 @@
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from django_ratelimit.middleware import RatelimitMiddleware as BaseRatelimitMiddleware
+
+from .admission import AdmissionController
+
+
+# Under ASGI a single sync-only middleware makes Django run every request in a thread,
+# which would take away the benefit of the async AI views. The middlewares below work both ways.
+
 class RemoveServerHeaderMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        response = self.get_response(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.strip_headers(self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.strip_headers(await self.get_response(request))
 
+    def strip_headers(self, response):
         # Strip identifying headers
         response.headers.pop('Server', None)
         response.headers.pop('X-Powered-By', None)
 
         return response
+
+
+class RatelimitMiddleware(BaseRatelimitMiddleware):
+    """django_ratelimit's middleware (turns Ratelimited into RATELIMIT_VIEW), usable under ASGI."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+
+class ReleasingStream:
+    """
+    Streaming content that calls `release` once, when it is exhausted or closed.
+    Django closes the response (and so this stream) when the client is gone too, even before the
+    first chunk, which a generator with a finally block would miss.
+    """
+
+    def __init__(self, content, release):
+        self.content = content
+        self.release = release
+        self.released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            yield from self.content
+        finally:
+            self.close()
+
+    def close(self):
+        with self._lock:
+            if self.released:
+                return
+            self.released = True
+        self.release()
+
+
+class AsyncReleasingStream(ReleasingStream):
+    """ReleasingStream for async streaming content (ASGI)."""
+
+    __iter__ = None
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.content:
+                yield chunk
+        finally:
+            self.close()
+
+
+class AdmissionControlMiddleware:
+    """
+    Sheds AI requests before they take a worker (see EcoGenie/admission.py).
+    Streaming responses keep their slot until the stream is closed.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.controller = AdmissionController.from_settings(getattr(settings, 'ADMISSION_CONTROL', {}))
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        endpoint_class = self.controller.classify(request.path)
+        if endpoint_class is None:
+            return self.get_response(request)
+        if not self.controller.admit(endpoint_class):
+            return self.overloaded(endpoint_class)
+
+        started = time.monotonic()
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self.controller.release(endpoint_class, time.monotonic() - started)
+            raise
+        return self.release_with(response, endpoint_class, started)
+
+    async def __acall__(self, request):
+        endpoint_class = self.controller.classify(request.path)
+        if endpoint_class is None:
+            return await self.get_response(request)
+        if not await self.controller.aadmit(endpoint_class):
+            return self.overloaded(endpoint_class)
+
+        started = time.monotonic()
+        try:
+            response = await self.get_response(request)
+        except BaseException:
+            self.controller.release(endpoint_class, time.monotonic() - started)
+            raise
+        return self.release_with(response, endpoint_class, started)
+
+    def release_with(self, response, endpoint_class, started):
+        def release():
+            self.controller.release(endpoint_class, time.monotonic() - started)
+
+        if response.streaming:
+            # The work happens while the body is streamed
+            stream_type = AsyncReleasingStream if response.is_async else ReleasingStream
+            response.streaming_content = stream_type(response.streaming_content, release)
+        else:
+            release()
+        return response
+
+    def overloaded(self, endpoint_class):
+        response = JsonResponse(
+            {'error': 'The service is busy right now. Please try again in a moment.', 'degraded': True},
+            status=503,
+        )
+        response['Retry-After'] = str(self.controller.retry_after(endpoint_class))
+        return response
@@ -87,6 +87,7 @@ RATELIMIT_VIEW = 'api.views.custom_ratelimit_exceeded'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'EcoGenie.middleware.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -94,11 +95,37 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'OrionEngine.middleware.LogUserIPMiddleware',
-    'django_ratelimit.middleware.RatelimitMiddleware',
+    'EcoGenie.middleware.RatelimitMiddleware',
     'EcoGenie.middleware.RemoveServerHeaderMiddleware',
     'django.middleware.security.SecurityMiddleware',
 ]
 
+# Admission control (see EcoGenie/admission.py). The AI endpoint classes share
+# WORKER_SLOTS - RESERVED_SLOTS concurrent requests per worker; the reserved slots keep auth and
+# profile endpoints responsive. Set WORKER_SLOTS to the number of requests a worker serves at once.
+# The counts are per process, so this needs gthread workers (WORKER_SLOTS = --threads) or ASGI;
+# with sync gunicorn workers (one request each) it never sheds anything.
+ADMISSION_CONTROL = {
+    'WORKER_SLOTS': int(os.getenv('ADMISSION_WORKER_SLOTS', '16')),
+    'RESERVED_SLOTS': int(os.getenv('ADMISSION_RESERVED_SLOTS', '4')),
+    'MAX_QUEUE': int(os.getenv('ADMISSION_MAX_QUEUE', '16')),
+    'MAX_QUEUE_WAIT': float(os.getenv('ADMISSION_MAX_QUEUE_WAIT', '2')),
+    'CLASSES': {
+        'ai_chat': ['/api/ai/chat/', '/api/async/ai/chat/'],
+        'ai_recommendations': ['/api/recommendations/', '/api/async/recommendations/'],
+        'ai_home': ['/api/userhome/', '/api/async/userhome/'],
+    },
+}
+
+# Chat compaction (see api/tasks.py). Once the messages after a session's last summary reach
+# AFTER_MESSAGES messages or AFTER_TOKENS tokens (estimated like the AI's context budget),
+# all but the KEEP_RECENT most recent ones are folded into the summary in the background.
+CHAT_COMPACTION = {
+    'AFTER_MESSAGES': int(os.getenv('CHAT_COMPACT_AFTER_MESSAGES', '30')),
+    'AFTER_TOKENS': int(os.getenv('CHAT_COMPACT_AFTER_TOKENS', '8000')),
+    'KEEP_RECENT': int(os.getenv('CHAT_KEEP_RECENT_MESSAGES', '6')),
+}
+
 ROOT_URLCONF = 'EcoGenie.urls'
 
 TEMPLATES = [
@@ -142,7 +169,17 @@ DATABASES = {
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+    },
+    # Seen by every worker: product search pages and Idempotency-Key records.
+    # Redis when REDIS_URL is set (needed with several hosts), otherwise the SQLite file
+    # of AI/cache.py, which all workers on this machine share (see EcoGenie/cache.py).
+    'shared': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL'),
+    } if os.getenv('REDIS_URL') else {
+        'BACKEND': 'EcoGenie.cache.SQLiteSharedCache',
+        'LOCATION': os.getenv('SHARED_CACHE_PATH', ''),
+    },
 }
 
 
@@ -1,3 +1,5 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
 from .utils import log_user_ip
 
 class LogUserIPMiddleware:
@@ -5,11 +7,28 @@ class LogUserIPMiddleware:
     Middleware to log IP address and endpoint for authenticated users.
     """
 
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.get_response(request)
+        self.log_request(request)
+        return response
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        # request.user may still be lazy (session lookup), so the check runs in a thread as well
+        await sync_to_async(self.log_request)(request)
+        return response
+
+    def log_request(self, request):
         # Log only if authenticated and it's not an admin panel request
         if request.user.is_authenticated and not request.path.startswith('/admin/'):
             try:
@@ -17,4 +36,3 @@ class LogUserIPMiddleware:
             except Exception as e:
                 # Avoid crashing even if logging fails
                 print(f"IP logging failed: {e}")
-        return response
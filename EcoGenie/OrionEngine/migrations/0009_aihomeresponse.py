@@ -0,0 +1,25 @@
+# Generated by Django 5.1.15 on 2026-10-17 16:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OrionEngine', '0008_userprofile_ai_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIHomeResponse',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('profile_hash', models.CharField(max_length=64)),
+                ('content', models.TextField()),
+                ('generated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ai_home_response', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
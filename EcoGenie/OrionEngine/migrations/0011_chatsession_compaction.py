@@ -0,0 +1,23 @@
+# Generated by Django 5.1.15 on 2026-10-17 16:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OrionEngine', '0010_chatsession_chatmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsession',
+            name='compacted_history',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='compacted_upto',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.db import models
 from django.utils.translation import gettext_lazy as _
@@ -170,6 +172,68 @@ class AI_UserProfile(models.Model):
         return f"AI Profile of {self.user.username}"
 
 
+class AIHomeResponse(models.Model):
+    """
+    Home screen suggestions generated in the background for a user.
+    profile_hash is the hash of the profile they were generated from; when it no longer
+    matches the current profile the suggestions are stale and get regenerated.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='ai_home_response'
+    )
+    profile_hash = models.CharField(max_length=64)
+    content = models.TextField()
+    generated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"AI home response of {self.user.email}"
+
+
+class ChatSession(models.Model):
+    """
+    A conversation between a user and the AI, stored server side so clients only send the new message.
+    Its messages are ChatMessage rows, which are only ever appended.
+
+    Long conversations are compacted in the background (see api.tasks): the messages up to and
+    including compacted_upto (a ChatMessage id) are replaced in the AI's history by compacted_history,
+    a summarized chat_history list. The messages themselves are kept.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='chat_sessions'
+    )
+    compacted_history = models.JSONField(default=list, blank=True)
+    compacted_upto = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Chat session {self.id} of {self.user.email}"
+
+
+class ChatMessage(models.Model):
+    ROLE_CHOICES = [
+        ('user', 'User'),
+        ('model', 'Model'),
+    ]
+
+    session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name='messages')
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # Messages are read in insertion order
+        ordering = ['id']
+
+    def __str__(self):
+        return f"{self.role} message in chat session {self.session_id}"
+
+
 
 class UserIPLog(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
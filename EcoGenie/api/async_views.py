@@ -0,0 +1,319 @@
+"""
+Async versions of the Gemini-bound endpoints, for ASGI deployments (see EcoGenie/asgi.py).
+
+The sync views in api.views hold a worker for the whole LLM call. These views await
+the async AI methods instead, so a single ASGI process can keep hundreds of LLM calls
+in flight. They take and return the same JSON as their sync counterparts and share
+their rate limit counters, caches and stored home responses.
+
+DRF's APIView is sync only, so these are plain Django async views: JWT authentication
+and rate limiting run in one thread hop before the handler, and the few database
+reads and writes go through sync_to_async.
+"""
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from django_ratelimit.core import is_ratelimited
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from EcoGenie.cache import shared_cache
+from OrionEngine.models import AIHomeResponse, ChatSession
+
+from .utils import get_effective_user_profile, profile_hash, recommendation_cache_key, save_chat_turn
+from .idempotency import aidempotent
+from .tasks import schedule_chat_compaction, schedule_home_refresh, store_home_response
+from .views import AI_UNAVAILABLE_MESSAGE, AIChatView, ProductRecommendationsView, UserHomeView, ai_unavailable, custom_ratelimit_exceeded
+
+from AI.AI import AI
+from AI.scheduler import LLMUnavailable
+
+
+# Requests carry a JWT, not a session cookie, so CSRF doesn't apply (same as DRF's APIView)
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAIView(View):
+    """
+    Base class of the async AI views: JWT authentication, rate limits and JSON bodies.
+    rate_limits maps an HTTP method to (group, limits); the views reuse their sync counterpart's table.
+    """
+    rate_limits = {}
+
+    def check_request(self, request):
+        """
+        Authenticates the request and applies the rate limits of its method.
+        Returns an error response, or None if the request may proceed.
+        """
+        try:
+            user_and_token = JWTAuthentication().authenticate(request)
+        except AuthenticationFailed as e:
+            detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+            return JsonResponse(detail, status=e.status_code)
+
+        if user_and_token is None:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+        request.user = user_and_token[0]
+
+        group, limits = self.rate_limits.get(request.method, (None, []))
+        for limit in limits:
+            if is_ratelimited(request, group=group, increment=True, **limit):
+                return custom_ratelimit_exceeded(request)
+        return None
+
+    async def dispatch(self, request, *args, **kwargs):
+        error_response = await sync_to_async(self.check_request)(request)
+        if error_response:
+            return error_response
+        return await super().dispatch(request, *args, **kwargs)
+
+    def parse_body(self, request):
+        # Raises ValueError if the body isn't a JSON object
+        data = json.loads(request.body or b'{}')
+        if not isinstance(data, dict):
+            raise ValueError('Request body must be a JSON object.')
+        return data
+
+
+# Async version of views.UserHomeView
+class AsyncUserHomeView(AsyncAIView):
+    rate_limits = UserHomeView.rate_limits
+
+    def load_home(self, user):
+        user_profile_data = get_effective_user_profile(user)
+        stored = AIHomeResponse.objects.filter(user=user).first()
+        return user_profile_data, stored
+
+    async def get(self, request):
+        try:
+            user_profile_data, stored = await sync_to_async(self.load_home)(request.user)
+
+            if not user_profile_data:
+                return JsonResponse({"error": "User profile not found."}, status=404)
+
+            # Serve the suggestions generated in the background (see api.tasks)
+            current_hash = profile_hash(user_profile_data)
+            if stored:
+                stale = stored.profile_hash != current_hash
+                if stale:
+                    schedule_home_refresh(request.user.pk)
+                return JsonResponse({"home_response": stored.content, "stale": stale})
+
+            # Nothing generated yet (first visit): send to AI and store the result
+            ai_response = await AI.aAI_home_response(user_profile=user_profile_data)
+            await sync_to_async(store_home_response)(request.user, current_hash, ai_response)
+
+            return JsonResponse({"home_response": ai_response, "stale": False})
+
+        except LLMUnavailable as e:
+            return ai_unavailable(e)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+
+
+# Async version of views.AIChatView. Session handling is shared with the sync view.
+class AsyncAIChatView(AsyncAIView):
+    rate_limits = AIChatView.rate_limits
+
+    sync_view = AIChatView()
+
+    async def event_stream(self, request, chat_history, user_profile_data, session=None, message=None, cache_options=None):
+        # Same events as AIChatView.event_stream
+        new_profile = None
+        reply = []
+        try:
+            async for event in AI.astream_response(chat_history=chat_history, user_profile=user_profile_data, **(cache_options or {})):
+                if event["type"] == "profile":
+                    new_profile = event["new_profile"]
+                    continue
+                reply.append(event["text"])
+                yield f"data: {json.dumps(event)}\n\n"
+
+            if new_profile is not None:
+                await sync_to_async(self.sync_view.save_new_profile)(request.user, new_profile)
+
+            done = {'type': 'done'}
+            if message is not None:
+                session = await sync_to_async(save_chat_turn)(request.user, session, message, "".join(reply))
+                done['session_id'] = str(session.pk)
+                schedule_chat_compaction(session.pk)
+
+            yield f"data: {json.dumps(done)}\n\n"
+
+        except LLMUnavailable:
+            yield f"data: {json.dumps({'type': 'error', 'error': AI_UNAVAILABLE_MESSAGE, 'degraded': True})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+
+    def load_chat(self, user, data):
+        # Session history, profile and cache options in one thread hop
+        chat_history, session, message = self.sync_view.load_chat(user, data)
+        return chat_history, session, message, get_effective_user_profile(user), self.sync_view.cache_options(data)
+
+    async def post(self, request):
+        try:
+            data = self.parse_body(request)
+        except ValueError as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        return await aidempotent(request, 'ai_chat', data, lambda: self.process_post(request, data))
+
+    async def process_post(self, request, data):
+        try:
+            try:
+                chat_history, session, message, user_profile_data, cache_options = await sync_to_async(self.load_chat)(request.user, data)
+            except ValueError as e:
+                return JsonResponse({"error": str(e)}, status=400)
+            except ChatSession.DoesNotExist:
+                return JsonResponse({"error": "Chat session not found."}, status=404)
+
+            if not user_profile_data:
+                return JsonResponse({"error": "User profile not found."}, status=404)
+
+            if data.get("stream"):
+                response = StreamingHttpResponse(
+                    self.event_stream(request, chat_history, user_profile_data, session, message, cache_options),
+                    content_type='text/event-stream',
+                )
+                response['Cache-Control'] = 'no-cache'
+                response['X-Accel-Buffering'] = 'no'
+                return response
+
+            ai_response_data = await AI.aget_response(chat_history=chat_history, user_profile=user_profile_data, **cache_options)
+
+            #Save new AI profile if returned
+            if "new_profile" in ai_response_data:
+                await sync_to_async(self.sync_view.save_new_profile)(request.user, ai_response_data["new_profile"])
+
+            response_data = {"ai_response": ai_response_data.get("response")}
+            if message is not None:
+                session = await sync_to_async(save_chat_turn)(request.user, session, message, ai_response_data.get("response") or "")
+                response_data["session_id"] = str(session.pk)
+                schedule_chat_compaction(session.pk)
+
+            return JsonResponse(response_data)
+
+        except LLMUnavailable as e:
+            return ai_unavailable(e, ai_response=AI_UNAVAILABLE_MESSAGE)
+        except Exception as e:
+            return JsonResponse({"error": str(e)}, status=500)
+
+
+# Async version of views.ProductRecommendationsView.
+# Pagination, cache keys and product cleaning are shared with the sync view.
+class AsyncProductRecommendationsView(AsyncAIView):
+    rate_limits = ProductRecommendationsView.rate_limits
+
+    sync_view = ProductRecommendationsView()
+
+    async def start_search(self, request, query):
+        if isinstance(query, list):
+            ranked_ids = await AI.arank_products_batch(query, self.sync_view.MAX_RESULTS)
+        else:
+            ranked_ids = await AI.arank_products(query, self.sync_view.MAX_RESULTS)
+        search_id = uuid.uuid4().hex
+        await shared_cache.aset(self.sync_view.search_cache_key(request, search_id), ranked_ids, timeout=self.sync_view.SEARCH_TIMEOUT)
+        return search_id, ranked_ids
+
+    async def page_response(self, search_id, ranked_ids, page, page_size):
+        start = (page - 1) * page_size
+        products = await sync_to_async(AI.products_from_indices, thread_sensitive=False)(ranked_ids[start:start + page_size])
+        return JsonResponse({
+            "products": self.sync_view.clean_products(products),
+            "search_id": search_id,
+            "page": page,
+            "page_size": page_size,
+            "has_more": start + page_size < len(ranked_ids),
+        })
+
+    async def cached_page(self, request, params):
+        # Same as ProductRecommendationsView.cached_page
+        search_id = params.get('search_id')
+        if not search_id:
+            return None
+
+        page, page_size = self.sync_view.get_page_params(params)
+        ranked_ids = await shared_cache.aget(self.sync_view.search_cache_key(request, search_id))
+        if ranked_ids is None:
+            return JsonResponse({'error': 'Search expired. Please search again.'}, status=410)
+        return await self.page_response(search_id, ranked_ids, page, page_size)
+
+    async def get(self, request):
+        try:
+            try:
+                cached_response = await self.cached_page(request, request.GET)
+                if cached_response:
+                    return cached_response
+                page, page_size = self.sync_view.get_page_params(request.GET)
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+
+            user_profile_data = await sync_to_async(get_effective_user_profile)(request.user)
+            if not user_profile_data:
+                return JsonResponse({"error": "User profile not found."}, status=404)
+
+            # Reuse the ranking for this exact profile if we have one
+            current_hash = profile_hash(user_profile_data)
+            cache_key = recommendation_cache_key(request.user.pk)
+            cached = await cache.aget(cache_key)
+
+            if cached and cached["profile_hash"] == current_hash:
+                search_id, ranked_ids = cached["search_id"], cached["ranked_ids"]
+                await shared_cache.aset(self.sync_view.search_cache_key(request, search_id), ranked_ids, timeout=self.sync_view.SEARCH_TIMEOUT)
+            else:
+                generated_query = await AI.aget_product_query_from_profile(user_profile_data)
+                search_id, ranked_ids = await self.start_search(request, generated_query)
+                await cache.aset(cache_key, {
+                    "profile_hash": current_hash,
+                    "search_id": search_id,
+                    "ranked_ids": ranked_ids,
+                }, timeout=self.sync_view.RECOMMENDATION_TIMEOUT)
+
+            return await self.page_response(search_id, ranked_ids, page, page_size)
+
+        except LLMUnavailable as e:
+            return ai_unavailable(e)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
+
+    async def post(self, request):
+        try:
+            data = self.parse_body(request)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return await aidempotent(request, 'product_search', data, lambda: self.process_post(request, data))
+
+    async def process_post(self, request, data):
+        try:
+            try:
+                cached_response = await self.cached_page(request, data)
+                if cached_response:
+                    return cached_response
+                page, page_size = self.sync_view.get_page_params(data)
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+
+            query = data.get('query', '')
+            queries = data.get('queries', [])
+
+            if queries:
+                if not isinstance(queries, list) or not all(isinstance(q, str) and q for q in queries):
+                    return JsonResponse({'error': 'queries must be a list of non-empty strings.'}, status=400)
+
+                search_id, ranked_ids = await self.start_search(request, queries)
+                return await self.page_response(search_id, ranked_ids, page, page_size)
+
+            if not query:
+                return JsonResponse({'error': 'Query field is required.'}, status=400)
+
+            paraphrased_query = await AI.aparaphrase_query(query)
+            search_id, ranked_ids = await self.start_search(request, paraphrased_query)
+            return await self.page_response(search_id, ranked_ids, page, page_size)
+
+        except LLMUnavailable as e:
+            return ai_unavailable(e)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=500)
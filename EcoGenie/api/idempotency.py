@@ -0,0 +1,208 @@
+"""
+Idempotency-Key support for the AI POST endpoints.
+
+A client that retries a request sends the same Idempotency-Key header. The first request with a key
+runs normally and its response is stored for IDEMPOTENCY_TTL. A retry that arrives while the original
+is still running waits for it, and a retry that arrives after it finished gets the stored response,
+so retries never repeat the generation or the tool calls.
+
+- Keys are scoped per user and endpoint, and bound to the request body: reusing a key with a different body is a 422.
+- Server errors (5xx), rate limited requests (429) and streams that ended with an error event
+  are not stored, so a retry runs the request again.
+- Streamed (Server-Sent Events) responses are stored event by event and replayed as a stream.
+
+Records live in the shared cache (EcoGenie/cache.py: Redis, or a SQLite file every worker opens),
+so a retry is coalesced whichever worker serves it.
+"""
+import asyncio
+import hashlib
+import json
+import time
+
+from django.http import JsonResponse, StreamingHttpResponse
+
+from EcoGenie.cache import shared_cache
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+IDEMPOTENCY_TTL = 86400  # 1 day
+# A pending marker outlives any request, so a crashed worker can't block a key forever
+PENDING_TTL = 300
+# How long a retry waits for the original request, and how often it checks
+WAIT_TIMEOUT = 120
+POLL_INTERVAL = 0.1
+
+
+class IdempotentRequest:
+    """The Idempotency-Key of one request, with its cache record."""
+
+    def __init__(self, user, scope, key, data):
+        self.cache_key = 'idempotency_' + hashlib.sha256(f'{user.pk}\x1f{scope}\x1f{key}'.encode('utf-8')).hexdigest()
+        self.fingerprint = hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_request(cls, request, scope, data):
+        """Returns None if the request has no Idempotency-Key. Raises ValueError for an invalid key."""
+        key = request.headers.get(HEADER)
+        if key is None:
+            return None
+        if not key.strip() or len(key) > MAX_KEY_LENGTH:
+            raise ValueError(f'{HEADER} must be 1 to {MAX_KEY_LENGTH} characters.')
+        return cls(request.user, scope, key, data)
+
+    def pending_record(self):
+        return {'state': 'pending', 'fingerprint': self.fingerprint}
+
+    def check(self, record):
+        """
+        Response for a request whose key is already taken, or None to keep waiting for it.
+        A vanished record (expired marker) is treated like a finished request without a stored response.
+        """
+        if record is None:
+            return JsonResponse({'error': 'The original request did not complete. Please retry.'}, status=409)
+        if record['fingerprint'] != self.fingerprint:
+            return JsonResponse({'error': f'{HEADER} was already used for a different request.'}, status=422)
+        if record['state'] == 'done':
+            return replay(record)
+        return None
+
+    def record_response(self, response):
+        """Stores a finished response, or drops the key if it must not be replayed. Returns the response."""
+        if not replayable(response):
+            shared_cache.delete(self.cache_key)
+        elif response.streaming:
+            response.streaming_content = self.record_stream(response, response.streaming_content)
+        else:
+            shared_cache.set(self.cache_key, self.done_record(response), timeout=IDEMPOTENCY_TTL)
+        return response
+
+    async def arecord_response(self, response):
+        """Async version of record_response."""
+        if not replayable(response):
+            await shared_cache.adelete(self.cache_key)
+        elif response.streaming:
+            response.streaming_content = self.arecord_stream(response, response.streaming_content)
+        else:
+            await shared_cache.aset(self.cache_key, self.done_record(response), timeout=IDEMPOTENCY_TTL)
+        return response
+
+    def done_record(self, response, events=None):
+        record = {'state': 'done', 'fingerprint': self.fingerprint, 'status': response.status_code}
+        if events is not None:
+            record['events'] = events
+            record['content_type'] = response['Content-Type']
+        else:
+            # DRF responses keep their data, plain Django responses only have the rendered body
+            record['body'] = response.data if hasattr(response, 'data') else json.loads(response.content or b'null')
+        return record
+
+    def record_stream(self, response, content):
+        # A stream the client dropped (GeneratorExit) or that raised is not stored, so a retry runs it again
+        events = []
+        completed = False
+        try:
+            for chunk in content:
+                events.append(chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk)
+                yield chunk
+            completed = not stream_failed(events)
+        finally:
+            if completed:
+                shared_cache.set(self.cache_key, self.done_record(response, events), timeout=IDEMPOTENCY_TTL)
+            else:
+                shared_cache.delete(self.cache_key)
+
+    async def arecord_stream(self, response, content):
+        events = []
+        completed = False
+        try:
+            async for chunk in content:
+                events.append(chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk)
+                yield chunk
+            completed = not stream_failed(events)
+        finally:
+            if completed:
+                await shared_cache.aset(self.cache_key, self.done_record(response, events), timeout=IDEMPOTENCY_TTL)
+            else:
+                await shared_cache.adelete(self.cache_key)
+
+
+def replayable(response):
+    return response.status_code < 500 and response.status_code != 429
+
+
+def stream_failed(events):
+    # The chat streams report failures as a final {"type": "error"} event
+    return not events or '"type": "error"' in events[-1]
+
+
+def replay(record):
+    if 'events' in record:
+        response = StreamingHttpResponse(iter(record['events']), content_type=record['content_type'], status=record['status'])
+        response['Cache-Control'] = 'no-cache'
+    else:
+        response = JsonResponse(record['body'], status=record['status'], safe=False)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def invalid_key(error):
+    return JsonResponse({'error': str(error)}, status=400)
+
+
+def idempotent(request, scope, data, handler):
+    """
+    Runs handler() (which returns the response) at most once per Idempotency-Key.
+    Requests without the header just run the handler.
+    """
+    try:
+        idempotent_request = IdempotentRequest.from_request(request, scope, data)
+    except ValueError as e:
+        return invalid_key(e)
+    if idempotent_request is None:
+        return handler()
+
+    # Only one request may take the key; the others wait for its response
+    if not shared_cache.add(idempotent_request.cache_key, idempotent_request.pending_record(), timeout=PENDING_TTL):
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while True:
+            response = idempotent_request.check(shared_cache.get(idempotent_request.cache_key))
+            if response is not None:
+                return response
+            if time.monotonic() >= deadline:
+                return JsonResponse({'error': 'The original request is still in progress.'}, status=409)
+            time.sleep(POLL_INTERVAL)
+
+    try:
+        response = handler()
+    except BaseException:
+        shared_cache.delete(idempotent_request.cache_key)
+        raise
+    return idempotent_request.record_response(response)
+
+
+async def aidempotent(request, scope, data, handler):
+    """Async version of idempotent(): handler is an async function."""
+    try:
+        idempotent_request = IdempotentRequest.from_request(request, scope, data)
+    except ValueError as e:
+        return invalid_key(e)
+    if idempotent_request is None:
+        return await handler()
+
+    if not await shared_cache.aadd(idempotent_request.cache_key, idempotent_request.pending_record(), timeout=PENDING_TTL):
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while True:
+            response = idempotent_request.check(await shared_cache.aget(idempotent_request.cache_key))
+            if response is not None:
+                return response
+            if time.monotonic() >= deadline:
+                return JsonResponse({'error': 'The original request is still in progress.'}, status=409)
+            await asyncio.sleep(POLL_INTERVAL)
+
+    try:
+        response = await handler()
+    except BaseException:
+        await shared_cache.adelete(idempotent_request.cache_key)
+        raise
+
+    return await idempotent_request.arecord_response(response)
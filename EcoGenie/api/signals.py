@@ -0,0 +1,23 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from OrionEngine.models import UserProfile
+
+from .tasks import schedule_home_refresh
+from .utils import recommendation_cache_key
+
+
+# Survey answers or ai_profile changed: drop the cached profile recommendations right away.
+# (Entries are also keyed by profile hash, so a missed signal can never serve stale results.)
+@receiver(post_save, sender=UserProfile)
+def invalidate_recommendations(sender, instance, **kwargs):
+    cache.delete(recommendation_cache_key(instance.user_id))
+
+
+# Survey submitted or ai_profile changed: regenerate the home suggestions in the background,
+# once the new profile is committed, so the next home screen load is served instantly.
+@receiver(post_save, sender=UserProfile)
+def refresh_home_response(sender, instance, **kwargs):
+    transaction.on_commit(lambda: schedule_home_refresh(instance.user_id))
@@ -0,0 +1,151 @@
+"""
+Background AI work that must not block a request.
+
+Tasks run on a small in-process thread pool. Each task is keyed, so the same work
+(e.g. regenerating one user's home suggestions) is never queued twice at once.
+AI profile saves run on their own thread, see schedule_profile_save.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+
+from OrionEngine.models import AIHomeResponse, ChatSession, UserProfile
+
+from AI.AI import AI
+from AI.context import estimate_tokens
+
+from .utils import get_effective_user_profile, profile_hash
+
+logger = logging.getLogger(__name__)
+
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ai-background')
+
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def run_in_background(key, func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) on the background pool unless a task with the same key is already queued.
+    Returns True if the task was queued.
+    """
+    with _pending_lock:
+        if key in _pending:
+            return False
+        _pending.add(key)
+
+    def task():
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            # Background failures must never surface in a request
+            logger.exception("Background task %s failed", key)
+        finally:
+            with _pending_lock:
+                _pending.discard(key)
+            # Threads outside the request cycle have to release their DB connections themselves
+            close_old_connections()
+
+    executor.submit(task)
+    return True
+
+
+def store_home_response(user, current_hash, content):
+    AIHomeResponse.objects.update_or_create(
+        user=user,
+        defaults={"profile_hash": current_hash, "content": content},
+    )
+
+
+def refresh_home_response(user_id):
+    """Regenerates a user's home suggestions if the stored copy doesn't match the current profile."""
+    user = get_user_model().objects.select_related('profile').get(pk=user_id)
+    user_profile_data = get_effective_user_profile(user)
+    if not user_profile_data:
+        return
+
+    current_hash = profile_hash(user_profile_data)
+    if AIHomeResponse.objects.filter(user=user, profile_hash=current_hash).exists():
+        return
+
+    content = AI.AI_home_response(user_profile=user_profile_data)
+    store_home_response(user, current_hash, content)
+
+
+def schedule_home_refresh(user_id):
+    return run_in_background(f'home_response_{user_id}', refresh_home_response, user_id)
+
+
+# Profile saves are cheap DB writes, so they get their own thread instead of queueing behind
+# the LLM-bound tasks above. One thread runs them in order, and only the latest profile of a
+# user is kept while a save is pending, so an older profile can never overwrite a newer one.
+profile_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profile-save')
+
+_pending_profiles = {}  # user_id -> newest profile not saved yet
+
+
+def save_ai_profile(user_id, new_profile):
+    # save() rather than update(), so the profile signals (cache invalidation, home refresh) still run
+    profile = UserProfile.objects.get(user_id=user_id)
+    profile.ai_profile = new_profile
+    profile.save()
+
+
+def save_pending_profile(user_id):
+    with _pending_lock:
+        new_profile = _pending_profiles.pop(user_id)
+    try:
+        save_ai_profile(user_id, new_profile)
+    except Exception:
+        logger.exception("Saving the AI profile of user %s failed", user_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_profile_save(user_id, new_profile):
+    """Saves new_profile in the background. Returns False if it replaced a save still pending for the user."""
+    with _pending_lock:
+        queued = user_id in _pending_profiles
+        _pending_profiles[user_id] = new_profile
+    if not queued:
+        profile_executor.submit(save_pending_profile, user_id)
+    return not queued
+
+
+def compact_chat_session(session_id):
+    """
+    Folds the older messages of a long chat session into its compacted history,
+    once they pass one of the settings.CHAT_COMPACTION thresholds.
+    """
+    config = settings.CHAT_COMPACTION
+    session = ChatSession.objects.get(pk=session_id)
+    messages = list(session.messages.filter(id__gt=session.compacted_upto).values_list('id', 'role', 'content'))
+
+    if (len(messages) < config['AFTER_MESSAGES']
+            and sum(estimate_tokens(content) for _, _, content in messages) < config['AFTER_TOKENS']):
+        return
+
+    keep_recent = config['KEEP_RECENT']
+    folded = messages[:-keep_recent] if keep_recent else messages
+    # End on a model message, so the kept messages start with the user's turn
+    while folded and folded[-1][1] != 'model':
+        folded.pop()
+    if not folded:
+        return
+
+    history = list(session.compacted_history) + [{"role": role, "parts": content} for _, role, content in folded]
+    compacted_history = AI.compact_chat(history)
+
+    # Only store it if no other compaction got there first
+    ChatSession.objects.filter(pk=session.pk, compacted_upto=session.compacted_upto).update(
+        compacted_history=compacted_history,
+        compacted_upto=folded[-1][0],
+    )
+
+
+def schedule_chat_compaction(session_id):
+    return run_in_background(f'chat_compaction_{session_id}', compact_chat_session, session_id)
@@ -1,3 +1,716 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import uuid
+from datetime import date
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from EcoGenie.admission import AdmissionController
+from EcoGenie.cache import SQLiteSharedCache, shared_cache
+from EcoGenie.middleware import AdmissionControlMiddleware
+from OrionEngine.models import AIHomeResponse, ChatMessage, ChatSession, UserProfile
+
+from . import tasks
+from .idempotency import IdempotentRequest, idempotent
+from .utils import chat_session_history, profile_hash, recommendation_cache_key, save_chat_turn
+from .views import AdminAIStatsView, AIChatView, ProductRecommendationsView
+
+from AI.AI import AI
+
+
+class SQLiteSharedCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'shared.sqlite3')
+
+    def worker_cache(self):
+        # Each worker process builds its own backend instance on the same file
+        return SQLiteSharedCache(self.path, {'TIMEOUT': 600})
+
+    def test_values_are_shared_between_instances(self):
+        first, second = self.worker_cache(), self.worker_cache()
+        first.set('search', [3, 1, 2])
+        self.assertEqual(second.get('search'), [3, 1, 2])
+        self.assertTrue(second.delete('search'))
+        self.assertIsNone(first.get('search'))
+
+    def test_add_only_stores_missing_keys(self):
+        first, second = self.worker_cache(), self.worker_cache()
+        self.assertTrue(first.add('key', 'first'))
+        self.assertFalse(second.add('key', 'second'))
+        self.assertEqual(second.get('key'), 'first')
+
+    def test_expired_values_are_gone(self):
+        cache = self.worker_cache()
+        cache.set('key', 'value', timeout=0)
+        self.assertIsNone(cache.get('key'))
+        self.assertTrue(cache.add('key', 'new'))
+
+
+class ProfileSaveTests(SimpleTestCase):
+
+    def test_only_the_latest_pending_profile_is_saved(self):
+        started, release = threading.Event(), threading.Event()
+        saved = []
+
+        def save(user_id, new_profile):
+            saved.append(new_profile)
+            started.set()
+            release.wait(5)
+
+        with mock.patch.object(tasks, 'save_ai_profile', side_effect=save):
+            self.assertTrue(tasks.schedule_profile_save(1, 'first'))
+            started.wait(5)
+            self.assertTrue(tasks.schedule_profile_save(1, 'second'))
+            self.assertFalse(tasks.schedule_profile_save(1, 'third'))
+            release.set()
+            tasks.profile_executor.submit(lambda: None).result(5)
+
+        self.assertEqual(saved, ['first', 'third'])
+
+
+class AdmissionControllerTests(SimpleTestCase):
+
+    def controller(self, capacity=2, **options):
+        return AdmissionController(capacity, {'ai_chat': ['/api/ai/chat/']}, **options)
+
+    def test_classifies_by_path_prefix(self):
+        controller = self.controller()
+        self.assertEqual(controller.classify('/api/ai/chat/'), 'ai_chat')
+        self.assertIsNone(controller.classify('/api/profile/'))
+
+    def test_admits_up_to_capacity(self):
+        controller = self.controller(max_queue_wait=0.05)
+        self.assertTrue(controller.admit('ai_chat'))
+        self.assertTrue(controller.admit('ai_chat'))
+        # Full: waits MAX_QUEUE_WAIT, then gives up
+        self.assertFalse(controller.admit('ai_chat'))
+        stats = controller.stats()['classes']['ai_chat']
+        self.assertEqual((stats['in_flight'], stats['admitted'], stats['rejected']), (2, 2, 1))
+
+    def test_sheds_without_waiting_when_the_queue_is_full(self):
+        controller = self.controller(capacity=1, max_queue=0, max_queue_wait=5)
+        self.assertTrue(controller.admit('ai_chat'))
+        self.assertFalse(controller.admit('ai_chat'))
+        self.assertEqual(controller.stats()['classes']['ai_chat']['avg_wait'], 0)
+
+    def test_release_hands_the_slot_to_a_waiting_request(self):
+        controller = self.controller(capacity=1, max_queue_wait=5)
+        controller.admit('ai_chat')
+        results = []
+        waiter = threading.Thread(target=lambda: results.append(controller.admit('ai_chat')))
+        waiter.start()
+        while controller.stats()['waiting'] == 0:
+            threading.Event().wait(0.01)
+        controller.release('ai_chat', 2.5)
+        waiter.join(5)
+        self.assertEqual(results, [True])
+        self.assertEqual(controller.retry_after('ai_chat'), 3)
+
+    def test_async_admit_waits_for_a_slot(self):
+        controller = self.controller(capacity=1, max_queue_wait=5)
+        controller.admit('ai_chat')
+
+        async def admit_after_release():
+            waiting = asyncio.ensure_future(controller.aadmit('ai_chat'))
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+            controller.release('ai_chat', 0.1)
+            return await waiting
+
+        self.assertTrue(asyncio.run(admit_after_release()))
+
+
+class AdmissionControlMiddlewareTests(SimpleTestCase):
+
+    ADMISSION_CONTROL = {'WORKER_SLOTS': 2, 'RESERVED_SLOTS': 1, 'CLASSES': {'ai_chat': ['/api/ai/chat/']}}
+
+    def middleware(self, response):
+        with self.settings(ADMISSION_CONTROL=self.ADMISSION_CONTROL):
+            return AdmissionControlMiddleware(lambda request: response)
+
+    def in_flight(self, middleware):
+        return middleware.controller.stats()['in_flight']
+
+    def request(self):
+        return RequestFactory().post('/api/ai/chat/')
+
+    def test_plain_responses_release_right_away(self):
+        middleware = self.middleware(HttpResponse('ok'))
+        middleware(self.request())
+        self.assertEqual(self.in_flight(middleware), 0)
+
+    def test_sheds_with_retry_after(self):
+        middleware = self.middleware(StreamingHttpResponse(iter(['a'])))
+        middleware(self.request())
+        response = middleware(self.request())
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+    def test_streams_release_when_exhausted(self):
+        middleware = self.middleware(StreamingHttpResponse(iter(['a', 'b'])))
+        response = middleware(self.request())
+        self.assertEqual(self.in_flight(middleware), 1)
+        self.assertEqual(b''.join(response), b'ab')
+        self.assertEqual(self.in_flight(middleware), 0)
+        response.close()
+        self.assertEqual(self.in_flight(middleware), 0)
+
+    def test_streams_release_when_closed_before_the_first_chunk(self):
+        middleware = self.middleware(StreamingHttpResponse(iter(['a', 'b'])))
+        middleware(self.request()).close()
+        self.assertEqual(self.in_flight(middleware), 0)
+
+    def test_async_streams_release_when_exhausted(self):
+        async def chunks():
+            yield 'a'
+            yield 'b'
+
+        middleware = self.middleware(StreamingHttpResponse(chunks()))
+        response = middleware(self.request())
+        self.assertTrue(response.is_async)
+
+        async def read():
+            return b''.join([chunk async for chunk in response])
+
+        self.assertEqual(asyncio.run(read()), b'ab')
+        self.assertEqual(self.in_flight(middleware), 0)
+
+
+class IdempotencyTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        shared = {'BACKEND': 'EcoGenie.cache.SQLiteSharedCache', 'LOCATION': os.path.join(directory.name, 'shared.sqlite3')}
+        overridden = self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}, 'shared': shared})
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        self.calls = 0
+
+    def request(self, key='retry-1', user_id=1):
+        request = RequestFactory().post('/api/ai/chat/', headers={'Idempotency-Key': key})
+        request.user = SimpleNamespace(pk=user_id)
+        return request
+
+    def handler(self, response):
+        def handle():
+            self.calls += 1
+            return response() if callable(response) else response
+        return handle
+
+    def stream(self, *events):
+        return lambda: StreamingHttpResponse(iter(events), content_type='text/event-stream')
+
+    def test_retries_get_the_stored_response(self):
+        handler = self.handler(lambda: JsonResponse({'reply': 'hi'}))
+        idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        replayed = idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(replayed.content, b'{"reply": "hi"}')
+
+    def test_keys_are_scoped_per_user(self):
+        handler = self.handler(lambda: JsonResponse({'reply': 'hi'}))
+        idempotent(self.request(user_id=1), 'ai_chat', {'message': 'hi'}, handler)
+        idempotent(self.request(user_id=2), 'ai_chat', {'message': 'hi'}, handler)
+        self.assertEqual(self.calls, 2)
+
+    def test_a_key_reused_for_another_body_is_rejected(self):
+        handler = self.handler(lambda: JsonResponse({'reply': 'hi'}))
+        idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        response = idempotent(self.request(), 'ai_chat', {'message': 'bye'}, handler)
+        self.assertEqual(response.status_code, 422)
+
+    def test_server_errors_are_not_stored(self):
+        handler = self.handler(lambda: JsonResponse({'error': 'down'}, status=503))
+        idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        self.assertEqual(self.calls, 2)
+
+    def test_finished_streams_are_replayed(self):
+        handler = self.handler(self.stream('data: a\n\n', 'data: b\n\n'))
+        response = idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        self.assertEqual(b''.join(response), b'data: a\n\ndata: b\n\n')
+        replayed = idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(b''.join(replayed), b'data: a\n\ndata: b\n\n')
+
+    def test_dropped_streams_free_the_key(self):
+        handler = self.handler(self.stream('data: a\n\n', 'data: b\n\n'))
+        response = idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        next(iter(response))
+        # The client disconnects after the first event
+        response.close()
+        idempotent(self.request(), 'ai_chat', {'message': 'hi'}, handler)
+        self.assertEqual(self.calls, 2)
+
+    def test_async_dropped_streams_free_the_key(self):
+        async def events():
+            yield 'data: a\n\n'
+            yield 'data: b\n\n'
+
+        idempotent_request = IdempotentRequest(SimpleNamespace(pk=1), 'ai_chat', 'retry-1', {'message': 'hi'})
+        shared_cache.add(idempotent_request.cache_key, idempotent_request.pending_record())
+        response = StreamingHttpResponse(content_type='text/event-stream')
+
+        async def drop():
+            stream = idempotent_request.arecord_stream(response, events())
+            await stream.__anext__()
+            # The client disconnects after the first event
+            await stream.aclose()
+
+        asyncio.run(drop())
+        self.assertIsNone(shared_cache.get(idempotent_request.cache_key))
+
+
+class AdminAIStatsViewTests(SimpleTestCase):
+
+    def get(self, is_staff):
+        request = APIRequestFactory().get('/api/admin/ai-stats/')
+        force_authenticate(request, user=SimpleNamespace(pk=1, is_authenticated=True, is_staff=is_staff))
+        return AdminAIStatsView.as_view()(request)
+
+    def test_staff_get_the_ai_counters(self):
+        response = self.get(is_staff=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['pid'], os.getpid())
+        for name in ('embeddings', 'paraphrases', 'scheduler', 'inflight'):
+            self.assertIn(name, response.data)
+        self.assertIn('hit_rate', response.data['embeddings'])
+
+    def test_other_users_are_refused(self):
+        self.assertEqual(self.get(is_staff=False).status_code, 403)
+
+
+class UserTestCase(TestCase):
+    """A user with an AI profile, and JWT headers to call the API as them."""
+
+    ai_profile = "Alex, 34, lives in Oslo and cycles to work."
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(
+            email='alex@example.com', username='alex', password='unused-password', date_of_birth=date(1991, 5, 4),
+        )
+        UserProfile.objects.create(user=cls.user, ai_profile=cls.ai_profile)
+
+    def setUp(self):
+        # Rate limit counters and cached recommendations live in the default cache
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.headers = {'Authorization': f'Bearer {RefreshToken.for_user(self.user).access_token}'}
+
+
+class AsyncAIViewTests(UserTestCase):
+
+    def test_requests_need_a_token(self):
+        for name in ('async-user-home', 'async-product-recommendations'):
+            with self.subTest(name=name):
+                self.assertEqual(self.client.get(reverse(name)).status_code, 401)
+        response = self.client.post(reverse('async-ai-chat'), {'message': 'Hi'}, content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+        response = self.client.get(reverse('async-user-home'), headers={'Authorization': 'Bearer not-a-token'})
+        self.assertEqual(response.status_code, 401)
+
+    def test_rate_limits_are_shared_with_the_sync_view(self):
+        AIHomeResponse.objects.create(user=self.user, profile_hash=profile_hash(self.ai_profile), content='Cycle more.')
+
+        # UserHomeView allows 5 requests a minute, whichever endpoint serves them
+        for name in ('user-home', 'async-user-home') * 2 + ('async-user-home',):
+            response = self.client.get(reverse(name), headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), {'home_response': 'Cycle more.', 'stale': False})
+
+        self.assertEqual(self.client.get(reverse('async-user-home'), headers=self.headers).status_code, 429)
+        self.assertEqual(self.client.get(reverse('user-home'), headers=self.headers).status_code, 429)
+
+    @mock.patch('api.async_views.schedule_chat_compaction')
+    @mock.patch.object(AIChatView, 'save_new_profile')
+    async def test_chat_stream(self, save_new_profile, schedule_chat_compaction):
+        async def astream_response(chat_history, user_profile, **options):
+            self.assertEqual(chat_history, [{'role': 'user', 'parts': "I'm vegan now"}])
+            self.assertEqual(user_profile, self.ai_profile)
+            yield {'type': 'text', 'text': 'Great, '}
+            yield {'type': 'profile', 'new_profile': 'Alex is vegan.'}
+            yield {'type': 'text', 'text': 'noted.'}
+
+        with mock.patch('api.async_views.AI.astream_response', astream_response):
+            response = await self.async_client.post(
+                reverse('async-ai-chat'), {'message': "I'm vegan now", 'stream': True},
+                content_type='application/json', headers=self.headers,
+            )
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+        events = [json.loads(line[len('data: '):]) for line in body.split('\n\n') if line]
+        self.assertEqual(events[:2], [{'type': 'text', 'text': 'Great, '}, {'type': 'text', 'text': 'noted.'}])
+        self.assertEqual(events[2]['type'], 'done')
+
+        # The profile update is saved, not streamed, and the turn is stored in a new session
+        save_new_profile.assert_called_once_with(self.user, 'Alex is vegan.')
+        session = await ChatSession.objects.aget(pk=events[2]['session_id'], user=self.user)
+        messages = [(message.role, message.content) async for message in ChatMessage.objects.filter(session=session)]
+        self.assertEqual(messages, [('user', "I'm vegan now"), ('model', 'Great, noted.')])
+        schedule_chat_compaction.assert_called_once_with(session.pk)
+
+
+@mock.patch('api.views.schedule_chat_compaction')
+class ChatSessionTests(UserTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('api.views.AI.get_response', side_effect=self.reply)
+        self.get_response = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reply(self, chat_history, user_profile, **options):
+        return {"response": f"Reply to: {chat_history[-1]['parts']}"}
+
+    def chat(self, data):
+        return self.client.post(reverse('ai-chat'), data, content_type='application/json', headers=self.headers)
+
+    def sent_history(self):
+        return self.get_response.call_args.kwargs['chat_history']
+
+    def stored_messages(self, session_id):
+        return list(ChatMessage.objects.filter(session_id=session_id).values_list('role', 'content'))
+
+    def test_a_message_without_session_starts_one(self, schedule_chat_compaction):
+        response = self.chat({'message': 'How do I save water?'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ai_response'], 'Reply to: How do I save water?')
+        self.assertEqual(self.sent_history(), [{'role': 'user', 'parts': 'How do I save water?'}])
+
+        session = ChatSession.objects.get(pk=response.json()['session_id'])
+        self.assertEqual(session.user, self.user)
+        self.assertEqual(self.stored_messages(session.pk), [
+            ('user', 'How do I save water?'), ('model', 'Reply to: How do I save water?'),
+        ])
+        schedule_chat_compaction.assert_called_once_with(session.pk)
+
+    def test_session_id_continues_the_stored_history(self, schedule_chat_compaction):
+        session_id = self.chat({'message': 'How do I save water?'}).json()['session_id']
+
+        response = self.chat({'message': 'And energy?', 'session_id': session_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['session_id'], session_id)
+        self.assertEqual(self.sent_history(), [
+            {'role': 'user', 'parts': 'How do I save water?'},
+            {'role': 'model', 'parts': 'Reply to: How do I save water?'},
+            {'role': 'user', 'parts': 'And energy?'},
+        ])
+        self.assertEqual(len(self.stored_messages(session_id)), 4)
+
+    def test_compacted_sessions_send_the_summary(self, schedule_chat_compaction):
+        session_id = self.chat({'message': 'How do I save water?'}).json()['session_id']
+        summary = [{'role': 'user', 'parts': 'Summary: the user asked about saving water.'}]
+        ChatSession.objects.filter(pk=session_id).update(
+            compacted_history=summary, compacted_upto=ChatMessage.objects.filter(session_id=session_id).last().pk,
+        )
+
+        self.chat({'message': 'And energy?', 'session_id': session_id})
+        self.assertEqual(self.sent_history(), summary + [{'role': 'user', 'parts': 'And energy?'}])
+
+    def test_unknown_sessions_are_not_found(self, schedule_chat_compaction):
+        other_user = get_user_model().objects.create_user(
+            email='sam@example.com', username='sam', password='unused-password', date_of_birth=date(1988, 2, 1),
+        )
+        other_session = ChatSession.objects.create(user=other_user)
+
+        for session_id in (str(uuid.uuid4()), 'not-a-uuid', str(other_session.pk)):
+            with self.subTest(session_id=session_id):
+                response = self.chat({'message': 'Hi', 'session_id': session_id})
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(response.json(), {'error': 'Chat session not found.'})
+        self.get_response.assert_not_called()
+        self.assertFalse(other_session.messages.exists())
+
+    def test_client_side_history_is_still_accepted(self, schedule_chat_compaction):
+        chat_history = [
+            {'role': 'user', 'parts': 'How do I save water?'},
+            {'role': 'model', 'parts': 'Shorter showers.'},
+            {'role': 'user', 'parts': 'And energy?'},
+        ]
+        response = self.chat({'chat_history': chat_history})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'ai_response': 'Reply to: And energy?'})
+        self.assertEqual(self.sent_history(), chat_history)
+        # Nothing is stored for these clients
+        self.assertFalse(ChatSession.objects.exists())
+        schedule_chat_compaction.assert_not_called()
+
+        self.assertEqual(self.chat({'chat_history': []}).status_code, 400)
+
+
+@override_settings(CHAT_COMPACTION={'AFTER_MESSAGES': 6, 'AFTER_TOKENS': 1000, 'KEEP_RECENT': 2})
+class ChatCompactionTests(UserTestCase):
+
+    summary = [{'role': 'user', 'parts': 'Conversation summary: the user saves water.'}]
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('api.tasks.AI.compact_chat', return_value=self.summary)
+        self.compact_chat = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = None
+
+    def chat_turns(self, *messages):
+        for message in messages:
+            self.session = save_chat_turn(self.user, self.session, message, f'Reply to: {message}')
+        self.session.refresh_from_db()
+
+    def test_short_sessions_are_left_alone(self):
+        self.chat_turns('How do I save water?', 'And energy?')
+        tasks.compact_chat_session(self.session.pk)
+        self.compact_chat.assert_not_called()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.compacted_upto, 0)
+
+    def test_the_message_count_triggers_compaction(self):
+        self.chat_turns('How do I save water?', 'And energy?', 'What about food?')
+        tasks.compact_chat_session(self.session.pk)
+
+        # All but the last turn are summarized; the summary replaces them in the AI's history
+        self.compact_chat.assert_called_once()
+        self.assertEqual([message['parts'] for message in self.compact_chat.call_args.args[0]], [
+            'How do I save water?', 'Reply to: How do I save water?', 'And energy?', 'Reply to: And energy?',
+        ])
+        self.session.refresh_from_db()
+        self.assertEqual(chat_session_history(self.session), self.summary + [
+            {'role': 'user', 'parts': 'What about food?'},
+            {'role': 'model', 'parts': 'Reply to: What about food?'},
+        ])
+        self.assertEqual(self.session.messages.count(), 6)
+
+    def test_the_token_estimate_triggers_compaction(self):
+        # ~610 tokens by characters / 4, but ~1200 words and punctuation marks
+        self.chat_turns('a ' * 600, 'And energy?')
+        tasks.compact_chat_session(self.session.pk)
+        self.compact_chat.assert_called_once()
+        self.session.refresh_from_db()
+        self.assertEqual(chat_session_history(self.session)[0], self.summary[0])
+        self.assertEqual(len(chat_session_history(self.session)), 3)
+
+    def test_a_new_summary_includes_the_previous_one(self):
+        self.chat_turns('How do I save water?', 'And energy?', 'What about food?')
+        tasks.compact_chat_session(self.session.pk)
+        self.chat_turns('Cheap solar panels?', 'Any bikes?')
+        tasks.compact_chat_session(self.session.pk)
+
+        self.assertEqual(self.compact_chat.call_count, 2)
+        history = self.compact_chat.call_args.args[0]
+        self.assertEqual(history[0], self.summary[0])
+        self.assertEqual(history[1], {'role': 'user', 'parts': 'What about food?'})
+        self.session.refresh_from_db()
+        self.assertEqual(len(chat_session_history(self.session)), 3)
+
+    def test_a_concurrent_compaction_wins(self):
+        self.chat_turns('How do I save water?', 'And energy?', 'What about food?')
+
+        def compacted_meanwhile(history):
+            ChatSession.objects.filter(pk=self.session.pk).update(compacted_upto=1)
+            return self.summary
+
+        self.compact_chat.side_effect = compacted_meanwhile
+        tasks.compact_chat_session(self.session.pk)
+        self.session.refresh_from_db()
+        self.assertEqual((self.session.compacted_upto, self.session.compacted_history), (1, []))
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-default'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests-shared'},
+})
+class RecommendationTestCase(UserTestCase):
+    """Product searches over the real catalog, with the query embedding and paraphrase stubbed out."""
+
+    def setUp(self):
+        super().setUp()
+        shared_cache.clear()
+        self.addCleanup(shared_cache.clear)
+        # Searches rank the catalog for one of its own products
+        self.vector = np.asarray(AI.catalog.embeddings[7], dtype=np.float32)
+        for name, patcher in {
+            'embed_queries': mock.patch('api.views.AI.embed_queries', side_effect=lambda queries, **kw: [self.vector] * len(queries)),
+            'paraphrase_query': mock.patch('api.views.AI.paraphrase_query', side_effect=lambda query: query),
+        }.items():
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def links(self, response):
+        return [product['site-link'] for product in response.json()['products']]
+
+    def ranked_links(self, start, stop):
+        ranked_ids = AI.catalog.search(self.vector, ProductRecommendationsView.MAX_RESULTS).tolist()
+        return AI.products.iloc[ranked_ids[start:stop]]['site-link'].tolist()
+
+
+class SearchPaginationTests(RecommendationTestCase):
+
+    def search(self, data):
+        return self.client.post(reverse('product_recommendations'), data, content_type='application/json', headers=self.headers)
+
+    def test_later_pages_reuse_the_ranking(self):
+        first = self.search({'query': 'reusable bottle', 'page_size': 10})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(self.links(first), self.ranked_links(0, 10))
+        search_id = first.json()['search_id']
+
+        second = self.search({'search_id': search_id, 'page': 2, 'page_size': 10})
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json()['search_id'], search_id)
+        self.assertEqual((second.json()['page'], second.json()['has_more']), (2, True))
+        self.assertEqual(self.links(second), self.ranked_links(10, 20))
+
+        # Served from the cached ranking: no second embedding or paraphrase
+        self.embed_queries.assert_called_once()
+        self.paraphrase_query.assert_called_once()
+
+        # GET reads the same search by query parameter
+        response = self.client.get(reverse('product_recommendations'), {'search_id': search_id, 'page': 2, 'page_size': 10}, headers=self.headers)
+        self.assertEqual(self.links(response), self.ranked_links(10, 20))
+
+    def test_rankings_stop_at_max_results(self):
+        max_results = ProductRecommendationsView.MAX_RESULTS
+        self.assertGreater(len(AI.products), max_results)
+        search_id = self.search({'query': 'reusable bottle', 'page_size': 50}).json()['search_id']
+
+        last = self.search({'search_id': search_id, 'page': max_results // 50, 'page_size': 50})
+        self.assertEqual(self.links(last), self.ranked_links(max_results - 50, max_results))
+        self.assertFalse(last.json()['has_more'])
+
+        past_the_end = self.search({'search_id': search_id, 'page': max_results // 50 + 1, 'page_size': 50})
+        self.assertEqual(past_the_end.status_code, 200)
+        self.assertEqual(past_the_end.json()['products'], [])
+
+    def test_expired_searches_are_gone(self):
+        search_id = self.search({'query': 'reusable bottle'}).json()['search_id']
+        shared_cache.clear()
+
+        for search in (search_id, 'never-issued'):
+            with self.subTest(search_id=search):
+                response = self.search({'search_id': search, 'page': 2})
+                self.assertEqual(response.status_code, 410)
+                self.assertEqual(response.json(), {'error': 'Search expired. Please search again.'})
+
+    def test_invalid_pages_are_rejected(self):
+        for data in ({'query': 'bottle', 'page': 0}, {'query': 'bottle', 'page_size': 51}, {'query': 'bottle', 'page': 'two'}):
+            with self.subTest(data=data):
+                self.assertEqual(self.search(data).status_code, 400)
+        self.embed_queries.assert_not_called()
+
+
+class ProfileRecommendationTests(RecommendationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('api.views.AI.get_product_query_from_profile', side_effect=lambda profile: f'Products for {profile}')
+        self.profile_query = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def recommend(self, **params):
+        response = self.client.get(reverse('product_recommendations'), params, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_the_ranking_is_reused_for_the_same_profile(self):
+        first = self.recommend(page_size=10)
+        second = self.recommend(page_size=10)
+        self.assertEqual(self.links(second), self.links(first))
+        self.assertEqual(second.json()['search_id'], first.json()['search_id'])
+        # One LLM query and one embedding for both requests
+        self.profile_query.assert_called_once_with(self.ai_profile)
+        self.embed_queries.assert_called_once()
+
+        # The cached ranking also serves later pages by search_id
+        shared_cache.clear()
+        page_2 = self.recommend(page=2, page_size=10)
+        self.assertEqual(self.links(page_2), self.ranked_links(10, 20))
+        next_page = self.recommend(search_id=page_2.json()['search_id'], page=3, page_size=10)
+        self.assertEqual(self.links(next_page), self.ranked_links(20, 30))
+        self.profile_query.assert_called_once()
+
+    def test_a_profile_change_invalidates_the_ranking(self):
+        self.recommend()
+        self.user.profile.ai_profile = 'Alex, 34, moved to a farm.'
+        self.user.profile.save()
+        self.assertIsNone(cache.get(recommendation_cache_key(self.user.pk)))
+
+        self.recommend()
+        self.assertEqual(self.profile_query.call_count, 2)
+        self.profile_query.assert_called_with('Alex, 34, moved to a farm.')
+        self.assertEqual(cache.get(recommendation_cache_key(self.user.pk))['profile_hash'], profile_hash('Alex, 34, moved to a farm.'))
+
+    def test_the_profile_hash_catches_changes_without_signals(self):
+        self.recommend()
+        # update() sends no post_save, only the stored hash tells the ranking is stale
+        UserProfile.objects.filter(user=self.user).update(ai_profile='Alex, 34, moved to a farm.')
+        self.assertIsNotNone(cache.get(recommendation_cache_key(self.user.pk)))
+
+        self.recommend()
+        self.assertEqual(self.profile_query.call_count, 2)
+        self.assertEqual(self.embed_queries.call_count, 2)
+
+
+class HomePregenerationTests(UserTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch('AI.AI.AI.AI_home_response', side_effect=lambda user_profile: f'Tips for {user_profile}')
+        self.home_response = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def home(self):
+        response = self.client.get(reverse('user-home'), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_the_first_visit_generates_and_stores(self):
+        self.assertEqual(self.home(), {'home_response': f'Tips for {self.ai_profile}', 'stale': False})
+        stored = AIHomeResponse.objects.get(user=self.user)
+        self.assertEqual(stored.profile_hash, profile_hash(self.ai_profile))
+
+        self.assertEqual(self.home(), {'home_response': stored.content, 'stale': False})
+        self.home_response.assert_called_once()
+
+    @mock.patch('api.views.schedule_home_refresh')
+    def test_stale_suggestions_are_served_and_refreshed(self, schedule_home_refresh):
+        AIHomeResponse.objects.create(user=self.user, profile_hash=profile_hash('Old profile'), content='Old tips')
+        self.assertEqual(self.home(), {'home_response': 'Old tips', 'stale': True})
+        schedule_home_refresh.assert_called_once_with(self.user.pk)
+        self.home_response.assert_not_called()
+
+    @mock.patch('api.signals.schedule_home_refresh')
+    def test_profile_saves_schedule_a_refresh_after_commit(self, schedule_home_refresh):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.user.profile.save()
+            schedule_home_refresh.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        schedule_home_refresh.assert_called_once_with(self.user.pk)
+
+    def test_the_refresh_only_regenerates_stale_suggestions(self):
+        tasks.store_home_response(self.user, profile_hash(self.ai_profile), 'Current tips')
+        tasks.refresh_home_response(self.user.pk)
+        self.home_response.assert_not_called()
+
+        UserProfile.objects.filter(user=self.user).update(ai_profile='Alex, 34, moved to a farm.')
+        tasks.refresh_home_response(self.user.pk)
+        stored = AIHomeResponse.objects.get(user=self.user)
+        self.assertEqual(stored.content, 'Tips for Alex, 34, moved to a farm.')
+        self.assertEqual(stored.profile_hash, profile_hash('Alex, 34, moved to a farm.'))
@@ -10,12 +10,14 @@ from .views import (
     AIChatView,
     ProductRecommendationsView,
     AdminUserStatsView,
+    AdminAIStatsView,
     AdminUserIPLogsView,
     PasswordResetRequestView,
     VerifyOTPView,
     ResetPasswordView,
     ChangePasswordView
 )
+from .async_views import AsyncUserHomeView, AsyncAIChatView, AsyncProductRecommendationsView
 
 
 urlpatterns = [
@@ -31,6 +33,11 @@ urlpatterns = [
     path('userhome/', UserHomeView.as_view(), name='user-home'),
     path('ai/chat/', AIChatView.as_view(), name='ai-chat'),
     path('recommendations/', ProductRecommendationsView.as_view(), name='product_recommendations'),
+    # Async versions of the AI endpoints, for ASGI deployments (see EcoGenie/asgi.py)
+    path('async/userhome/', AsyncUserHomeView.as_view(), name='async-user-home'),
+    path('async/ai/chat/', AsyncAIChatView.as_view(), name='async-ai-chat'),
+    path('async/recommendations/', AsyncProductRecommendationsView.as_view(), name='async-product-recommendations'),
     path('admin/user-stats/', AdminUserStatsView.as_view(), name='admin-user-stats'),
     path('admin/user-ip-logs/', AdminUserIPLogsView.as_view(), name='admin-user-ip-logs'),
+    path('admin/ai-stats/', AdminAIStatsView.as_view(), name='admin-ai-stats'),
 ]
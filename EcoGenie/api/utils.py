@@ -0,0 +1,81 @@
+import hashlib
+import json
+
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from OrionEngine.models import UserProfile, ChatSession, ChatMessage
+
+from .serializers import UserProfileSerializer
+
+
+def get_effective_user_profile(user):
+    """
+    Returns the effective user profile for AI usage.
+    - If ai_profile exists, return ai_profile text (string).
+    - Otherwise, return survey data combined with basic user info (dict).
+    """
+    try:
+        profile = user.profile  # related_name='profile'
+    except UserProfile.DoesNotExist:
+        return None
+
+    if profile.ai_profile:
+        return profile.ai_profile  # String
+
+    # Build from survey fields if ai_profile doesn't exist yet
+    serializer = UserProfileSerializer(profile)
+    basic_user_info = {
+        "name": user.username,
+        "date_of_birth": user.date_of_birth,
+        "user_region": user.region,
+        "user_gender": user.gender,
+    }
+    return {**serializer.data, **basic_user_info}
+
+
+def profile_hash(user_profile_data):
+    """
+    Returns a stable hash of the effective user profile (ai_profile text or survey dict).
+    Anything cached from the profile is stored with this hash and ignored once it changes.
+    """
+    serialized = json.dumps(user_profile_data, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def recommendation_cache_key(user_id):
+    return f'product_recommendations_{user_id}'
+
+
+def get_chat_session(user, session_id):
+    """Returns the user's chat session with this id. Raises ChatSession.DoesNotExist otherwise."""
+    try:
+        return ChatSession.objects.get(pk=session_id, user=user)
+    except (ValidationError, ValueError):
+        # Not a valid UUID, so it can't be a session either
+        raise ChatSession.DoesNotExist
+
+
+def chat_session_history(session):
+    """
+    Returns the session's history in the chat_history format used by the AI ({"role", "parts"}):
+    the compacted summary followed by the messages that came after it.
+    """
+    messages = session.messages.filter(id__gt=session.compacted_upto).values_list("role", "content")
+    return list(session.compacted_history) + [{"role": role, "parts": content} for role, content in messages]
+
+
+def save_chat_turn(user, session, message, reply):
+    """
+    Appends the user's message and the AI reply to the session, creating the session if it is None.
+    Returns the session.
+    """
+    if session is None:
+        session = ChatSession.objects.create(user=user)
+    ChatMessage.objects.bulk_create([
+        ChatMessage(session=session, role="user", content=message),
+        ChatMessage(session=session, role="model", content=reply),
+    ])
+    # Bump updated_at without rewriting the row's other fields
+    ChatSession.objects.filter(pk=session.pk).update(updated_at=timezone.now())
+    return session
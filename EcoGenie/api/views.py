@@ -3,7 +3,7 @@ from django.conf import settings
 from django.contrib.auth import authenticate, get_user_model
 from django.contrib.auth.tokens import PasswordResetTokenGenerator 
 from django.db import IntegrityError
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -20,7 +20,7 @@ from rest_framework.views import APIView
 from rest_framework_simplejwt.tokens import RefreshToken
 
 # Local Application Imports
-from OrionEngine.models import CustomUser, UserProfile, UserIPLog
+from OrionEngine.models import CustomUser, UserProfile, UserIPLog, AIHomeResponse, ChatSession
 
 #serializers
 from .serializers import (
@@ -28,9 +28,16 @@ from .serializers import (
     UserIPLogSerializer,
     PasswordResetRequestSerializer,
 )
+from .utils import (
+    get_effective_user_profile, profile_hash, recommendation_cache_key,
+    get_chat_session, chat_session_history, save_chat_turn,
+)
+from .idempotency import idempotent
+from .tasks import schedule_chat_compaction, schedule_home_refresh, schedule_profile_save, store_home_response
 
 # Custom Modules
 from AI.AI import AI
+from AI.scheduler import LLMUnavailable
 
 #get the user model defined in settings
 User = get_user_model()
@@ -58,6 +65,18 @@ def custom_ratelimit_exceeded(request, exception=None):
     )
 
 
+AI_UNAVAILABLE_MESSAGE = "EcoGenie is very busy right now. Please try again in a moment."
+
+
+def ai_unavailable(error, **extra):
+    """
+    Fast degraded answer while the model can't be called (circuit open or out of quota, see AI/scheduler.py).
+    """
+    response = JsonResponse({'error': AI_UNAVAILABLE_MESSAGE, 'degraded': True, **extra}, status=503)
+    response['Retry-After'] = str(int(error.retry_after or 0) + 1)
+    return response
+
+
 DEFAULT_TERMS_AND_CONDITIONS = """
 Welcome to EcoGenie!
 
@@ -260,6 +279,7 @@ class LoginView(APIView):
 
 import random
 from django.core.cache import cache
+from EcoGenie.cache import shared_cache
 
 
 class PasswordResetRequestView(APIView):
@@ -516,46 +536,22 @@ class UserProfileView(APIView):
 
 #### AI Stuffs #########
 
-##Helper Function profile.
-
-def get_effective_user_profile(user):
-    """
-    Returns the effective user profile for AI usage.
-    - If ai_profile exists, return ai_profile text (string).
-    - Otherwise, return survey data combined with basic user info (dict).
-    """
-    try:
-        profile = user.profile  # related_name='profile'
-    except UserProfile.DoesNotExist:
-        return None
-
-    if profile.ai_profile:
-        return profile.ai_profile  # String
-
-    # Build from survey fields if ai_profile doesn't exist yet
-    serializer = UserProfileSerializer(profile)
-    basic_user_info = {
-        "name": user.username,
-        "date_of_birth": user.date_of_birth,
-        "user_region": user.region,
-        "user_gender": user.gender,
-    }
-    return {**serializer.data, **basic_user_info}
-
-
-
-
 # API view for the user's home screen data.
 class UserHomeView(APIView):
     permission_classes = [IsAuthenticated]
+    # HTTP method: (group, limits) for apply_rate_limits. The async views in api.async_views
+    # apply the same tables, so both endpoints share one set of limits.
+    rate_limits = {
+        'GET': ('user_home_get', [
+            {'rate': '5/m', 'key': 'user', 'method': 'GET'},
+            {'rate': '100/d', 'key': 'user', 'method': 'GET'},
+        ]),
+    }
 
     def get(self, request):
         # Apply rate limits
-        rate_limits = [
-            {'rate': '5/m', 'key': 'user', 'method': 'GET'},
-            {'rate': '100/d', 'key': 'user', 'method': 'GET'},
-        ]
-        rate_limit_response = apply_rate_limits(request, rate_limits, group='user_home_get')
+        group, rate_limits = self.rate_limits['GET']
+        rate_limit_response = apply_rate_limits(request, rate_limits, group=group)
         if rate_limit_response:
             return rate_limit_response
 
@@ -566,48 +562,167 @@ class UserHomeView(APIView):
             if not user_profile_data:
                 return Response({"error": "User profile not found."}, status=status.HTTP_404_NOT_FOUND)
 
-            # Send to AI
+            # Serve the suggestions generated in the background (see api.tasks)
+            current_hash = profile_hash(user_profile_data)
+            stored = AIHomeResponse.objects.filter(user=request.user).first()
+            if stored:
+                stale = stored.profile_hash != current_hash
+                if stale:
+                    # Profile changed since they were generated: serve them now, regenerate for next time
+                    schedule_home_refresh(request.user.pk)
+                return Response({"home_response": stored.content, "stale": stale}, status=status.HTTP_200_OK)
+
+            # Nothing generated yet (first visit): send to AI and store the result
             ai_response = AI.AI_home_response(user_profile=user_profile_data)
+            store_home_response(request.user, current_hash, ai_response)
 
-            return Response({"home_response": ai_response}, status=status.HTTP_200_OK)
+            return Response({"home_response": ai_response, "stale": False}, status=status.HTTP_200_OK)
 
+        except LLMUnavailable as e:
+            return ai_unavailable(e)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
 # API view to handle AI chat interactions.
+import json
+
 class AIChatView(APIView):
     permission_classes = [IsAuthenticated]
+    rate_limits = {
+        'POST': ('ai_chat_post', [
+            {'rate': '15/m', 'key': 'user', 'method': 'POST'},
+            {'rate': '100/d', 'key': 'user', 'method': 'POST'},
+        ]),
+    }
+
+    def save_new_profile(self, user, new_profile):
+        # Persisted in the background, the reply doesn't wait for the write
+        schedule_profile_save(user.pk, new_profile)
+
+    def load_chat(self, user, data):
+        """
+        Reads the chat turn from the request data, either
+        - {"message": ..., "session_id": ...}: the history comes from the stored session
+          (no session_id starts a new session), or
+        - {"chat_history": [...]}: the client sends the whole history (older clients).
+        Returns (chat_history, session, message); message is None for client side history.
+        Raises ValueError for invalid data and ChatSession.DoesNotExist for an unknown session.
+        """
+        session_id = data.get("session_id")
+        message = data.get("message")
+
+        if session_id is None and message is None:
+            chat_history = data.get("chat_history", [])
+            if not isinstance(chat_history, list) or not chat_history:
+                raise ValueError("chat_history must be a non-empty list.")
+            return chat_history, None, None
+
+        if not isinstance(message, str) or not message.strip():
+            raise ValueError("message must be a non-empty string.")
+
+        session = get_chat_session(user, session_id) if session_id else None
+        chat_history = chat_session_history(session) if session else []
+        return chat_history + [{"role": "user", "parts": message}], session, message
+
+    def cache_options(self, data):
+        """
+        Semantic cache arguments for the AI call. {"cache": false} in the request bypasses the cache.
+        """
+        return {"use_cache": AI.semantic_cache is not None and data.get("cache") is not False}
+
+    def event_stream(self, request, chat_history, user_profile_data, session=None, message=None, cache_options=None):
+        """
+        Server-Sent Events: one "data: {json}" event per text chunk, then a final
+        {"type": "done"} event (with the session_id for stored sessions).
+        A profile update and the stored messages are saved once the stream completes.
+        """
+        new_profile = None
+        reply = []
+        try:
+            for event in AI.stream_response(chat_history=chat_history, user_profile=user_profile_data, **(cache_options or {})):
+                if event["type"] == "profile":
+                    new_profile = event["new_profile"]
+                    continue
+                reply.append(event["text"])
+                yield f"data: {json.dumps(event)}\n\n"
+
+            #Save new AI profile if returned
+            if new_profile is not None:
+                self.save_new_profile(request.user, new_profile)
+
+            done = {'type': 'done'}
+            if message is not None:
+                session = save_chat_turn(request.user, session, message, "".join(reply))
+                done['session_id'] = str(session.pk)
+                schedule_chat_compaction(session.pk)
+
+            yield f"data: {json.dumps(done)}\n\n"
+
+        except LLMUnavailable:
+            yield f"data: {json.dumps({'type': 'error', 'error': AI_UNAVAILABLE_MESSAGE, 'degraded': True})}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
 
     def post(self, request):
+        """
+        POST - One chat turn. Send {"message", "session_id"} to continue a stored session
+        (session_id is returned with the reply), or the full "chat_history" list.
+        Optional: "stream": true for Server-Sent Events, "cache": false to skip the semantic cache.
+        Send an Idempotency-Key header to make retries safe: a retry gets the original reply.
+        """
+        return idempotent(request, 'ai_chat', request.data, lambda: self.process_post(request))
+
+    def process_post(self, request):
         # Rate limits
-        rate_limits = [
-            {'rate': '15/m', 'key': 'user', 'method': 'POST'},
-            {'rate': '100/d', 'key': 'user', 'method': 'POST'},
-        ]
-        rate_limit_response = apply_rate_limits(request, rate_limits, group='ai_chat_post')
+        group, rate_limits = self.rate_limits['POST']
+        rate_limit_response = apply_rate_limits(request, rate_limits, group=group)
         if rate_limit_response:
             return rate_limit_response
 
         try:
-            chat_history = request.data.get("chat_history", [])
-            if not isinstance(chat_history, list) or not chat_history:
-                return Response({"error": "chat_history must be a non-empty list."}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                chat_history, session, message = self.load_chat(request.user, request.data)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            except ChatSession.DoesNotExist:
+                return Response({"error": "Chat session not found."}, status=status.HTTP_404_NOT_FOUND)
 
             user_profile_data = get_effective_user_profile(request.user)
             if not user_profile_data:
                 return Response({"error": "User profile not found."}, status=status.HTTP_404_NOT_FOUND)
 
-            ai_response_data = AI.get_response(chat_history=chat_history, user_profile=user_profile_data)
+            cache_options = self.cache_options(request.data)
+
+            # {"stream": true}: stream tokens to the client as they are generated
+            if request.data.get("stream"):
+                response = StreamingHttpResponse(
+                    self.event_stream(request, chat_history, user_profile_data, session, message, cache_options),
+                    content_type='text/event-stream',
+                )
+                response['Cache-Control'] = 'no-cache'
+                response['X-Accel-Buffering'] = 'no'  # stop nginx from buffering the events
+                return response
+
+            ai_response_data = AI.get_response(chat_history=chat_history, user_profile=user_profile_data, **cache_options)
 
             #Save new AI profile if returned
             if "new_profile" in ai_response_data:
-                profile = request.user.profile
-                profile.ai_profile = ai_response_data["new_profile"]
-                profile.save()
+                self.save_new_profile(request.user, ai_response_data["new_profile"])
+
+            response_data = {"ai_response": ai_response_data.get("response")}
 
-            return Response({"ai_response": ai_response_data.get("response")}, status=status.HTTP_200_OK)
+            # Stored sessions: append this turn and tell the client which session it belongs to
+            if message is not None:
+                session = save_chat_turn(request.user, session, message, ai_response_data.get("response") or "")
+                response_data["session_id"] = str(session.pk)
+                # Long sessions are summarized in the background, never during a request
+                schedule_chat_compaction(session.pk)
 
+            return Response(response_data, status=status.HTTP_200_OK)
+
+        except LLMUnavailable as e:
+            return ai_unavailable(e, ai_response=AI_UNAVAILABLE_MESSAGE)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -615,12 +730,35 @@ class AIChatView(APIView):
 
 # API view to provide product recommendations.
 import math
+import uuid
 
 class ProductRecommendationsView(APIView):
     permission_classes = [IsAuthenticated]
+    rate_limits = {
+        'GET': ('product_recommendations_get', [
+            {'rate': '5/m', 'key': 'user', 'method': 'GET'},
+            {'rate': '100/d', 'key': 'user', 'method': 'GET'},
+        ]),
+        'POST': ('product_recommendations_post', [
+            {'rate': '10/m', 'key': 'user', 'method': 'POST'},
+            {'rate': '500/d', 'key': 'user', 'method': 'POST'},
+        ]),
+    }
 
     REQUIRED_FIELDS = ["title", "brand", "description", "image-link", "site-link"]
 
+    # Pagination: a search is ranked once (top MAX_RESULTS) and its ranked ids are cached,
+    # so later pages are served by search_id without embedding or re-ranking anything.
+    # The ranking goes to the shared cache, so any worker can serve the next page.
+    DEFAULT_PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 50
+    MAX_RESULTS = 100
+    SEARCH_TIMEOUT = 600  # 10 minutes
+
+    # Profile based recommendations only change with the profile, so they are cached per user
+    # together with the profile hash (and dropped by api.signals when the profile is saved).
+    RECOMMENDATION_TIMEOUT = 86400  # 1 day
+
     def clean_products(self, products):
         """
         Ensures each product contains only required fields 
@@ -637,57 +775,151 @@ class ProductRecommendationsView(APIView):
             cleaned_products.append(cleaned)
         return cleaned_products
 
+    def get_page_params(self, params):
+        """
+        Reads page (1-based) and page_size from the request.
+        Raises ValueError for invalid values.
+        """
+        page = int(params.get('page', 1))
+        page_size = int(params.get('page_size', self.DEFAULT_PAGE_SIZE))
+        if page < 1 or not 1 <= page_size <= self.MAX_PAGE_SIZE:
+            raise ValueError(f'page must be >= 1 and page_size between 1 and {self.MAX_PAGE_SIZE}.')
+        return page, page_size
+
+    def search_cache_key(self, request, search_id):
+        return f'product_search_{request.user.pk}_{search_id}'
+
+    def start_search(self, request, query):
+        """
+        Ranks the catalog once for the query (or list of queries) and caches the ranked product ids.
+        Returns the new search_id and the ranked ids.
+        """
+        if isinstance(query, list):
+            # Several queries are embedded together and their rankings fused
+            ranked_ids = AI.rank_products_batch(query, self.MAX_RESULTS)
+        else:
+            ranked_ids = AI.rank_products(query, self.MAX_RESULTS)
+        search_id = uuid.uuid4().hex
+        shared_cache.set(self.search_cache_key(request, search_id), ranked_ids, timeout=self.SEARCH_TIMEOUT)
+        return search_id, ranked_ids
+
+    def page_response(self, search_id, ranked_ids, page, page_size):
+        start = (page - 1) * page_size
+        products = self.clean_products(AI.products_from_indices(ranked_ids[start:start + page_size]))
+        return Response({
+            "products": products,
+            "search_id": search_id,
+            "page": page,
+            "page_size": page_size,
+            "has_more": start + page_size < len(ranked_ids),
+        }, status=status.HTTP_200_OK)
+
+    def cached_page(self, request, params):
+        """
+        Serves a page of an earlier search if a search_id was sent.
+        Returns None when no search_id was given.
+        """
+        search_id = params.get('search_id')
+        if not search_id:
+            return None
+
+        page, page_size = self.get_page_params(params)
+        ranked_ids = shared_cache.get(self.search_cache_key(request, search_id))
+        if ranked_ids is None:
+            return Response({'error': 'Search expired. Please search again.'}, status=status.HTTP_410_GONE)
+        return self.page_response(search_id, ranked_ids, page, page_size)
+
     def get(self, request):
         """
         GET - Generate product recommendations based on the user's profile
+        Optional query params: page, page_size, search_id (to fetch further pages)
         """
         # Apply user-specific rate limits
-        rate_limits = [
-            {'rate': '5/m', 'key': 'user', 'method': 'GET'},
-            {'rate': '100/d', 'key': 'user', 'method': 'GET'},
-        ]
-        rate_limit_response = apply_rate_limits(request, rate_limits, group='product_recommendations_get')
+        group, rate_limits = self.rate_limits['GET']
+        rate_limit_response = apply_rate_limits(request, rate_limits, group=group)
         if rate_limit_response:
             return rate_limit_response
 
         try:
+            try:
+                # Later pages of an earlier search are served from the cached ranking
+                cached_response = self.cached_page(request, request.query_params)
+                if cached_response:
+                    return cached_response
+                page, page_size = self.get_page_params(request.query_params)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
             # Step 1: Get effective user profile data
             user_profile_data = get_effective_user_profile(request.user)
             if not user_profile_data:
                 return Response({"error": "User profile not found."}, status=status.HTTP_404_NOT_FOUND)
 
-            # Step 2: Generate query from the user profile
-            generated_query = AI.get_product_query_from_profile(user_profile_data)
-
-            # Step 3: Paraphrase the generated query
-            paraphrased_query = AI.paraphrase_query(generated_query)
-
-            # Step 4: Get matching products
-            products = AI.get_products(paraphrased_query)
-
-            # Step 5: Clean products
-            products = self.clean_products(products)
-
-            return Response({"products": products}, status=status.HTTP_200_OK)
+            # Step 2: Reuse the ranking for this exact profile if we have one
+            current_hash = profile_hash(user_profile_data)
+            cache_key = recommendation_cache_key(request.user.pk)
+            cached = cache.get(cache_key)
 
+            if cached and cached["profile_hash"] == current_hash:
+                search_id, ranked_ids = cached["search_id"], cached["ranked_ids"]
+                # Keep later pages reachable by search_id
+                shared_cache.set(self.search_cache_key(request, search_id), ranked_ids, timeout=self.SEARCH_TIMEOUT)
+            else:
+                # Step 3: Generate the search query from the user profile (a single LLM step)
+                generated_query = AI.get_product_query_from_profile(user_profile_data)
+
+                # Step 4: Rank matching products once and remember them for this profile
+                search_id, ranked_ids = self.start_search(request, generated_query)
+                cache.set(cache_key, {
+                    "profile_hash": current_hash,
+                    "search_id": search_id,
+                    "ranked_ids": ranked_ids,
+                }, timeout=self.RECOMMENDATION_TIMEOUT)
+
+            # Step 5: Return the requested page of clean products
+            return self.page_response(search_id, ranked_ids, page, page_size)
+
+        except LLMUnavailable as e:
+            return ai_unavailable(e)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
     def post(self, request):
         """
         POST - Search for products based on a custom user query
+        Optional fields: page, page_size, search_id (to fetch further pages without a query),
+        queries (a list of queries searched together instead of a single query)
+        Send an Idempotency-Key header to make retries safe: a retry gets the original results.
         """
+        return idempotent(request, 'product_search', request.data, lambda: self.process_post(request))
+
+    def process_post(self, request):
         # Apply user-specific rate limits
-        rate_limits = [
-            {'rate': '10/m', 'key': 'user', 'method': 'POST'},
-            {'rate': '500/d', 'key': 'user', 'method': 'POST'},
-        ]
-        rate_limit_response = apply_rate_limits(request, rate_limits, group='product_recommendations_post')
+        group, rate_limits = self.rate_limits['POST']
+        rate_limit_response = apply_rate_limits(request, rate_limits, group=group)
         if rate_limit_response:
             return rate_limit_response
 
         try:
+            try:
+                # Later pages of an earlier search are served from the cached ranking
+                cached_response = self.cached_page(request, request.data)
+                if cached_response:
+                    return cached_response
+                page, page_size = self.get_page_params(request.data)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
             query = request.data.get('query', '')
+            queries = request.data.get('queries', [])
+
+            if queries:
+                if not isinstance(queries, list) or not all(isinstance(q, str) and q for q in queries):
+                    return Response({'error': 'queries must be a list of non-empty strings.'}, status=status.HTTP_400_BAD_REQUEST)
+
+                # Several product intents: one embedding call and one fused ranking
+                search_id, ranked_ids = self.start_search(request, queries)
+                return self.page_response(search_id, ranked_ids, page, page_size)
 
             if not query:
                 return Response({'error': 'Query field is required.'}, status=status.HTTP_400_BAD_REQUEST)
@@ -695,14 +927,14 @@ class ProductRecommendationsView(APIView):
             # Step 1: Paraphrase the user's custom query
             paraphrased_query = AI.paraphrase_query(query)
 
-            # Step 2: Get matching products
-            products = AI.get_products(paraphrased_query)
-
-            # Step 3: Clean products
-            products = self.clean_products(products)
+            # Step 2: Rank matching products once
+            search_id, ranked_ids = self.start_search(request, paraphrased_query)
 
-            return Response({"products": products}, status=status.HTTP_200_OK)
+            # Step 3: Return the requested page of clean products
+            return self.page_response(search_id, ranked_ids, page, page_size)
 
+        except LLMUnavailable as e:
+            return ai_unavailable(e)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -747,6 +979,32 @@ class AdminUserStatsView(APIView):
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+import os
+
+# Admin API view to get this worker's AI cache and scheduler counters (AI.cache_stats).
+class AdminAIStatsView(APIView):
+    # Requires the user to be authenticated.
+    permission_classes = [IsAuthenticated]
+
+    # Handles GET requests for the AI counters.
+    def get(self, request):
+        # Applies user-specific rate limits.
+        rate_limits = [
+            {'rate': '15/m', 'key': 'user', 'method': 'GET'},
+            {'rate': '200/d', 'key': 'user', 'method': 'GET'},
+        ]
+        rate_limit_response = apply_rate_limits(request, rate_limits, group='admin_ai_stats_get')
+        if rate_limit_response:
+            return rate_limit_response
+
+        # Checks if the authenticated user is a staff member (admin).
+        if not request.user.is_staff:
+            # Returns forbidden if user is not an admin.
+            return Response({"error": "Unauthorized access. Admins only."}, status=status.HTTP_403_FORBIDDEN)
+
+        # Counters are per worker process; the pid tells the workers' answers apart
+        return Response({"pid": os.getpid(), **AI.cache_stats()}, status=status.HTTP_200_OK)
+
 # Admin API view to get user IP logs.
 class AdminUserIPLogsView(APIView):
     # Requires the user to be authenticated.